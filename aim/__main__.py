@@ -7,7 +7,56 @@ sub_parser = parser.add_subparsers(help="Commands", dest="command")
 sub_parser.required = False
 
 sub_parser.add_parser("init")
-sub_parser.add_parser("run")
+run_parser = sub_parser.add_parser("run")
+run_parser.add_argument("--no-cache", action="store_true", help="Compile main.py even if it is in the compile cache")
+run_parser.add_argument(
+	"--backend",
+	choices=("numpy", "numba"),
+	default="numpy",
+	help="numba compiles the whole program into one kernel, but only supports a few nodes",
+)
+run_parser.add_argument(
+	"--profile",
+	nargs="?",
+	type=int,
+	const=10,
+	metavar="N",
+	help="Time the nodes while playing and print the N slowest, 10 if not given, about once per second",
+)
+run_parser.add_argument(
+	"--debug",
+	action="store_true",
+	help="Compile in print nodes and the debug output of the nodes. Left out otherwise",
+)
+run_parser.add_argument(
+	"--record",
+	metavar="PATH",
+	help="Write what is played to a file. .wav, or raw float32 for anything else",
+)
+run_parser.add_argument(
+	"--audio-profile",
+	help="Profile of aim.json to run with, like low-latency, balanced or throughput",
+)
+render_parser = sub_parser.add_parser("render", help="Render the project to a file, faster than realtime")
+render_parser.add_argument("--seconds", type=float, required=True)
+render_parser.add_argument("--out", required=True, help="File to write. .wav, or raw float32 for anything else")
+render_parser.add_argument("--backend", choices=("numpy", "numba"), default="numpy")
+render_parser.add_argument("--audio-profile", help="Profile of aim.json to take the sample rate from")
+render_parser.add_argument("--frame-count", type=int, help="Frames per block. Default is large, for speed")
+render_parser.add_argument(
+	"--workers",
+	type=int,
+	default=1,
+	help="Processes to run the parts of the project that are not connected in. 0 for one per core",
+)
+bench_parser = sub_parser.add_parser("bench", help="Time every node of the numpy backend and write a JSON report")
+bench_parser.add_argument("--out", default="bench.json", help="File to write the report to")
+bench_parser.add_argument("--compare", help="Report of an earlier run, to list the nodes that got slower")
+bench_parser.add_argument("--threshold", type=float, default=0.3, help="Increase of time, as a fraction, that is a regression")
+bench_parser.add_argument("--nodes", nargs="+", help="Only benchmark these nodes")
+bench_parser.add_argument("--voices", nargs="+", type=int, default=[1, 8, 64])
+bench_parser.add_argument("--frame-counts", nargs="+", type=int, default=[64, 512, 8192])
+sub_parser.add_parser("clear-cache", help="Delete the compile cache of the project")
 
 opts = parser.parse_args()
 
@@ -19,9 +68,17 @@ if not opts.path:
 
 assert os.path.isdir(opts.path), f"Path {opts.path} is not a folder"
 
+if opts.command == "run" and getattr(opts, "backend", "numpy") != "numpy":
+	if getattr(opts, "profile", None):
+		run_parser.error("--profile needs the numpy backend")
+	if getattr(opts, "debug", False):
+		run_parser.error("--debug needs the numpy backend")
+
 
 if opts.command == "run":
 	import sys
+	record = getattr(opts, "record", None) and os.path.abspath(opts.record)
+
 	if not sys.stdin.isatty():
 		# We are getting data as a pipe. Make a temporary project
 		import tempfile
@@ -34,26 +91,81 @@ if opts.command == "run":
 	os.chdir(opts.path)
 	assert os.path.isfile("main.py"), f"main.py not found in directory {opts.path}"
 
-	from aim.nodes import load
+	from aim.project import load_profile
 	from aim.run import CompileAndRun
 
-	with open("main.py") as f:
-		# We default with having a UI for our disposal.
+	# We default with having a UI for our disposal.
 
-		# Create a thread for compiling and running (as a child process) the created program.
-		compile_and_run = CompileAndRun(load(f.read()))
+	# Create a thread for compiling and running (as a child process) the created program.
+	# main.py is watched for changes and recompiled incrementally.
+	compile_and_run = CompileAndRun(
+		"main.py",
+		use_cache=not getattr(opts, "no_cache", False),
+		backend=getattr(opts, "backend", "numpy"),
+		profile=load_profile(getattr(opts, "audio_profile", None)),
+		profile_nodes=getattr(opts, "profile", None),
+		debug=getattr(opts, "debug", False),
+		record=record,
+	)
 
-		try:
-			compile_and_run.mainloop_mainthread()
-		except KeyboardInterrupt:
-			pass
+	try:
+		compile_and_run.mainloop_mainthread()
+	except KeyboardInterrupt:
+		pass
 
-		compile_and_run.stop()
+	compile_and_run.stop()
 
 elif opts.command == "init":
 	from aim.init_folder import init_folder
 	init_folder(".")
 
+elif opts.command == "render":
+	out = os.path.abspath(opts.out)
+	os.chdir(opts.path)
+	assert os.path.isfile("main.py"), f"main.py not found in directory {opts.path}"
+
+	from aim.project import load_profile
+	from aim.render import render, RENDER_FRAME_COUNT
+
+	with open("main.py") as f:
+		text = f.read()
+
+	result = render(
+		text,
+		opts.seconds,
+		out,
+		load_profile(opts.audio_profile),
+		backend=opts.backend,
+		frame_count=opts.frame_count or RENDER_FRAME_COUNT,
+		workers=opts.workers or os.cpu_count(),
+	)
+
+	print(
+		f"Rendered {result.seconds:.2f}s to {opts.out} in {result.render_time:.2f}s "
+		f"(compiled in {result.compile_time:.2f}s), {result.realtime_factor:.1f}x realtime"
+	)
+
+elif opts.command == "bench":
+	from aim.node_bench import main
+
+	regressions = main(
+		opts.out,
+		previous=opts.compare,
+		nodes=opts.nodes,
+		voice_counts=tuple(opts.voices),
+		frame_counts=tuple(opts.frame_counts),
+		threshold=opts.threshold,
+	)
+
+	if regressions:
+		import sys
+		sys.exit(1)
+
+elif opts.command == "clear-cache":
+	from aim.cache import clear
+	os.chdir(opts.path)
+	clear()
+
 # aim
 # Automatically runs the project in the current folder using the numpy backend
 
@@ -0,0 +1,282 @@
+"""
+Buffer of mixed audio between the thread that runs the program and the sound card callback
+
+The program is run in a thread of its own, which writes whole blocks of frame_count frames into
+the buffer, as long as there is room. The callback of the sound card only copies out as many
+frames as the sound card asks for, which does not need to be frame_count. So a slow block or a
+pause of the garbage collector is taken up by the blocks already in the buffer, instead of
+becoming an underrun, and the sound card can use any block size.
+
+There is one writer and one reader. The write and read positions are frame counters that only
+increase, each only changed by its own side, after the frames it stands for. No locks are
+taken, so the callback never waits for the program.
+"""
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from aim.output import Mixer
+
+
+class AudioBuffer:
+	def __init__(self, frame_count: int, blocks: int, channel_count: int):
+		"""
+		Room for blocks blocks of frame_count frames
+		"""
+		assert frame_count > 0 and blocks > 0 and channel_count > 0
+
+		self.frame_count = frame_count
+		self.capacity = frame_count * blocks
+		self.frames = np.zeros((self.capacity, channel_count), dtype='float32')
+
+		self.written = 0  # Frames, changed by the writer
+		self.read = 0  # Frames, changed by the reader
+
+		# Changed by the reader
+		self.underflows = 0  # Reads that got fewer frames than asked for
+		self.lowest_fill = self.capacity  # Lowest fill before a read, since reset_lowest_fill()
+
+	@property
+	def fill(self) -> int:
+		"""
+		Frames written but not read yet
+		"""
+		return self.written - self.read
+
+	def writable(self) -> bool:
+		"""
+		If there is room for the next block
+		"""
+		return self.capacity - self.fill >= self.frame_count
+
+	def next_block(self) -> np.ndarray:
+		"""
+		Where the next block is to be written. It is given to the reader by commit()
+
+		The capacity is a multiple of frame_count, so a block is never split at the end.
+		"""
+		assert self.writable()
+		offset = self.written % self.capacity
+		return self.frames[offset:offset + self.frame_count]
+
+	def commit(self) -> None:
+		self.written += self.frame_count
+
+	def read_into(self, outdata: np.ndarray) -> int:
+		"""
+		Fill outdata with the next frames, and with silence if there are not enough
+
+		Returns the number of frames that were in the buffer.
+		"""
+		fill = self.fill
+		if fill < self.lowest_fill:
+			self.lowest_fill = fill
+
+		count = min(len(outdata), fill)
+		offset = self.read % self.capacity
+		first = min(count, self.capacity - offset)
+
+		outdata[:first] = self.frames[offset:offset + first]
+		outdata[first:count] = self.frames[:count - first]
+
+		if count < len(outdata):
+			outdata[count:] = 0
+			self.underflows += 1
+
+		self.read += count
+
+		return count
+
+	def reset_lowest_fill(self) -> int:
+		"""
+		Lowest fill since the last call. Called by whoever reports it, not the reader
+
+		A read at the same time may be missed.
+		"""
+		lowest, self.lowest_fill = self.lowest_fill, self.fill
+		return lowest
+
+
+def produce(engine, buffer: AudioBuffer, sample_rate: int, stop: threading.Event, recorder=None) -> None:
+	"""
+	Run the programs of the engine into buffer, until stop is set
+
+	When the buffer is full, we check again after a quarter of a block. Every block is also given
+	to the aim.recorder.Recorder, if any.
+
+	A program that raises is reported on stderr, and silence is played until the engine swaps in
+	another program.
+	"""
+	mixer = Mixer(buffer.frame_count, buffer.frames.shape[1])
+	wait = buffer.frame_count / sample_rate / 4
+	failed = None  # Generation of the program that raised
+
+	while not stop.is_set():
+		if not buffer.writable():
+			time.sleep(wait)
+			continue
+
+		block = buffer.next_block()
+		engine.swap(buffer.frame_count)
+
+		if engine.generation == failed:
+			block.fill(0)
+		else:
+			try:
+				mixer.mix(engine.program, engine.process(buffer.frame_count), block)
+			except Exception:
+				failed = engine.generation
+				print(f"Program {failed} failed, playing silence until main.py is changed:", file=sys.stderr)
+				traceback.print_exc(file=sys.stderr)
+				block.fill(0)
+
+		buffer.commit()
+
+		if recorder is not None:
+			recorder.submit(block)
+
+
+def test_audio_buffer() -> None:
+	buffer = AudioBuffer(4, 3, 2)
+	block = np.arange(8, dtype='float32').reshape(4, 2)
+
+	written = 0
+	while buffer.writable():
+		buffer.next_block()[:] = block + written
+		buffer.commit()
+		written += 1
+
+	assert written == 3 and buffer.fill == 12
+
+	# The sound card asks for other sizes than the block size
+	outdata = np.ones((5, 2), dtype='float32')
+	assert buffer.read_into(outdata) == 5
+	assert np.array_equal(outdata, np.concatenate([block, block[:1] + 1]))
+	assert buffer.writable() and not buffer.underflows
+
+	# Wraps around the end
+	buffer.next_block()[:] = block + 3
+	buffer.commit()
+	outdata = np.ones((10, 2), dtype='float32')
+	assert buffer.read_into(outdata) == 10
+	assert np.array_equal(outdata, np.concatenate([block[1:] + 1, block + 2, block[:3] + 3]))
+
+	# Not enough, the rest is silence
+	outdata = np.ones((3, 2), dtype='float32')
+	assert buffer.read_into(outdata) == 1
+	assert np.array_equal(outdata[0], block[3] + 3) and not outdata[1:].any()
+	assert buffer.underflows == 1 and buffer.fill == 0
+
+	assert buffer.reset_lowest_fill() == 1  # Before the last read
+	assert buffer.lowest_fill == 0
+
+
+def test_produce() -> None:
+	import os
+	import tempfile
+	from aim.engine import Engine
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+	from aim.output import CHANNEL_COUNT
+	from aim.recorder import Recorder
+
+	context = load("out(sine(100))")
+	graph, node_ids = build_node_graph(context)
+	order = execution_order(graph)
+
+	engine = Engine()
+	engine.load(IncrementalCompiler(10, 1000).compile(CompilationContext(context, graph, node_ids, order)), 1)
+
+	folder = tempfile.TemporaryDirectory()
+	recorder = Recorder(folder.name + os.path.sep + "out.raw", 10, CHANNEL_COUNT, 1000)
+
+	buffer = AudioBuffer(10, 4, CHANNEL_COUNT)
+	stop = threading.Event()
+	producer = threading.Thread(target=produce, args=(engine, buffer, 1000, stop, recorder))
+	producer.start()
+
+	try:
+		# The sound card reads in blocks of another size than the program
+		outdata = np.empty((7, CHANNEL_COUNT), dtype='float32')
+		result = []
+		while len(result) < 100:
+			if buffer.fill >= len(outdata):
+				buffer.read_into(outdata)
+				result.extend(outdata[:, 0])
+			else:
+				time.sleep(0.001)
+	finally:
+		stop.set()
+		producer.join()
+		recorder.close()
+
+	assert not buffer.underflows
+	t = np.arange(1, 101) / 1000
+	assert np.allclose(result[:100], np.sin(t * 100 * 2 * np.pi) * .1, atol=1e-4)
+
+	# Everything that was made is recorded, also what has not been played yet
+	recorded = np.fromfile(recorder.path, dtype='<f4').reshape(-1, CHANNEL_COUNT)
+	assert len(recorded) == buffer.written and not recorder.dropped
+	assert np.array_equal(recorded[:100, 0], result[:100])
+	folder.cleanup()
+
+
+def test_produce_failing_program() -> None:
+	import contextlib
+	import io
+	from aim.engine import Engine
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+
+	context = load("out(sine(100))")
+	graph, node_ids = build_node_graph(context)
+	playing = IncrementalCompiler(10, 1000).compile(CompilationContext(context, graph, node_ids, execution_order(graph)))
+	failing = "frame_count = 10\nsample_rate = 1000\nvoice_identifier = 0\ndef numpy_process():\n\treturn 1 / 0"
+
+	engine = Engine()
+	engine.load(playing, 1)
+
+	buffer = AudioBuffer(10, 2, 2)
+	stop = threading.Event()
+	stderr = io.StringIO()
+	producer = threading.Thread(target=produce, args=(engine, buffer, 1000, stop))
+
+	def played_after(generation: int) -> np.ndarray:
+		# Frames of the next block made by the program of generation
+		outdata = np.empty((20, 2), dtype='float32')
+		while engine.generation != generation:
+			buffer.read_into(outdata)
+			time.sleep(0.001)
+
+		buffer.read_into(outdata)  # Made before the swap
+		while buffer.fill < 10:
+			time.sleep(0.001)
+
+		buffer.read_into(outdata[:10])
+		return outdata[:10, 0].copy()
+
+	with contextlib.redirect_stderr(stderr), contextlib.redirect_stdout(io.StringIO()):
+		producer.start()
+		try:
+			assert played_after(1).any()
+
+			engine.load(failing, 2, 1, [])
+			assert not played_after(2).any()
+			assert producer.is_alive()
+
+			engine.load(playing, 3, 2, [])
+			assert played_after(3).any()
+		finally:
+			stop.set()
+			producer.join()
+
+	assert stderr.getvalue().count("ZeroDivisionError") == 1, stderr.getvalue()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
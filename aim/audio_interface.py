@@ -1,51 +1,91 @@
-import sounddevice as sd
+"""
+Plays the output of the engine on the sound card
+
+The programs are run in a thread of their own, into an AudioBuffer that is a number of blocks
+deep (see audio_buffer.py). The callback of the sound card only copies from it, so the sound card
+may use another block size than the program.
+
+With "aim run --record", the blocks are also written to a file, see recorder.py.
+"""
+import sys
 import threading
+from typing import Optional
+
+import sounddevice as sd
+
+from aim.audio_buffer import AudioBuffer, produce
+from aim.output import CHANNEL_COUNT
+from aim.recorder import Recorder
+
+BUFFER_BLOCKS = 2  # Default depth of the buffer, see Profile.buffer_blocks
+
 
-CHANNEL_COUNT = 2
+def play(
+	engine,
+	buffer_blocks: int = BUFFER_BLOCKS,
+	channel_count: int = CHANNEL_COUNT,
+	record: Optional[str] = None,
+) -> None:
+	"""
+	Play the programs of the engine on channel_count channels of the sound card, until it stops
 
-event = threading.Event()
+	The stream stays open when programs are swapped. It is only reopened if a new program has
+	another frame_count or sample_rate.
 
-def callback(outdata, frames, time, status):
-	# Is this check bad? Could frames vary?
-	assert frames == frame_count
+	If record is given, what is played is also written to that file.
+	"""
+	engine.loaded.wait()
+	recorder: Optional[Recorder] = None
 
-	if status.output_underflow:
-		outdata[:,0] = _SILENCE
-		outdata[:,1] = _SILENCE
-		return
-		#raise sd.CallbackAbort
+	while engine.running:
+		engine.reopen.clear()
 
-	assert not status, status
+		frame_count = engine.frame_count
+		sample_rate = engine.sample_rate
+		buffer = AudioBuffer(frame_count, buffer_blocks, channel_count)
+		engine.telemetry.buffer = buffer
+		finished = threading.Event()
+		stop = threading.Event()
 
-	# TODO merayen handle midi outputs too... Send to hardware devices?
-	output = numpy_process().values()
+		if recorder is not None and (recorder.frame_count, recorder.sample_rate) != (frame_count, sample_rate):
+			print(f"Stopped recording to {record}, as the program changed frame_count or sample_rate", file=sys.stderr)
+			recorder.close()
+			recorder = engine.telemetry.recorder = None
+		elif record and recorder is None:
+			recorder = engine.telemetry.recorder = Recorder(record, frame_count, channel_count, sample_rate)
+			record = None  # Only once
 
-	output_channels = {0: np.zeros(frame_count, dtype='float32'), 1: np.zeros(frame_count, dtype='float32')}
+		producer = threading.Thread(target=produce, args=(engine, buffer, sample_rate, stop, recorder))
+		producer.start()
 
-	if not any(1 for out in output for voice_id in out.voices):
-		assert np.all(_SILENCE == 0.0)
+		def callback(outdata, frames, time, status):
+			if status.output_underflow:
+				engine.telemetry.xruns += 1
+			else:
+				assert not status, status
 
-		outdata[:,0] = _SILENCE
-		outdata[:,1] = _SILENCE
-		return
+			buffer.read_into(outdata)
 
-	for out in output:
-		if isinstance(out, Signal):
-			for voice_id, voice in out.voices.items():
+		# Start with a full buffer
+		while buffer.writable() and producer.is_alive():
+			stop.wait(0.001)
 
-				# TODO merayen read channel_map instead of using voice_id directly as channel_index
-				output_channels[voice_id % CHANNEL_COUNT] += voice * .1
+		with sd.OutputStream(
+			samplerate=sample_rate,
+			blocksize=0,  # Whatever suits the sound card
+			channels=channel_count,
+			dtype='float32',
+			callback=callback,
+			finished_callback=finished.set,
+		) as stream:
+			while not finished.is_set() and not engine.reopen.is_set() and producer.is_alive():
+				finished.wait(0.1)
 
-	outdata[:,0] = output_channels[0]
-	outdata[:,1] = output_channels[1]
+		stop.set()
+		producer.join()
 
+		if not engine.reopen.is_set():
+			break  # Playback stopped by itself, e.g the sound card went away
 
-with sd.OutputStream(
-	samplerate=sample_rate,
-	blocksize=frame_count,
-	channels=CHANNEL_COUNT,
-	dtype='float32',
-	callback=callback,
-	finished_callback=event.set,
-) as stream:
-	event.wait()  # Wait until playback is finished
+	if recorder is not None:
+		recorder.close()
@@ -0,0 +1,547 @@
+"""
+Benchmarks for aim
+
+Run with "python -m aim.benchmark". Numbers are printed, nothing is asserted.
+
+These compare whole projects and ways of compiling them. The time of each node, between versions
+of aim, is measured by node_bench.py ("aim bench").
+"""
+import random
+import time
+
+from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+
+
+def synthetic_script(node_count: int, seed: int = 0) -> str:
+	"""
+	Create a main.py with node_count nodes
+
+	Every node depends on the node before it and on one random earlier node, so all nodes are
+	reachable from the single out-node and the graph has both long chains and fan-out.
+	"""
+	rng = random.Random(seed)
+
+	lines = ["_n0 = sine(440)"]
+	for i in range(1, node_count - 1):
+		lines.append(f"_n{i} = add(_n{i - 1}, _n{rng.randrange(i)})")
+
+	lines.append(f"out(_n{node_count - 2})")
+
+	return "\n".join(lines)
+
+
+def nested_script(node_count: int, depth: int = 100) -> str:
+	"""
+	Expressions of depth nested add(), like test_operator_execution_order
+
+	Python does not parse expressions nested much deeper than 200.
+	"""
+	expression = "out(" + "".join(f"add({i}, " for i in range(depth)) + "sine(440)" + ")" * depth + ")"
+	return "\n".join([expression] * max(node_count // (depth + 2), 1))
+
+
+def chain_script(length: int) -> str:
+	"""
+	Operators chained through variables, every node depending on the one before it
+	"""
+	return "\n".join(["_n0 = sine(440)", *(f"_n{i} = _n{i - 1} * 0.5 + {i}" for i in range(1, length // 2)), f"out(_n{length // 2 - 1})"])
+
+
+def fan_out_script(width: int) -> str:
+	"""
+	One oscillator read by width nodes, summed back together by a tree of add()
+	"""
+	lines = ["_s = sine(440)", *(f"_w{i} = _s * {i}" for i in range(width))]
+	names = [f"_w{i}" for i in range(width)]
+
+	while len(names) > 1:
+		pairs = []
+		for i in range(0, len(names) - 1, 2):
+			pairs.append(f"{names[i]}_")
+			lines.append(f"{pairs[-1]} = add({names[i]}, {names[i + 1]})")
+
+		names = pairs + names[len(names) - len(names) % 2:]
+
+	return "\n".join(lines + [f"out({names[0]})"])
+
+
+def outs_script(count: int) -> str:
+	"""
+	count out-nodes, each with its own oscillator
+	"""
+	return "\n".join(f"out(sine({i + 1}))" for i in range(count))
+
+
+def benchmark_compile_stages(sizes: tuple[int, ...] = (1000, 10000, 50000)) -> None:
+	"""
+	Time and peak memory of every stage of compiling, on scripts of different shapes
+
+	Memory is measured with tracemalloc on a second run, as tracing slows Python down. load()
+	includes _validate_python(), which is also shown by itself. A stage that fails, like Python not
+	parsing very deep expressions, stops that script.
+	"""
+	import tracemalloc
+	from aim.nodes import _validate_python
+	from aim.numpy_backend import compile_to_numpy
+
+	def measure(function, *args):
+		start = time.perf_counter()
+		result = function(*args)
+		seconds = time.perf_counter() - start
+
+		tracemalloc.start()
+		function(*args)
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+		return result, seconds, peak
+
+	shapes = {
+		"nested": nested_script,
+		"chain": chain_script,
+		"fan-out": fan_out_script,
+		"outs": outs_script,
+		"random": synthetic_script,
+	}
+
+	print(f"{'script':<8} {'nodes':>6} {'stage':<18} {'time':>9} {'peak':>9}")
+
+	for name, function in shapes.items():
+		for size in sizes:
+			text = function(size)
+			stages = [
+				("_validate_python", lambda: _validate_python(text)),
+				("load", lambda: load(text)),
+				("build_node_graph", lambda: build_node_graph(context)),
+				("execution_order", lambda: execution_order(*graph_and_ids)),
+				("compile_to_numpy", lambda: compile_to_numpy(CompilationContext(context, *graph_and_ids, order), 512)),
+			]
+
+			for stage, call in stages:
+				try:
+					result, seconds, peak = measure(call)
+				except Exception as e:
+					print(f"{name:<8} {size:>6} {stage:<18} failed: {e.__class__.__name__}: {str(e)[:40]}")
+					break
+
+				if stage == "load":
+					context = result
+				elif stage == "build_node_graph":
+					graph_and_ids = result
+				elif stage == "execution_order":
+					order = result
+
+				node_count = len(graph_and_ids[0]) if stage != "_validate_python" and stage != "load" else size
+				print(f"{name:<8} {node_count:>6} {stage:<18} {seconds:>8.3f}s {peak/2**20:>7.1f}MB")
+
+
+def benchmark_execution_order(sizes: tuple[int, ...] = (1000, 10000, 100000)) -> None:
+	print(f"{'nodes':>8} {'load':>9} {'graph':>9} {'order':>9}")
+
+	for size in sizes:
+		text = synthetic_script(size)
+
+		start = time.perf_counter()
+		context = load(text)
+		load_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		graph, node_ids = build_node_graph(context)
+		graph_time = time.perf_counter() - start
+
+		assert len(graph) == size, (len(graph), size)
+
+		start = time.perf_counter()
+		execution_order(graph, node_ids)
+		order_time = time.perf_counter() - start
+
+		print(f"{size:>8} {load_time:>8.3f}s {graph_time:>8.3f}s {order_time:>8.3f}s")
+
+
+def benchmark_load(sizes: tuple[int, ...] = (10000, 50000)) -> None:
+	"""
+	Time of creating the nodes of main.py, without validating it
+	"""
+	from aim.nodes import Node, OutNode, _PARSE_CONTEXT, Context
+
+	print(f"{'nodes':>8} {'load':>9} {'per node':>10}")
+
+	namespace = {x.__name__: x for x in Node.__subclasses__() + OutNode.__subclasses__()}
+
+	for size in sizes:
+		code = compile(synthetic_script(size), "main.py", "exec")
+		token = _PARSE_CONTEXT.set(Context())
+
+		start = time.perf_counter()
+		exec(code, dict(namespace))
+		load_time = time.perf_counter() - start
+
+		_PARSE_CONTEXT.reset(token)
+
+		print(f"{size:>8} {load_time:>8.3f}s {load_time/size*1e6:>8.1f}us")
+
+
+def benchmark_validation(megabytes: tuple[int, ...] = (1, 4)) -> None:
+	"""
+	Validating and loading large main.py files, like generated scores
+	"""
+	from aim.nodes import _validate_python
+
+	print(f"{'size':>8} {'nodes':>8} {'validate':>9} {'load':>9}")
+
+	for size in megabytes:
+		node_count = 1000
+		while len(text := synthetic_script(node_count)) < size * 2**20:
+			node_count *= 2
+
+		start = time.perf_counter()
+		_validate_python(text)
+		validate_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		load(text)
+		load_time = time.perf_counter() - start
+
+		print(f"{len(text)/2**20:>6.1f}MB {node_count:>8} {validate_time:>8.3f}s {load_time:>8.3f}s")
+
+
+def compile_program(
+	text: str,
+	optimized: bool = True,
+	frame_count: int = 512,
+	sample_rate: int = 48000,
+	backend: str = "numpy",
+) -> dict:
+	"""
+	Compile main.py text and return the namespace of the program, ready to call numpy_process()
+	"""
+	from aim.optimizer import optimize
+	from aim.run import COMPILERS
+
+	context = load(text)
+	graph, node_ids = build_node_graph(context)
+
+	if optimized:
+		graph, node_ids, _ = optimize(context, graph, node_ids)
+
+	order = execution_order(graph, node_ids)
+	code = COMPILERS[backend](frame_count, sample_rate).compile(CompilationContext(context, graph, node_ids, order))
+
+	program: dict = {}
+	exec(code, program)
+
+	return program
+
+
+def time_blocks(program: dict, blocks: int = 200) -> float:
+	"""
+	Seconds per block of numpy_process(), after warming up
+	"""
+	import contextlib
+	import io
+
+	# What the nodes print goes to stdout
+	with contextlib.redirect_stdout(io.StringIO()):
+		for _ in range(10):
+			program["numpy_process"]()
+
+		start = time.perf_counter()
+		for _ in range(blocks):
+			program["numpy_process"]()
+
+	return (time.perf_counter() - start) / blocks
+
+
+# Projects that repeat the same oscillators and math chains, as scripts often do
+OPTIMIZER_PROJECTS = {
+	"three sine(220)": "out(sine(220) * 0.3 + sine(220) * 0.3 + sine(220) * 0.3)",
+	"repeated chain": "\n".join(
+		f"out(mix(sine(sine(2) * 5 + 220), saw(110) * 0.5, 0.2) + add(0.1, {i}))"
+		for i in range(4)
+	),
+	"polyphonic duplicate": (
+		"_v = unison(220, 8)\n"
+		"out(sine(_v) * sine(5) + sine(_v) * sine(5))"
+	),
+}
+
+
+def benchmark_optimizer(frame_count: int = 512) -> None:
+	print(f"{'project':<22} {'plain':>10} {'optimized':>10} {'change':>7}")
+
+	for name, text in OPTIMIZER_PROJECTS.items():
+		plain = time_blocks(compile_program(text, optimized=False, frame_count=frame_count))
+		optimized = time_blocks(compile_program(text, optimized=True, frame_count=frame_count))
+		print(f"{name:<22} {plain*1e6:>8.1f}us {optimized*1e6:>8.1f}us {(optimized/plain - 1)*100:>6.1f}%")
+
+
+# Projects only using nodes that the numba backend supports
+NUMBA_PROJECTS = {
+	"sine": "out(sine(440))",
+	"fm": "out(sine(sine(sine(3) * 50 + 220) * 200 + 440) * 0.5)",
+	"mix and clip": "out(clip(mix(sine(220), saw(110), 0.3) * 2 + square(55, duty=sine(1)) * 0.2, -0.8, 0.8))",
+	"trigger": "out(trigger(sine(2), 0.5, -0.5) * saw(time() * 10 + 100))",
+}
+
+
+def benchmark_numba(frame_counts: tuple[int, ...] = (32, 64, 128, 512), sample_rate: int = 48000) -> None:
+	"""
+	Realtime factor of the numpy and the numba backend: seconds of audio produced per second
+	"""
+	print(f"{'project':<14} {'frames':>6} {'numpy':>9} {'numba':>9}")
+
+	for name, text in NUMBA_PROJECTS.items():
+		for frame_count in frame_counts:
+			realtime_factors = []
+			for backend in ("numpy", "numba"):
+				program = compile_program(text, frame_count=frame_count, sample_rate=sample_rate, backend=backend)
+				realtime_factors.append(frame_count / sample_rate / time_blocks(program, blocks=2000))
+
+			print(f"{name:<14} {frame_count:>6} {realtime_factors[0]:>8.1f}x {realtime_factors[1]:>8.1f}x")
+
+
+def benchmark_blocks(frame_counts: tuple[int, ...] = (64, 512, 8192)) -> None:
+	"""
+	Time per block of the numpy backend, and the memory it allocates while processing a block
+	"""
+	import contextlib
+	import io
+	import tracemalloc
+
+	projects = dict(NUMBA_PROJECTS, unison="out(sine(unison(220, 8)) * sine(3) + saw(unison(110, 8)) * 0.2)")
+
+	print(f"{'project':<14} {'frames':>6} {'time':>10} {'allocated':>10}")
+
+	for name, text in projects.items():
+		for frame_count in frame_counts:
+			program = compile_program(text, frame_count=frame_count)
+			seconds = time_blocks(program)
+
+			with contextlib.redirect_stdout(io.StringIO()):
+				tracemalloc.start()
+				program["numpy_process"]()
+				allocated = tracemalloc.get_traced_memory()[1]
+				tracemalloc.stop()
+
+			print(f"{name:<14} {frame_count:>6} {seconds*1e6:>8.1f}us {allocated:>9}B")
+
+
+def benchmark_voices(voice_counts: tuple[int, ...] = (1, 8, 32, 128), frame_count: int = 512) -> None:
+	"""
+	Time per block and per voice, for a patch where every node has the voices of unison
+	"""
+	print(f"{'voices':>6} {'block':>10} {'voice':>10}")
+
+	for voices in voice_counts:
+		text = (
+			f"_v = unison(220, {voices})\n"
+			"_a = sine(_v * sine(3) + _v)\n"
+			"out(downmix(clip(mix(_a, saw(_v), 0.3) * dB(-6), -0.5, 0.5) + trigger(_a, 0.5, -0.5) * 0.1))"
+		)
+		seconds = time_blocks(compile_program(text, frame_count=frame_count))
+		print(f"{voices:>6} {seconds*1e6:>8.1f}us {seconds/voices*1e6:>8.2f}us")
+
+
+def benchmark_fusion(frame_count: int = 512) -> None:
+	"""
+	Chains of elementwise math, calculated node by node and fused into one expression
+	"""
+	from aim.nodes import load
+	from aim.numpy_backend import IncrementalCompiler
+
+	print(f"{'chain':>6} {'voices':>6} {'nodes':>10} {'fused':>10} {'change':>7}")
+
+	for length in (2, 4, 8):
+		for voices in (1, 8):
+			source = "sine(220)" if voices == 1 else f"sine(unison(220, {voices}))"
+			text = f"_a = {source}\n_b = sine(3)\nout(" + " + ".join(["_a * 0.5 - _b"] * (length // 2)) + ")"
+
+			times = []
+			for fuse in (False, True):
+				context = load(text)
+				graph, node_ids = build_node_graph(context)
+				order = execution_order(graph, node_ids)
+				program: dict = {}
+				exec(IncrementalCompiler(frame_count, fuse=fuse).compile(CompilationContext(context, graph, node_ids, order)), program)
+				times.append(time_blocks(program))
+
+			print(f"{length * 3 // 2 - 1:>6} {voices:>6} {times[0]*1e6:>8.1f}us {times[1]*1e6:>8.1f}us {(times[1]/times[0] - 1)*100:>6.1f}%")
+
+
+def benchmark_incremental(sizes: tuple[int, ...] = (1000, 10000)) -> None:
+	"""
+	Compile time of a full compile against recompiling after editing a single node near the output
+	"""
+	from aim.numpy_backend import IncrementalCompiler
+
+	def compile_with(compiler: IncrementalCompiler, text: str) -> float:
+		context = load(text)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph, node_ids)
+
+		start = time.perf_counter()
+		compiler.compile(CompilationContext(context, graph, node_ids, order))
+		return time.perf_counter() - start
+
+	print(f"{'nodes':>8} {'full':>9} {'edit':>9} {'regenerated':>12}")
+
+	for size in sizes:
+		text = synthetic_script(size)
+		compiler = IncrementalCompiler()
+
+		full_time = compile_with(compiler, text)
+		edit_time = compile_with(compiler, text.replace("\nout(", " * 0.5\nout("))
+
+		print(f"{size:>8} {full_time:>8.3f}s {edit_time:>8.3f}s {compiler.generated:>12}")
+
+
+def benchmark_reload(sizes: tuple[int, ...] = (1000, 10000)) -> None:
+	"""
+	Time of every stage of the path from saving main.py to the engine having the new program, for
+	a full build and after editing a single node near the output
+
+	Like CompileAndRun.reload() followed by the engine loading the program, except that the engine
+	runs in this process. "compile" is Python compiling the chunks that changed, when storing the
+	program in the compile cache.
+	"""
+	import tempfile
+	from aim.cache import CompileCache
+	from aim.engine import Engine
+	from aim.numpy_backend import IncrementalCompiler
+	from aim.optimizer import optimize
+
+	stages = ("load", "graph", "optimize", "order", "codegen", "compile", "engine")
+	print(f"{'nodes':>8} {'build':<6} " + " ".join(f"{x:>9}" for x in stages) + f" {'total':>9}")
+
+	for size in sizes:
+		text = synthetic_script(size)
+		compiler = IncrementalCompiler(512)
+		engine = Engine()
+		chunks: dict = {}  # Of the program the engine has, see aim.engine.run_commands()
+
+		with tempfile.TemporaryDirectory() as path:
+			cache = CompileCache(compiler.frame_count, compiler.sample_rate, path=path)
+
+			for generation, (build, source) in enumerate((("full", text), ("edit", text.replace("\nout(", " * 0.5\nout("))), 1):
+				times = [time.perf_counter()]
+
+				context = load(source)
+				times.append(time.perf_counter())
+
+				graph, node_ids = build_node_graph(context)
+				times.append(time.perf_counter())
+
+				graph, node_ids, _ = optimize(context, graph, node_ids)
+				times.append(time.perf_counter())
+
+				order = execution_order(graph, node_ids)
+				times.append(time.perf_counter())
+
+				code = compiler.compile(CompilationContext(context, graph, node_ids, order))
+				times.append(time.perf_counter())
+
+				program = cache.store(source, code, node_ids, {}, compiler.chunks)
+				times.append(time.perf_counter())
+
+				engine.load(program.load_bytecode(chunks), generation, generation - 1 or None, compiler.preserved)
+				times.append(time.perf_counter())
+
+				print(
+					f"{size:>8} {build:<6} " + " ".join(f"{y - x:>8.3f}s" for x, y in zip(times, times[1:])) +
+					f" {times[-1] - times[0]:>8.3f}s"
+				)
+
+
+def benchmark_workers(worker_counts: tuple[int, ...] = (1, 2, 4), frame_count: int = 512, blocks: int = 2000) -> None:
+	"""
+	Time per block of a project of independent oscillators, run as one program and split over
+	workers, see parallel.py. With small blocks, this is mostly the overhead of the workers
+	"""
+	import contextlib
+	import io
+	import numpy as np
+	from aim.output import Mixer
+	from aim.parallel import ParallelProgram
+	from aim.render import compile_parts
+
+	text = outs_script(8)
+	outdata = np.zeros((frame_count, 2), dtype='float32')
+
+	print(f"{'workers':>8} {'block':>10}")
+
+	for workers in worker_counts:
+		codes = compile_parts(text, frame_count, 48000, workers=workers)
+
+		with contextlib.ExitStack() as stack:
+			stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+
+			if workers == 1:
+				program: dict = {}
+				exec(codes[0], program)
+				mixer = Mixer(frame_count, 2)
+				process = lambda outdata: mixer.mix(program, program["numpy_process"](), outdata)
+			else:
+				process = stack.enter_context(ParallelProgram(codes, frame_count, 2)).process
+
+			start = time.perf_counter()
+			for _ in range(blocks):
+				process(outdata)
+			elapsed = time.perf_counter() - start
+
+		print(f"{workers:>8} {elapsed / blocks * 1e6:>8.1f}us")
+
+
+def benchmark_profiles(blocks: int = 2000) -> None:
+	"""
+	Realtime headroom of the audio profiles: the duration of a block divided by the time it takes to
+	process it, for the mean and the 99th percentile block. Below 1, the sound card underruns
+	"""
+	import contextlib
+	import io
+	import os
+	from aim.project import PROFILES
+
+	folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.path.sep + "example_projects"
+	projects = {}
+	for name in sorted(os.listdir(folder)):
+		with open(folder + os.path.sep + name + os.path.sep + "main.py") as f:
+			projects[name] = f.read()
+
+	projects["unison"] = "out(sine(unison(220, 8)) * sine(3) + saw(unison(110, 8)) * 0.2)"
+
+	print(f"{'profile':<12} {'project':<12} {'latency':>8} {'mean':>8} {'p99':>8}")
+
+	for profile in PROFILES.values():
+		for name, text in projects.items():
+			program = compile_program(text, frame_count=profile.frame_count, sample_rate=profile.sample_rate)
+			times = []
+
+			with contextlib.redirect_stdout(io.StringIO()):
+				for _ in range(10):
+					program["numpy_process"]()
+
+				for _ in range(blocks):
+					start = time.perf_counter()
+					program["numpy_process"]()
+					times.append(time.perf_counter() - start)
+
+			print(
+				f"{profile.name:<12} {name:<12} {profile.latency*1000:>6.1f}ms "
+				f"{profile.latency / (sum(times) / blocks):>7.1f}x {profile.latency / sorted(times)[blocks * 99 // 100]:>7.1f}x"
+			)
+
+
+if __name__ == '__main__':
+	benchmark_execution_order()
+	benchmark_load()
+	benchmark_validation()
+	benchmark_optimizer()
+	benchmark_incremental()
+	benchmark_reload()
+	benchmark_fusion()
+	benchmark_blocks()
+	benchmark_voices()
+	benchmark_workers()
+	benchmark_numba()
+	benchmark_profiles()
+	benchmark_compile_stages()
@@ -0,0 +1,328 @@
+"""
+Content-addressed cache of compiled programs
+
+Stored in .local/cache of the project. A program is found by hashing main.py, frame_count,
+sample_rate, the backend and the version of aim. As the files that main.py refers to (scores, audio files) are
+only known after parsing, the first lookup gives the list of those files, and their contents are
+hashed too to find the program itself:
+
+	.local/cache/<hash of main.py etc>.json  Files referred to by main.py
+	.local/cache/<hash of all>.py            Generated code
+	.local/cache/<hash of all>.bytecode      Chunks of the generated code, and the line each starts at
+	.local/cache/<hash of all>.json          Listeners of the nodes
+	.local/cache/chunks/<hash>.bytecode      A chunk, compiled by Python
+	.local/cache/statistics.json             Hits and misses
+
+The compiler gives the code in chunks, see numpy_backend.IncrementalCompiler. They are compiled by
+Python one by one and stored by their content, so a recompile only compiles the chunks that
+changed, and aim.engine only reads those.
+
+Delete the folder, run "aim clear-cache" or "aim run --no-cache" to not use what has been cached.
+"""
+import hashlib
+import json
+import marshal
+import os
+import shutil
+from dataclasses import dataclass
+from types import CodeType
+from typing import Optional
+
+from aim.nodes import Node, Outlet
+
+PATH = ".local/cache"  # Of the project
+CHUNKS = "chunks"  # Folder of the compiled chunks, in the cache
+
+
+@dataclass
+class CachedProgram:
+	path: str  # Generated code, for reading and tracebacks
+	bytecode_path: str
+	listeners: dict[str, str]  # Node variable -> node class name
+
+	def load_bytecode(self, chunks: Optional[dict[str, CodeType]] = None) -> list[CodeType]:
+		"""
+		Chunks of the program, compiled by Python, to be run one after the other
+
+		chunks has the chunks loaded before, by their hash, which are not read again. It is changed
+		to have the chunks of this program only.
+		"""
+		chunks = {} if chunks is None else chunks
+
+		with open(self.bytecode_path, "rb") as f:
+			manifest: list[tuple[str, int]] = marshal.load(f)
+
+		folder = os.path.dirname(self.bytecode_path) + os.path.sep + CHUNKS
+
+		result = []
+		for key, line in manifest:
+			if (code := chunks.get(key)) is None:
+				with open(folder + os.path.sep + key + ".bytecode", "rb") as f:
+					code = chunks[key] = marshal.load(f)
+
+			result.append(_relocated(code, self.path, line))
+
+		for key in chunks.keys() - {key for key, _ in manifest}:
+			del chunks[key]
+
+		return result
+
+
+class CompileCache:
+	def __init__(self, frame_count: int, sample_rate: int, backend: str = "numpy", path: str = PATH):
+		self.frame_count = frame_count
+		self.sample_rate = sample_rate
+		self.backend = backend
+		self.path = path
+
+		self._chunks: dict[str, str] = {}  # Hashes of the chunks stored by the last store(), by their code
+
+	def lookup(self, text: str) -> Optional[CachedProgram]:
+		"""
+		Return the cached program for main.py, if any. Counts as a hit or a miss
+		"""
+		program = self._lookup(text)
+		self._count("hits" if program else "misses")
+		return program
+
+	def _lookup(self, text: str) -> Optional[CachedProgram]:
+		try:
+			with open(self._file(self._text_key(text), ".json")) as f:
+				files = json.load(f)["files"]
+
+			key = self._program_key(text, files)
+
+			with open(self._file(key, ".json")) as f:
+				listeners = json.load(f)["listeners"]
+		except (OSError, ValueError, KeyError):
+			return None
+
+		program = CachedProgram(self._file(key, ".py"), self._file(key, ".bytecode"), listeners)
+
+		if not os.path.isfile(program.path) or not os.path.isfile(program.bytecode_path):
+			return None
+
+		return program
+
+	def store(
+		self,
+		text: str,
+		code: str,
+		node_ids: dict[int, Node],
+		listeners: dict[str, str],
+		chunks: Optional[list[str]] = None,
+	) -> CachedProgram:
+		"""
+		Store the program compiled from main.py text. chunks is the code in pieces, that joined by
+		newlines is code. Only the chunks that are not stored already are compiled
+		"""
+		os.makedirs(self.path + os.path.sep + CHUNKS, exist_ok=True)
+
+		files = referenced_files(node_ids)
+		key = self._program_key(text, files)
+		program = CachedProgram(self._file(key, ".py"), self._file(key, ".bytecode"), listeners)
+
+		with open(program.path, "w") as f:
+			f.write(code)
+
+		manifest = []
+		stored = {}
+		line = 1
+		for chunk in chunks or [code]:
+			if (chunk_key := self._chunks.get(chunk)) is None:
+				chunk_key = _hash([chunk])
+				path = self._file(CHUNKS + os.path.sep + chunk_key, ".bytecode")
+
+				if not os.path.isfile(path):
+					with open(path, "wb") as f:
+						marshal.dump(compile(chunk, "<chunk>", "exec"), f)
+
+			stored[chunk] = chunk_key
+			manifest.append((chunk_key, line))
+			line += chunk.count("\n") + 1
+
+		self._chunks = stored
+
+		with open(program.bytecode_path, "wb") as f:
+			marshal.dump(manifest, f)
+
+		with open(self._file(key, ".json"), "w") as f:
+			json.dump({"listeners": listeners}, f)
+
+		# Written last, as it is what makes the lookup find the rest
+		with open(self._file(self._text_key(text), ".json"), "w") as f:
+			json.dump({"files": files}, f)
+
+		return program
+
+	def statistics(self) -> dict[str, int]:
+		try:
+			with open(self._file("statistics", ".json")) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return {"hits": 0, "misses": 0}
+
+	def _count(self, name: str) -> None:
+		statistics = self.statistics()
+		statistics[name] += 1
+
+		os.makedirs(self.path, exist_ok=True)
+		with open(self._file("statistics", ".json"), "w") as f:
+			json.dump(statistics, f)
+
+	def _file(self, key: str, extension: str) -> str:
+		return self.path + os.path.sep + key + extension
+
+	def _text_key(self, text: str) -> str:
+		return _hash([text, str(self.frame_count), str(self.sample_rate), self.backend, aim_version()])
+
+	def _program_key(self, text: str, files: list[str]) -> str:
+		return _hash([self._text_key(text)] + [f"{path}:{_hash_file(path)}" for path in files])
+
+
+def clear(path: str = PATH) -> None:
+	"""
+	Delete the cache in the folder path, for all frame counts, sample rates and backends
+	"""
+	if os.path.isdir(path):
+		shutil.rmtree(path)
+
+
+def _relocated(code: CodeType, filename: str, line: int) -> CodeType:
+	"""
+	The code of a chunk, as if compiled from the file it is part of, starting at line
+	"""
+	return code.replace(
+		co_filename=filename,
+		co_firstlineno=code.co_firstlineno + line - 1,
+		co_consts=tuple(_relocated(x, filename, line) if isinstance(x, CodeType) else x for x in code.co_consts),
+	)
+
+
+def referenced_files(node_ids: dict[int, Node]) -> list[str]:
+	"""
+	Files that the nodes read when compiling, like scores and audio files
+	"""
+	return sorted(
+		{
+			value
+			for node in node_ids.values()
+			for value in node._inlets.values()
+			if isinstance(value, str) and not isinstance(value, Outlet) and os.path.isfile(value)
+		}
+	)
+
+
+def aim_version() -> str:
+	"""
+	Hash of the source code of aim itself
+
+	There are no releases of aim, so any change of the compiler must give another version.
+	"""
+	if aim_version.value is None:
+		folder = os.path.dirname(os.path.abspath(__file__))
+		aim_version.value = _hash(
+			[_hash_file(folder + os.path.sep + x) for x in sorted(os.listdir(folder)) if x.endswith(".py")]
+		)
+
+	return aim_version.value
+aim_version.value = None
+
+
+def _hash(parts: list[str]) -> str:
+	return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+def _hash_file(path: str) -> str:
+	result = hashlib.sha256()
+
+	with open(path, "rb") as f:
+		while data := f.read(2**20):
+			result.update(data)
+
+	return result.hexdigest()
+
+
+def test_compile_cache() -> None:
+	import tempfile
+	from aim.nodes import load, build_node_graph
+
+	with tempfile.TemporaryDirectory() as path:
+		cache = CompileCache(frame_count=64, sample_rate=48000, path=path + os.path.sep + "cache")
+		score_path = path + os.path.sep + "score.txt"
+
+		with open(score_path, "w") as f:
+			f.write("0 1 c4\n")
+
+		text = f"out(sine(frequency(polyphonic(score({score_path!r})))))"
+		assert cache.lookup(text) is None
+
+		context = load(text)
+		graph, node_ids = build_node_graph(context)
+		assert referenced_files(node_ids) == [score_path]
+
+		stored = cache.store(text, "result = 1 + 1", node_ids, {"_1": "oscilloscope"})
+
+		program = cache.lookup(text)
+		assert program == stored
+
+		result = {}
+		for code in program.load_bytecode():
+			exec(code, result)
+		assert result["result"] == 2
+
+		# Anything else compiled differently
+		assert CompileCache(frame_count=128, sample_rate=48000, path=cache.path).lookup(text) is None
+		assert CompileCache(frame_count=64, sample_rate=48000, backend="numba", path=cache.path).lookup(text) is None
+		assert cache.lookup(text + "\n") is None
+
+		with open(score_path, "w") as f:
+			f.write("0 1 d4\n")
+
+		assert cache.lookup(text) is None
+		assert cache.statistics() == {"hits": 1, "misses": 5}
+
+		clear(cache.path)
+		assert cache.statistics() == {"hits": 0, "misses": 0}
+
+
+def test_chunks() -> None:
+	import tempfile
+	import traceback
+
+	with tempfile.TemporaryDirectory() as path:
+		cache = CompileCache(frame_count=64, sample_rate=48000, path=path)
+		chunks = ["a = 1", "def f():\n\traise ValueError(a)", "b = a + 1"]
+		program = cache.store("out(sine(1))", "\n".join(chunks), {}, {}, chunks)
+
+		loaded = {}
+		result = {}
+		for code in program.load_bytecode(loaded):
+			exec(code, result)
+		assert result["b"] == 2
+		assert len(loaded) == 3
+
+		# Tracebacks show the line in the file of the program
+		try:
+			result["f"]()
+		except ValueError as e:
+			frame = traceback.extract_tb(e.__traceback__)[-1]
+			assert (frame.filename, frame.lineno, frame.line) == (program.path, 3, "raise ValueError(a)")
+
+		# Only the chunk that changed is compiled and loaded
+		chunks[0] = "a = 2"
+		program = cache.store("out(sine(2))", "\n".join(chunks), {}, {}, chunks)
+		assert len(os.listdir(path + os.path.sep + CHUNKS)) == 4
+
+		previous = dict(loaded)
+		result = {}
+		for code in program.load_bytecode(loaded):
+			exec(code, result)
+		assert result["b"] == 3
+		assert len(loaded) == 3 and loaded.keys() - previous.keys() == {_hash(["a = 2"])}
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,442 @@
+"""
+Long-lived worker that runs the compiled programs
+
+Started once by CompileAndRun as "python -m aim.engine". It keeps the audio device open and reads
+new programs to run as JSON lines on stdin:
+
+	{"program": ".local/cache/<hash>.py", "generation": 2, "previous": 1, "preserved": ["_12", ...]}
+
+If "bytecode" is given, the program is read already compiled, in chunks, from the compile cache
+instead. The chunks that the previous program had too are not read again (see cache.py).
+
+A new program is initialized next to the running one and swapped in between two audio callbacks.
+Variables of nodes that the compiler reused (oscillator clocks, playback positions, voice maps
+etc.) are carried over from the running program, so that a reload does not cause an audible gap.
+
+Node data from the programs is written on stdout, like before, except samples, which go in the
+shared memory named by AIM_DATA (see transport.py). Nothing is written for every block: the
+number of blocks, buffer underruns and the time spent are counted, and sent every
+TELEMETRY_INTERVAL as
+
+	{"telemetry": {"blocks": 187, "xruns": 0, "load": 0.12, "slowest": 0.0009, "underflows": 0, "fill": 1.5, "dropped": 0}}
+
+stdout is only flushed then, which also sends what the nodes printed since. Our own messages go
+to stderr.
+"""
+import json
+import sys
+import threading
+import time
+import traceback
+from types import CodeType
+from typing import Optional, Union
+
+TELEMETRY_INTERVAL = 0.25  # Seconds between reports to the parent process
+
+
+class Telemetry:
+	"""
+	Counters of the audio threads, reported to the parent process at a fixed rate
+
+	Each counter is only changed by one thread, the one running the programs or the callback of
+	the sound card, so they are read by the reporting thread without locking. A report may miss a
+	block that finishes while it is made, which then goes in the next.
+	"""
+	def __init__(self):
+		self.blocks = 0
+		self.xruns = 0  # Buffer underruns of the audio device
+		self.seconds = 0.0  # Spent processing
+		self.audio_seconds = 0.0  # Of audio processed
+		self.slowest = 0.0  # Longest block since the last report
+		self.buffer = None  # aim.audio_buffer.AudioBuffer being played from
+		self.recorder = None  # aim.recorder.Recorder, when recording
+
+		self._reported = (0, 0, 0.0, 0.0, 0, 0)
+
+	def add(self, seconds: float, audio_seconds: float) -> None:
+		self.blocks += 1
+		self.seconds += seconds
+		self.audio_seconds += audio_seconds
+
+		if seconds > self.slowest:
+			self.slowest = seconds
+
+	def report(self) -> dict:
+		"""
+		Counters since the previous report
+
+		load is the time spent processing divided by the time of the audio, 1 being as slow as we
+		can be without underruns. underflows are reads of the sound card that the buffer did not
+		have enough audio for, and fill is the lowest the buffer has been, in blocks. dropped are
+		blocks that were not recorded, as the disk was behind.
+		"""
+		buffer = self.buffer
+		recorder = self.recorder
+		counters = (
+			self.blocks,
+			self.xruns,
+			self.seconds,
+			self.audio_seconds,
+			buffer.underflows if buffer else 0,
+			recorder.dropped if recorder else 0,
+		)
+		slowest, self.slowest = self.slowest, 0.0
+		blocks, xruns, seconds, audio_seconds, underflows, dropped = (x - y for x, y in zip(counters, self._reported))
+		self._reported = counters
+
+		return {
+			"blocks": blocks,
+			"xruns": xruns,
+			"load": seconds / audio_seconds if audio_seconds else 0.0,
+			"slowest": slowest,
+			"underflows": underflows,
+			"fill": buffer.reset_lowest_fill() / buffer.frame_count if buffer else None,
+			"dropped": dropped,
+		}
+
+
+class Engine:
+	def __init__(self, data=None):
+		"""
+		data is the aim.transport.RingBuffer that the programs send samples to, if any
+		"""
+		self.data = data
+		self.program: Optional[dict] = None  # Namespace of the running program
+		self.generation: Optional[int] = None
+
+		self.telemetry = Telemetry()
+
+		self.running = True
+		self.loaded = threading.Event()  # Set when the first program has been loaded
+		self.reopen = threading.Event()  # Set when the audio stream needs to be opened again
+
+		# (program, preserved variables, generation), waiting to be swapped in
+		self._pending: Optional[tuple[dict, list[str], int]] = None
+		self._lock = threading.Lock()
+
+	@property
+	def frame_count(self) -> int:
+		return self._next_program()["frame_count"]
+
+	@property
+	def sample_rate(self) -> int:
+		return self._next_program()["sample_rate"]
+
+	def _next_program(self) -> dict:
+		pending = self._pending
+		return pending[0] if pending else self.program
+
+	def load(
+		self,
+		code: Union[str, CodeType, list[CodeType]],
+		generation: int,
+		previous: Optional[int] = None,
+		preserved: list[str] = (),
+		filename: str = "<program>",
+	) -> None:
+		"""
+		Initialize a new program and queue it for being swapped in
+
+		code is the program, or its chunks compiled by Python, see aim.cache. The preserved variables are only carried over if the program was compiled against the
+		program we have, given by the previous generation. Otherwise it starts from scratch.
+		"""
+		compiled = compile(code, filename, "exec") if isinstance(code, str) else code
+
+		with self._lock:
+			pending = self._pending
+			old, old_generation = (pending[0], pending[2]) if pending else (self.program, self.generation)
+
+		if old is not None and previous is not None and previous == old_generation:
+			preserved = list(preserved)
+			program = {"_preserved": set(preserved)}
+			program.update((name, old[name]) for name in preserved if name in old)
+		else:
+			preserved = []
+			program = {}
+
+		program["_data"] = self.data
+		for chunk in compiled if isinstance(compiled, list) else [compiled]:
+			exec(chunk, program)
+
+		with self._lock:
+			self._pending = (program, preserved, generation)
+
+			if self.program is not None and (
+				(program["frame_count"], program["sample_rate"]) !=
+				(self.program["frame_count"], self.program["sample_rate"])
+			):
+				self.reopen.set()  # Audio interface needs to reopen the stream before we can swap
+
+		self.loaded.set()
+
+	def process(self, frame_count: int) -> dict:
+		"""
+		Process one block. Called by the audio interface
+		"""
+		self.swap(frame_count)
+
+		start = time.perf_counter()
+		output = self.program["numpy_process"]()
+		self.telemetry.add(time.perf_counter() - start, frame_count / self.program["sample_rate"])
+
+		return output
+
+	def swap(self, frame_count: int) -> None:
+		"""
+		Swap in the program waiting to be, if any
+		"""
+		if self._pending is not None and self._lock.acquire(blocking=False):
+			# If load() holds the lock, we just try again on the next block
+			try:
+				self._swap(frame_count)
+			finally:
+				self._lock.release()
+
+	def _swap(self, frame_count: int) -> None:
+		program, preserved, generation = self._pending
+
+		if program["frame_count"] != frame_count:
+			return  # Waiting for the stream to be reopened
+
+		if self.program is not None:
+			# Take the latest values, as the old program has run since the new one was initialized
+			for name in preserved:
+				if name in self.program:
+					program[name] = self.program[name]
+
+			# Init code of the new program may have created voices meanwhile
+			program["voice_identifier"] = max(program["voice_identifier"], self.program["voice_identifier"])
+
+		self.program = program
+		self.generation = generation
+		self._pending = None
+
+	def stop(self) -> None:
+		self.running = False
+		self.loaded.set()
+		self.reopen.set()
+
+
+def main() -> None:
+	import argparse
+	import os
+	from aim import audio_interface
+	from aim.transport import RingBuffer, ENVIRONMENT_VARIABLE
+
+	parser = argparse.ArgumentParser(description="Run the programs given on stdin")
+	parser.add_argument("--buffer-blocks", type=int, default=audio_interface.BUFFER_BLOCKS)
+	parser.add_argument("--channels", type=int, default=audio_interface.CHANNEL_COUNT)
+	parser.add_argument("--record", help="File to write what is played to")
+	opts = parser.parse_args()
+
+	data = RingBuffer.attach(os.environ[ENVIRONMENT_VARIABLE]) if os.environ.get(ENVIRONMENT_VARIABLE) else None
+	engine = Engine(data)
+
+	player = threading.Thread(target=audio_interface.play, args=(engine, opts.buffer_blocks, opts.channels, opts.record))
+	player.start()
+
+	threading.Thread(target=report_telemetry, args=(engine,), daemon=True).start()
+
+	try:
+		run_commands(engine)
+	except KeyboardInterrupt:
+		pass  # Stop playing, and finish the recording
+
+	engine.stop()
+	player.join()
+
+
+def run_commands(engine: Engine) -> None:
+	"""
+	Load the programs given on stdin, until it is closed
+	"""
+	from aim.cache import CachedProgram
+
+	chunks: dict[str, CodeType] = {}  # Of the last program loaded from the compile cache
+
+	for line in sys.stdin:
+		if not line.strip():
+			continue
+
+		command = json.loads(line)
+
+		try:
+			if command.get("bytecode"):
+				code = CachedProgram(command["program"], command["bytecode"], {}).load_bytecode(chunks)
+			else:
+				with open(command["program"]) as f:
+					code = f.read()
+
+			engine.load(
+				code,
+				command["generation"],
+				command.get("previous"),
+				command.get("preserved", []),
+				filename=command["program"],
+			)
+		except Exception:
+			# Keep running the program we have
+			traceback.print_exc(file=sys.stderr)
+
+
+def report_telemetry(engine: Engine, interval: float = TELEMETRY_INTERVAL) -> None:
+	"""
+	Send the telemetry of the engine on stdout, every interval seconds, until it stops
+	"""
+	while engine.running:
+		time.sleep(interval)
+		print(json.dumps({"telemetry": engine.telemetry.report()}))
+		sys.stdout.flush()  # Along with what the nodes printed since the last time
+
+
+def test_hot_swap() -> None:
+	import contextlib
+	import io
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+
+	def compile_with(compiler: IncrementalCompiler, code: str) -> str:
+		context = load(code)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph)
+		return compiler.compile(CompilationContext(context, graph, node_ids, order))
+
+	def run(engine: Engine, blocks: int) -> list:
+		with contextlib.redirect_stdout(io.StringIO()):
+			return [
+				{name: {k: v.copy() for k, v in signal.voices.items()} for name, signal in engine.process(10).items()}
+				for _ in range(blocks)
+			]
+
+	compiler = IncrementalCompiler(frame_count=10, sample_rate=1000)
+	engine = Engine()
+	engine.load(compile_with(compiler, "out(sine(110)); out(sine(unison(30, 2)) * 0.5)"), 1, None, compiler.preserved)
+	result = run(engine, 3)
+
+	engine.load(compile_with(compiler, "out(sine(110)); out(sine(unison(30, 2)) * 0.25)"), 2, 1, compiler.preserved)
+	assert compiler.reused == 4
+
+	# Not swapped in until the next block is processed
+	assert engine.generation == 1
+	result += run(engine, 3)
+	assert engine.generation == 2
+
+	# The unchanged oscillator continues where it was
+	reference = Engine()
+	reference.load(compile_with(IncrementalCompiler(10, 1000), "out(sine(110))"), 1)
+	expected = run(reference, 6)
+
+	for block, expected_block in zip(result, expected):
+		assert np.allclose(block["unnamed_0"][0], expected_block["unnamed_0"][0])
+
+	# As do the voices created by unison
+	assert set(result[-1]["unnamed_1"]) == {1, 2}
+
+	# A program compiled against another program starts from scratch
+	engine.load(compile_with(compiler, "out(sine(110))"), 4, 3, compiler.preserved)
+	result = run(engine, 1)
+	assert np.allclose(result[0]["unnamed_0"][0], expected[0]["unnamed_0"][0])
+
+
+def test_run_commands() -> None:
+	import contextlib
+	import io
+	import os
+	import tempfile
+	from aim.cache import CompileCache, CHUNKS
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+
+	compiler = IncrementalCompiler(frame_count=10, sample_rate=1000)
+	engine = Engine()
+
+	with tempfile.TemporaryDirectory() as path:
+		cache = CompileCache(10, 1000, path=path)
+		folder = path + os.path.sep + CHUNKS
+
+		def command(text: str, generation: int) -> str:
+			context = load(text)
+			graph, node_ids = build_node_graph(context)
+			code = compiler.compile(CompilationContext(context, graph, node_ids, execution_order(graph)))
+			program = cache.store(text, code, node_ids, {}, compiler.chunks)
+
+			return json.dumps(
+				{
+					"program": program.path,
+					"bytecode": program.bytecode_path,
+					"generation": generation,
+					"previous": generation - 1 or None,
+					"preserved": compiler.preserved,
+				}
+			)
+
+		def commands():
+			yield command("out(sine(110)); out(sine(unison(30, 2)) * 0.5)", 1)
+
+			# The engine has the chunks of the first program, so they are not read again
+			for name in os.listdir(folder):
+				os.remove(folder + os.path.sep + name)
+
+			yield command("out(sine(110)); out(sine(unison(30, 2)) * 0.25)", 2)
+			assert 0 < len(os.listdir(folder)) < len(compiler.chunks)
+
+		stdin = sys.stdin
+		sys.stdin = commands()
+		try:
+			run_commands(engine)
+		finally:
+			sys.stdin = stdin
+
+		with contextlib.redirect_stdout(io.StringIO()):
+			output = engine.process(10)
+
+		assert engine.generation == 2 and compiler.reused == 4
+		assert set(output["unnamed_1"].voices) == {1, 2}
+
+
+def test_telemetry() -> None:
+	import contextlib
+	import io
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+
+	context = load("out(sine(110)); print(sine(1))")
+	graph, node_ids = build_node_graph(context)
+	order = execution_order(graph)
+	code = IncrementalCompiler(10, 1000).compile(CompilationContext(context, graph, node_ids, order))
+
+	engine = Engine()
+	engine.load(code, 1)
+
+	# Nothing is written per block, and print nodes are left out without --debug
+	stdout = io.StringIO()
+	with contextlib.redirect_stdout(stdout):
+		for _ in range(20):
+			engine.process(10)
+
+	assert stdout.getvalue() == ""
+
+	engine.telemetry.xruns += 1
+	report = engine.telemetry.report()
+	assert report["blocks"] == 20 and report["xruns"] == 1
+	assert 0 < report["load"] and 0 < report["slowest"] < 0.2
+	assert report["underflows"] == 0 and report["fill"] is None  # Not playing
+
+	idle = {"blocks": 0, "xruns": 0, "load": 0.0, "slowest": 0.0, "underflows": 0, "fill": None, "dropped": 0}
+	assert engine.telemetry.report() == idle
+
+	# Stops with the engine
+	stdout = io.StringIO()
+	thread = threading.Thread(target=report_telemetry, args=(engine, 0.001))
+	with contextlib.redirect_stdout(stdout):
+		thread.start()
+		time.sleep(0.05)
+		engine.stop()
+		thread.join()
+
+	assert json.loads(stdout.getvalue().splitlines()[0]) == {"telemetry": idle}
+
+
+if __name__ == '__main__':
+	main()
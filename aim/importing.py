@@ -38,7 +38,7 @@ def get_ffprobe_file_information(path: str) -> list[dict[str, str]]:
 	return dict(x.split("=", 1) for x in stdout.decode("utf-8").splitlines() if "=" in x)
 
 
-def read_file_data(path: str) -> tuple[str, list[str]]:
+def read_file_data(path: str, sample_rate: int) -> tuple[str, list[str]]:
 	"""
 	Read audio from a file and store it into local .data folder for easy access
 
@@ -48,8 +48,9 @@ def read_file_data(path: str) -> tuple[str, list[str]]:
 		# Temporary data folder that is user local. Can be deleted to save space.
 		os.mkdir(".data")
 
-	# Make a hash of the path for simplicity
-	file_basename = hashlib.md5(path.encode("utf")).hexdigest().lower()
+	# Make a hash of the path for simplicity. Every sample rate gets its own files, so that
+	# switching audio profile does not play the files of another one
+	file_basename = hashlib.md5(path.encode("utf")).hexdigest().lower() + f"_{sample_rate}"
 
 	# Return any existing files with this hash
 	return (
@@ -71,10 +72,9 @@ def read_audio_data(path: str, sample_rate: int) -> list[str]:
 	If file has already been cached, we don't attempt to reload it.
 
 	User needs to either delete ".data" folder or run "aim reload" to retrieve any
-	new changes in the source files. Especially important when changing sample rate
-	of the project.
+	new changes in the source files. Files are cached per sample rate.
 	"""
-	hashsum, existing_files = read_file_data(path)
+	hashsum, existing_files = read_file_data(path, sample_rate)
 	if existing_files:
 		# There exists already cached files for this path. Just use that one without any more
 		# verification. User also needs to purge the .data directory to have aim to re-read.
@@ -124,4 +124,4 @@ def read_audio_data(path: str, sample_rate: int) -> list[str]:
 
 	assert not process.returncode, f"ffmpeg returned code {process.returncode}:\n{stderr.decode('utf-8')}"
 
-	return read_file_data(path)[1]
+	return read_file_data(path, sample_rate)[1]
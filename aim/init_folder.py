@@ -23,13 +23,16 @@ def init_folder(path: str) -> bool:
 	with open(".gitignore", "w") as f:
 		f.write(".local/")
 
+	from aim.project import init_config, CONFIG_FILE
+	init_config(path)
+
 	import subprocess
 	git_already_inited = ".git" not in os.listdir()
 
 	if not git_already_inited:
 		subprocess.run(["git", "init", "-q"])
 
-	subprocess.run(["git", "add", ".data", ".gitignore", "main.py"])
+	subprocess.run(["git", "add", ".data", ".gitignore", "main.py", CONFIG_FILE])
 
 	if not git_already_inited:
 		subprocess.run(["git", "commit", "-qm", "Aim project created"])
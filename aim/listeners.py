@@ -8,13 +8,13 @@ that for now.
 """
 import time
 from typing import Optional
+import numpy as np
 import pylab as pl
-from aim.nodes import Node
 
 
 class Listener:
-	def __init__(self, node: Node):
-		self.node = node
+	def __init__(self, node_id: str):
+		self.node_id = node_id  # Variable of the node in the program
 		self.setup()
 
 	def setup(self):
@@ -44,7 +44,7 @@ class oscilloscope_listener(Listener):
 
 		pl.show(block=False)
 
-	def receive(self, voice_id: Optional[int], samples: Optional[list[float]]):
+	def receive(self, voice_id: Optional[int], samples: Optional[np.ndarray]):
 		if not pl.fignum_exists(self.fig.number):
 			self.lines = None
 			return  # User has closed the window
@@ -0,0 +1,369 @@
+"""
+Benchmark suite of the nodes of the numpy backend
+
+Run with "aim bench". Every node is compiled in the configurations it is used in (constant or
+signal inputs, SIGNAL or MIDI, with 1, 8 and 64 voices) and numpy_process() is timed in steady
+state at several frame counts. The time of the node is the time of the program minus the time of
+the same program without the node, so what feeds it is not counted.
+
+The results are written as JSON, to compare against a report of another version:
+
+	aim bench --out new.json --compare old.json
+
+Unlike benchmark.py, which compares whole projects and approaches to compiling them, this is meant
+to be run as is between versions of aim, to find the nodes that got slower.
+"""
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+import numpy as np
+
+from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+from aim.numpy_backend import IncrementalCompiler
+
+WARMUP_BLOCKS = 5  # Processed before timing
+
+# Programs that feed the node in each configuration. They define _in, the input of the node.
+# {voices}, {score} and {audio} are filled in when running
+SETUPS = {
+	"constant": "",
+	"signal": "_in = sine(unison(220, {voices}))",
+	"midi": "_in = polyphonic(score({score!r}), max_voices=128)",
+	"score": "_in = score({score!r})",
+}
+
+
+@dataclass(frozen=True)
+class Case:
+	node: str
+	config: str  # Name of the configuration in the report
+	setup: str  # In SETUPS
+	code: str  # Uses the node, given _in from the setup
+	max_blocks: Optional[int] = None  # For nodes that stop by themselves, like audiofile at the end of the file
+
+	@property
+	def voiced(self) -> bool:
+		"""
+		If the case is run with several voice counts
+		"""
+		return any(x in SETUPS[self.setup] + self.code for x in ("{voices", "{score"))
+
+
+CASES = [
+	Case("sine", "constant", "constant", "out(sine(220))"),
+	Case("sine", "signal", "signal", "out(sine(_in))"),
+	Case("square", "constant", "constant", "out(square(220))"),
+	Case("square", "signal", "signal", "out(square(_in))"),
+	Case("square", "signal duty", "signal", "out(square(220, duty=_in))"),
+	Case("saw", "constant", "constant", "out(saw(220))"),
+	Case("saw", "signal", "signal", "out(saw(_in))"),
+	Case("noise", "constant", "constant", "out(noise())"),
+	Case("noise", "signal", "signal", "out(noise(_in))"),
+	Case("random", "signal", "signal", "out(random(_in))"),
+	*(Case(name, "signal", "signal", f"out({name}(_in, _in))") for name in ("add", "sub", "mul", "div", "gt", "lt")),
+	*(Case(name, "signal and constant", "signal", f"out({name}(_in, 0.5))") for name in ("add", "sub", "mul", "div", "gt", "lt")),
+	Case("mix", "signal", "signal", "out(mix(_in, _in, 0.3))"),
+	Case("mix", "signal fac", "signal", "out(mix(_in, _in, fac=_in))"),
+	Case("downmix", "signal", "signal", "out(downmix(_in))"),
+	Case("trigger", "signal", "signal", "out(trigger(_in, 0.5, -0.5))"),
+	Case("trigger", "signal on", "signal", "out(trigger(_in, on=_in, off=-0.5))"),
+	Case("clip", "signal", "signal", "out(clip(_in, -0.5, 0.5))"),
+	Case("dB", "constant", "constant", "out(dB(-6))"),
+	Case("dB", "signal", "signal", "out(dB(_in))"),
+	Case("time", "constant", "constant", "out(time())"),
+	Case("time", "signal", "signal", "out(time(voice_trigger=_in))"),
+	Case("one", "signal", "signal", "out(one(_in))"),
+	Case("one", "midi", "midi", "out(one(_in))"),
+	Case("frequency", "constant", "constant", "out(frequency(440))"),
+	Case("frequency", "midi", "midi", "out(frequency(_in))"),
+	Case("unison", "constant", "constant", "out(unison(220, {voices}))"),
+	Case("unison", "signal", "signal", "out(unison(_in, 2))"),
+	Case("unison", "midi", "midi", "out(unison(_in, 2))"),
+	Case("spawn", "signal", "signal", "out(spawn(_in))"),
+	Case("hold", "signal", "signal", "out(hold(_in))"),
+	Case("hold", "signal condition", "signal", "out(hold(_in, condition=_in))"),
+	Case("hold", "midi", "midi", "out(hold(_in))"),
+	Case("score", "midi", "constant", "out(score({score!r}))"),
+	Case("polyphonic", "midi", "score", "out(polyphonic(_in, max_voices=128))"),
+	# put is only read through get, so they are timed together. The get case has a second get
+	Case("put", "signal", "signal", "put('a', _in)\nout(get('a'))"),
+	Case("get", "signal", "signal", "put('a', _in)\nout(get('a'))\nout(get('a'))"),
+	Case("audiofile", "constant", "constant", "out(audiofile({audio!r}))", max_blocks=100),
+	Case("print", "signal", "signal", "print(_in)"),
+	Case("print", "midi", "midi", "print(_in)"),
+	Case("oscilloscope", "signal", "signal", "oscilloscope(_in)"),
+]
+
+
+@dataclass
+class Result:
+	node: str
+	config: str
+	voices: int
+	frame_count: int
+	block_seconds: float  # Median time of numpy_process()
+	baseline_seconds: float  # Same, without the node
+	node_seconds: float
+
+	@property
+	def key(self) -> tuple:
+		return (self.node, self.config, self.voices, self.frame_count)
+
+
+def score_file(folder: str, voices: int) -> str:
+	"""
+	Score that holds voices keys down for as long as the benchmark runs
+	"""
+	path = folder + os.path.sep + f"score_{voices}.txt"
+
+	with open(path, "w") as f:
+		for i in range(voices):
+			f.write(f"0 1000 {'abcdefg'[i % 7]}{i // 7}\n")
+
+	return path
+
+
+def audio_file(folder: str, frame_count: int, sample_rate: int = 48000) -> str:
+	"""
+	Stereo WAV file of frame_count frames to play back
+	"""
+	from aim.wav import WavWriter
+
+	path = folder + os.path.sep + f"audio_{frame_count}.wav"
+
+	t = np.arange(frame_count) / sample_rate
+	with WavWriter(path, 2, sample_rate) as writer:
+		writer.write(np.stack([np.sin(t * 440 * 2 * np.pi), np.sin(t * 220 * 2 * np.pi)], axis=1).astype('float32'))
+
+	return path
+
+
+def compile_program(text: str, frame_count: int, sample_rate: int = 48000) -> dict:
+	"""
+	Compile text as it is, so the node is not fused with other math or changed by the optimizer
+
+	Debug output is compiled in, so that the print node is timed as with "aim run --debug".
+	"""
+	context = load(text, sample_rate)
+	graph, node_ids = build_node_graph(context)
+	order = execution_order(graph, node_ids)
+	code = IncrementalCompiler(frame_count, sample_rate, fuse=False, debug=True).compile(
+		CompilationContext(context, graph, node_ids, order)
+	)
+
+	program: dict = {}
+	exec(compile(code, "<bench>", "exec"), program)
+
+	return program
+
+
+def time_programs(
+	texts: list[str],
+	frame_count: int,
+	min_time: float = 0.05,
+	max_blocks: Optional[int] = None,
+) -> list[float]:
+	"""
+	Median seconds per block of numpy_process() of each program, after warming up
+
+	The programs take turns processing a block, so that the machine being busy or changing its
+	clock speed affects them the same. At most max_blocks blocks are timed, if given.
+	"""
+	processes = [compile_program(text, frame_count)["numpy_process"] for text in texts]
+	times = [[] for _ in texts]
+
+	# Programs report to the parent process on stdout, which nobody listens to here
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		for process in processes:
+			for _ in range(WARMUP_BLOCKS):
+				process()
+
+		end = time.perf_counter() + min_time
+		while (len(times[0]) < 20 or time.perf_counter() < end) and len(times[0]) != max_blocks:
+			for process, process_times in zip(processes, times):
+				start = time.perf_counter()
+				process()
+				process_times.append(time.perf_counter() - start)
+
+	return [statistics.median(x) for x in times]
+
+
+def run_benchmarks(
+	folder: str,
+	cases: list[Case] = CASES,
+	voice_counts: tuple[int, ...] = (1, 8, 64),
+	frame_counts: tuple[int, ...] = (64, 512, 8192),
+	min_time: float = 0.05,
+	progress: bool = False,
+) -> list[Result]:
+	"""
+	Time every case, writing the score and audio files it needs in folder
+
+	Run in folder, as audiofile converts the files into .data of the current folder.
+	"""
+	results = []
+	cwd = os.getcwd()
+	os.chdir(folder)
+
+	try:
+		for case in cases:
+			audio = None
+			if "{audio" in case.code:
+				# Plays for every block that is timed, with room for the baseline
+				audio = audio_file(folder, (WARMUP_BLOCKS + case.max_blocks + 1) * max(frame_counts))
+
+			for voices in voice_counts if case.voiced else voice_counts[:1]:
+				values = {"voices": voices, "score": score_file(folder, voices), "audio": audio}
+				setup = SETUPS[case.setup].format(**values)
+				text = setup + "\n" + case.code.format(**values)
+
+				for frame_count in frame_counts:
+					if setup:
+						seconds, baseline = time_programs([text, setup + "\nout(_in)"], frame_count, min_time, case.max_blocks)
+					else:
+						seconds, baseline = time_programs([text], frame_count, min_time, case.max_blocks)[0], 0.0
+
+					result = Result(case.node, case.config, voices, frame_count, seconds, baseline, max(seconds - baseline, 0.0))
+					results.append(result)
+
+					if progress:
+						print(format_result(result), file=sys.stderr)
+	finally:
+		os.chdir(cwd)
+
+	return results
+
+
+def format_result(result: Result) -> str:
+	return (
+		f"{result.node:<12} {result.config:<20} {result.voices:>3} voices {result.frame_count:>5} frames "
+		f"{result.node_seconds*1e6:>9.1f}us"
+	)
+
+
+def report(results: list[Result]) -> dict:
+	"""
+	Machine readable report of the results, with what they were measured on
+	"""
+	from aim.cache import aim_version
+
+	return {
+		"aim_version": aim_version(),
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"machine": platform.machine(),
+		"processor": platform.processor(),
+		"created": time.time(),
+		"results": [asdict(x) for x in results],
+	}
+
+
+def compare(old: dict, new: dict, threshold: float = 0.3, minimum: float = 5e-6) -> list[tuple[Result, Result]]:
+	"""
+	Results of the new report that are slower than in the old one
+
+	A node is slower when its time increased by more than threshold, as a fraction, and by more
+	than minimum seconds, as short times are mostly noise.
+	"""
+	old_results = {x.key: x for x in (Result(**y) for y in old["results"])}
+
+	regressions = []
+	for result in (Result(**x) for x in new["results"]):
+		if (previous := old_results.get(result.key)) is None:
+			continue
+
+		increase = result.node_seconds - previous.node_seconds
+		if increase > minimum and increase > previous.node_seconds * threshold:
+			regressions.append((previous, result))
+
+	return regressions
+
+
+def main(
+	out: str,
+	previous: Optional[str] = None,
+	nodes: Optional[list[str]] = None,
+	voice_counts: tuple[int, ...] = (1, 8, 64),
+	frame_counts: tuple[int, ...] = (64, 512, 8192),
+	threshold: float = 0.3,
+) -> int:
+	"""
+	Run the suite, write the report to out and compare it with the report at previous
+
+	Returns the number of regressions.
+	"""
+	import tempfile
+
+	cases = [x for x in CASES if not nodes or x.node in nodes]
+	assert cases, f"No benchmarks of the nodes {nodes}"
+
+	with tempfile.TemporaryDirectory() as folder:
+		results = run_benchmarks(folder, cases, voice_counts, frame_counts, progress=True)
+
+	new = report(results)
+
+	with open(out, "w") as f:
+		json.dump(new, f, indent="\t")
+
+	print(f"Wrote {len(results)} results to {out}")
+
+	if not previous:
+		return 0
+
+	with open(previous) as f:
+		regressions = compare(json.load(f), new, threshold)
+
+	for old_result, result in regressions:
+		print(
+			f"Slower: {result.node} {result.config}, {result.voices} voices, {result.frame_count} frames: "
+			f"{old_result.node_seconds*1e6:.1f}us -> {result.node_seconds*1e6:.1f}us"
+		)
+
+	print(f"{len(regressions)} regressions compared to {previous}")
+
+	return len(regressions)
+
+
+def test_bench() -> None:
+	import tempfile
+
+	cases = [x for x in CASES if x.node in ("sine", "frequency", "put", "print")]
+
+	with tempfile.TemporaryDirectory() as folder:
+		results = run_benchmarks(folder, cases, voice_counts=(1, 8), frame_counts=(64,), min_time=0)
+
+	assert [(x.node, x.config, x.voices) for x in results] == [
+		("sine", "constant", 1),
+		("sine", "signal", 1),
+		("sine", "signal", 8),
+		("frequency", "constant", 1),
+		("frequency", "midi", 1),
+		("frequency", "midi", 8),
+		("put", "signal", 1),
+		("put", "signal", 8),
+		("print", "signal", 1),
+		("print", "signal", 8),
+		("print", "midi", 1),
+		("print", "midi", 8),
+	]
+	assert all(x.block_seconds > 0 and x.node_seconds >= 0 for x in results)
+
+	old = json.loads(json.dumps(report(results)))
+	assert compare(old, old) == []
+
+	slower = json.loads(json.dumps(old))
+	slower["results"][1]["node_seconds"] = old["results"][1]["node_seconds"] * 2 + 1e-5
+	assert [(x.key, y.key) for x, y in compare(old, slower)] == [(results[1].key, results[1].key)]
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
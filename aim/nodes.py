@@ -1,5 +1,8 @@
 """Experimenting using Python itself for writing music"""
-from collections import OrderedDict
+import ast
+import gc
+import itertools
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field, Field
 from functools import cached_property
 from typing import Any, Optional
@@ -11,13 +14,31 @@ from aim import importing
 
 def node(cls: type):
 	assert issubclass(cls, Node)
-	return dataclass()(cls)
+	cls = dataclass()(cls)
+
+	# Layout of the inlets and outlets is the same for every instance, so it is found here once
+	cls._inlet_names = tuple(k for k in cls.__dataclass_fields__ if not k.startswith("_"))
+	cls._outlet_names = tuple(
+		sorted(
+			(
+				k for k in set(dir(cls)) - set(cls.__dataclass_fields__)
+				if isinstance(getattr(cls, k, None), Outlet)
+			),
+			key=lambda k: getattr(cls, k)._index,
+		)
+	)
+
+	return cls
 
 
 class RestrictedPythonError(Exception):
 	pass
 
 
+class CyclicGraphError(Exception):
+	pass
+
+
 class Entity:
 	@cached_property
 	def _variable(self) -> str:
@@ -29,6 +50,10 @@ class Node(Entity):
 	_inlets = None
 	_outlets = None
 
+	# Set by @node
+	_inlet_names: tuple[str, ...] = ()
+	_outlet_names: tuple[str, ...] = ()  # Sorted by the order they were declared
+
 	def __add__(self, other) -> "add":
 		return add(self, other)
 
@@ -49,39 +74,29 @@ class Node(Entity):
 
 	def _first_outlet(self) -> Optional["Outlet"]:
 		# Node is sent as input, get the first outlet
-		outlets = []
-		for a in dir(self):
-			if not a.startswith("_"):
-				b = getattr(self, a)
-				if isinstance(b, Outlet):
-					outlets.append(b)
+		for k in self._outlet_names:
+			if not k.startswith("_"):
+				return getattr(self, k)
 
-		if not outlets:
-			return None
-
-		return sorted(outlets, key=lambda a:a._index)[0]
+		return None
 
 	def __post_init__(self) -> None:
 		# Insert inlets and outlets into self._inlets and self._outlets
 		outlets = OrderedDict()
 		inlets = OrderedDict()
 
-		# Collect our own outlets
-		for k in set(dir(self)) - set(self.__dataclass_fields__.keys()):
-			value = getattr(self, k)
-			if isinstance(value, Outlet):
-				assert value.node is None
+		# Create our own outlets from the ones declared on the class
+		for k in self._outlet_names:
+			value = getattr(self.__class__, k)
+			assert value.node is None
 
-				# Replace Outlet with a new, initialized instance for us only
-				value = value.initialize(self)
-				setattr(self, k, value)
-				outlets[k] = value
+			# Replace Outlet with a new, initialized instance for us only
+			value = value.initialize(self)
+			setattr(self, k, value)
+			outlets[k] = value
 
 		# Collect inlets
-		for k in self.__dataclass_fields__.keys():
-			if k.startswith("_"):
-				continue
-
+		for k in self._inlet_names:
 			value = getattr(self, k)
 
 			if isinstance(value, Node):
@@ -110,7 +125,7 @@ class Node(Entity):
 			value = getattr(self, k)
 
 		self._inlets = inlets
-		self._outlets = OrderedDict(sorted(outlets.items(), key=lambda a: a[1]._index))
+		self._outlets = outlets
 
 
 class OutNode(Node):
@@ -123,6 +138,7 @@ class OutNode(Node):
 class Context:
 	out_nodes: list[OutNode] = field(default_factory=lambda: [])
 	unnamed_counter: int = 0
+	sample_rate: int = 48000  # Of the audio profile. Audio files are imported with it
 
 
 @dataclass(frozen=True)
@@ -136,6 +152,20 @@ class CompilationContext:
 _PARSE_CONTEXT = contextvars.ContextVar("_PARSE_CONTEXT")
 
 
+@dataclass
+class CompilerState:
+	"""
+	State of a single compilation
+
+	Set in _COMPILER_STATE while compiling, so that several projects can be compiled at the same
+	time, in different threads.
+	"""
+	next_id: int = 0
+
+
+_COMPILER_STATE = contextvars.ContextVar("_COMPILER_STATE")
+
+
 class DataType:
 	SIGNAL = 1
 	MIDI = 3
@@ -147,7 +177,7 @@ class Outlet(Entity):
 	datatype: DataType
 	node: Optional[Node] = None  # Set later automatically
 
-	_index_counter = 0
+	_index_counter = itertools.count()  # Orders the outlets as they are declared on the node classes
 
 	def __get_outlet(self, v) -> "Outlet":
 		"""Pick the first output of the node
@@ -176,8 +206,7 @@ class Outlet(Entity):
 		return lt(self, self.__get_outlet(other))
 
 	def __post_init__(self) -> None:
-		self._index = Outlet._index_counter
-		Outlet._index_counter += 1
+		self._index = next(Outlet._index_counter)
 
 	def initialize(self, node: Node) -> "Outlet":
 		outlet = Outlet(datatype=self.datatype, node=node)
@@ -492,8 +521,7 @@ class audiofile(Node):
 
 		self.channel_paths = {}
 
-		# TODO merayen retrieve sample_rate from aim project config or something?
-		for path in importing.read_audio_data(self.file, 48000):
+		for path in importing.read_audio_data(self.file, _PARSE_CONTEXT.get().sample_rate):
 			self.channel_paths[int(path.split("-")[1])] = path
 
 
@@ -537,88 +565,127 @@ class out(OutNode):
 			context.unnamed_counter += 1
 
 
-class state:
-	next_id = 0
-
-
 def create_variable() -> str:
+	"""
+	Create a unique variable name in the program being compiled
+	"""
+	state: CompilerState = _COMPILER_STATE.get()
 	state.next_id += 1
 	return f"_{state.next_id}"
 
 
-def load(text: str) -> Context:
-	_validate_python(text)
+def load(text: str, sample_rate: int = 48000) -> Context:
+	# Parsing and creating nodes only allocates objects that are kept, so the garbage collector
+	# would just walk them over and over again on large scripts
+	gc_enabled = gc.isenabled()
+	gc.disable()
 
-	module_variables = {
-		x.__name__: x
-		for x in Node.__subclasses__() + OutNode.__subclasses__()
-	}
+	try:
+		code = compile(_validate_python(text), "<string>", "exec")
 
-	token = _PARSE_CONTEXT.set(Context())
+		token = _PARSE_CONTEXT.set(Context(sample_rate=sample_rate))
 
-	exec(text, module_variables)
+		exec(code, dict(_node_classes()))
 
-	context: Context = _PARSE_CONTEXT.get()
+		context: Context = _PARSE_CONTEXT.get()
 
-	_PARSE_CONTEXT.reset(token)
+		_PARSE_CONTEXT.reset(token)
+	finally:
+		if gc_enabled:
+			gc.enable()
 
 	return context
 
 
-def _validate_python(text: str) -> None:
+def _node_classes() -> dict[str, type]:
+	"""
+	The node classes that can be used in main.py, by name
+
+	Only rebuilt when node classes have been added or removed since last time.
+	"""
+	subclasses = tuple(Node.__subclasses__() + OutNode.__subclasses__())
+
+	# Replaced as a whole, as other threads may be loading at the same time
+	cached_subclasses, result = _node_classes.cache
+
+	if subclasses != cached_subclasses:
+		result = {x.__name__: x for x in subclasses}
+		_node_classes.cache = (subclasses, result)
+
+	return result
+_node_classes.cache = ((), {})
+
+
+# Elements of Python that main.py can use, besides names and assignments
+_ALLOWED_ELEMENTS = frozenset([
+	ast.Div,
+	ast.Gt,
+	ast.Lt,
+	ast.Compare,
+	ast.Module,
+	ast.Expr,
+	ast.Load,  # TODO merayen what is this?
+	ast.BinOp,  # TODO merayen what is this?
+	ast.Store,  # TODO merayen what is this?
+	ast.Constant,
+	ast.Add,
+	ast.Sub,
+	ast.UnaryOp,
+	ast.Attribute,
+	ast.Mult,
+	ast.USub,
+	ast.keyword,
+	ast.Call,
+	ast.Pass,
+])
+
+
+def _validate_python(text: str) -> ast.Module:
 	"""Validate that only a subset of Python is being used
 
 	This makes Python more declarative and hopefully helps against malicious code if this were to run
-	any external code."""
-	import ast
-
-	for x in ast.walk(ast.parse(text)):
-		if isinstance(x, (
-			ast.Div,
-			ast.Gt,
-			ast.Lt,
-			ast.Compare,
-			ast.Module,
-			ast.Expr,
-			ast.Load,  # TODO merayen what is this?
-			ast.BinOp,  # TODO merayen what is this?
-			ast.Store,  # TODO merayen what is this?
-			ast.Constant,
-			ast.Add,
-			ast.Sub,
-			ast.UnaryOp,
-			ast.Attribute,
-			ast.Mult,
-			ast.USub,
-			ast.keyword,
-		)):
-			pass
-		elif isinstance(x, ast.Name):
+	any external code.
+
+	Returns the parsed module, so that it does not need to be parsed again for running it."""
+
+	node_classes = _node_classes()
+	module = ast.parse(text)
+
+	# Depth first, like ast.walk() but without its overhead, which is noticable on large scores
+	remaining = [module]
+	while remaining:
+		x = remaining.pop()
+		element = type(x)
+
+		if element is ast.Name:
 			if x.id.startswith("__"):
 				raise RestrictedPythonError("Can not use '__' variables")
 
 			if x.id.startswith("_"):
 				pass  # Allow "_name" variables
 
-			elif not any(
-				x.id == node.__name__
-				for node in Node.__subclasses__() + OutNode.__subclasses__()
-			):
+			elif x.id not in node_classes:
 				# If not "_name" symbol, require it to be a node
 				raise RestrictedPythonError(f"Node not found: {x.id!r}")
 
-		elif isinstance(x, ast.Assign):
+		elif element is ast.Assign:
 			if [type(y) for y in x.targets] != [ast.Name]:
 				raise RestrictedPythonError("Can only do simple assignments like '_a = _b' etc")
 
 			if not x.targets[0].id.startswith("_"):
 				raise RestrictedPythonError("Can only assign to variables starting with '_'")
 
-		elif isinstance(x, (ast.Call, ast.Pass)):
-			pass
+		elif element not in _ALLOWED_ELEMENTS:
+			raise RestrictedPythonError(f"Element {element.__name__!r} can not be used")
 
-		else:
-			raise RestrictedPythonError(f"Element {type(x).__name__!r} can not be used")
+		for field in x._fields:
+			value = getattr(x, field, None)
+			if isinstance(value, list):
+				remaining.extend(y for y in value if isinstance(y, ast.AST))
+			elif isinstance(value, ast.AST):
+				remaining.append(value)
+
+	return module
 
 
 def build_node_graph(context: Context) -> tuple[dict[int, set[int]], dict[int, Node]]:
@@ -627,10 +694,11 @@ def build_node_graph(context: Context) -> tuple[dict[int, set[int]], dict[int, N
 	# Node <-> id() registry. It is our way of setting identifiers on the nodes
 	node_ids: dict[int, Node] = {id(node): node for node in context.out_nodes}
 
-	remaining: set[int] = set(node_ids)
+	# Walked in the order of the script, so that the same script always gives the same program
+	remaining: deque[int] = deque(node_ids)
 
 	while remaining:
-		node_id: int = remaining.pop()
+		node_id: int = remaining.popleft()
 
 		graph[node_id] = set()
 
@@ -650,33 +718,114 @@ def build_node_graph(context: Context) -> tuple[dict[int, set[int]], dict[int, N
 				graph[node_id].add(id(input_value))
 
 				if id(input_value) not in node_ids:
-					remaining.add(id(input_value))
+					remaining.append(id(input_value))
 
 				node_ids[id(input_value)] = input_value
 
 	return graph, node_ids
 
 
-def execution_order(graph: dict[int, set[int]]) -> list[int]:
+def execution_order(graph: dict[int, set[int]], node_ids: Optional[dict[int, Node]] = None) -> list[int]:
 	"""
 	Sort the nodes in the order they need to be executed
+
+	Kahn's algorithm, O(V+E). Nodes that become ready at the same time keep the order they have in
+	the graph, so the order is stable between runs of the same graph.
+
+	Raises CyclicGraphError naming the nodes of a cycle, if there is one. Pass node_ids to get the
+	node class names in the error message.
 	"""
-	result = list(graph)
-
-	i = 0
-	while i < len(result):
-		for dependency in graph[result[i]]:
-			dependency_index = result.index(dependency)
-			if dependency_index > i:  # A depedency is executed after current node
-				# Move that dependency before us
-				result.insert(i, result.pop(dependency_index))
-				break  # Rerun at the same position, re-evaluating after our reordering
-		else:  # All dependencies are executed before node
-			i += 1  # We can move one position ahead
+	dependents: dict[int, list[int]] = {node_id: [] for node_id in graph}
+	remaining: dict[int, int] = {}
+
+	for node_id, dependencies in graph.items():
+		remaining[node_id] = len(dependencies)
+		for dependency in dependencies:
+			dependents[dependency].append(node_id)
+
+	ready = deque(node_id for node_id, count in remaining.items() if not count)
+	result = []
+
+	while ready:
+		node_id = ready.popleft()
+		result.append(node_id)
+
+		for dependent in dependents[node_id]:
+			remaining[dependent] -= 1
+			if not remaining[dependent]:
+				ready.append(dependent)
+
+	if len(result) != len(graph):
+		cycle = _find_cycle(graph, {node_id for node_id, count in remaining.items() if count})
+
+		if node_ids:
+			names = [f"{node_ids[node_id].__class__.__name__}({node_id})" for node_id in cycle]
+		else:
+			names = [str(node_id) for node_id in cycle]
+
+		raise CyclicGraphError(f"Nodes depend on each other: {' -> '.join(names + names[:1])}")
 
 	return result
 
 
+def connected_components(graph: dict[int, set[int]], node_ids: dict[int, Node]) -> list[set[int]]:
+	"""
+	Groups of nodes that are connected, through their inputs or through put() and get() of a label
+
+	Nodes of different groups do not affect each other, so the groups can run on their own. The
+	groups are in the order of their first node in graph.
+	"""
+	parent: dict[int, int] = {node_id: node_id for node_id in graph}
+
+	def find(node_id: int) -> int:
+		while parent[node_id] != node_id:
+			parent[node_id] = parent[parent[node_id]]
+			node_id = parent[node_id]
+		return node_id
+
+	def union(a: int, b: int) -> None:
+		a, b = find(a), find(b)
+		if a != b:
+			parent[max(a, b, key=order.__getitem__)] = min(a, b, key=order.__getitem__)
+
+	order = {node_id: index for index, node_id in enumerate(graph)}
+	pipes: dict[Any, int] = {}  # Label -> first node of put() or get() with it
+
+	for node_id, dependencies in graph.items():
+		for dependency in dependencies:
+			union(node_id, dependency)
+
+		node = node_ids[node_id]
+		if isinstance(node, (put, get)):
+			union(node_id, pipes.setdefault(node.label, node_id))
+
+	groups: dict[int, set[int]] = {}
+	for node_id in graph:
+		groups.setdefault(find(node_id), set()).add(node_id)
+
+	return list(groups.values())
+
+
+def _find_cycle(graph: dict[int, set[int]], blocked: set[int]) -> list[int]:
+	"""
+	Find one cycle among the nodes that could not be ordered
+
+	Every blocked node waits for at least one other blocked node, so following blocked dependencies
+	must eventually visit a node a second time.
+	"""
+	path: list[int] = []
+	position: dict[int, int] = {}
+
+	node_id = next(x for x in graph if x in blocked)
+	while node_id not in position:
+		position[node_id] = len(path)
+		path.append(node_id)
+		node_id = next(x for x in graph[node_id] if x in blocked)
+
+	# The path is in dependency direction, present it in execution direction
+	return path[position[node_id]:][::-1]
+
+
 def test_a() -> None:
 	@node
 	class A(Node):
@@ -741,6 +890,32 @@ out(_d)
 	assert order[-1] == id(out_node)
 
 
+def test_connected_components() -> None:
+	context = load("""
+_a = sine(110)
+out(_a * 0.5)
+out(oscilloscope(_a))
+out(saw(220))
+put("feedback", sine(get("feedback")))
+out(get("feedback"))
+out(0.1)
+	""")
+
+	graph, node_ids = build_node_graph(context)
+	groups = connected_components(graph, node_ids)
+
+	def classes(group: set[int]) -> list[str]:
+		return sorted(node_ids[x].__class__.__name__ for x in group)
+
+	assert [classes(x) for x in groups] == [
+		["mul", "oscilloscope", "out", "out", "sine"],
+		["out", "saw"],
+		["get", "get", "out", "put", "sine"],  # Only connected by the label
+		["out"],
+	]
+	assert set().union(*groups) == set(graph)
+
+
 def test_operator_execution_order():
 	r = "out(%s)"
 	for i in range(10):
@@ -758,6 +933,17 @@ def test_operator_execution_order():
 	assert isinstance(node_ids[order[-1]], out)
 
 
+def test_execution_order_cycle() -> None:
+	graph = {1: set(), 2: {1, 4}, 3: {2}, 4: {3}, 5: {4}}
+
+	try:
+		execution_order(graph)
+	except CyclicGraphError as e:
+		assert str(e) == "Nodes depend on each other: 3 -> 4 -> 2 -> 3", str(e)
+	else:
+		raise Exception("Should have detected the cycle")
+
+
 def test_forbidden_python() -> None:
 	for x in (
 		"import os",
@@ -800,6 +986,32 @@ def test_forbidden_python() -> None:
 			raise Exception(f"Should have not restricted {x!r}")
 
 
+def test_new_node_classes_allowed() -> None:
+	import gc
+
+	load("out(sine())")
+
+	try:
+		load("out(test_node())")
+	except RestrictedPythonError:
+		pass
+	else:
+		raise Exception("test_node should not exist yet")
+
+	@node
+	class test_node(Node):
+		output = Outlet(DataType.SIGNAL)
+
+	assert len(load("out(test_node())").out_nodes) == 1
+
+	# Removed again, so that other tests do not see it. The cache of _node_classes() references it,
+	# and classes are in reference cycles of their own
+	del test_node
+	_node_classes.cache = ((), {})
+	gc.collect()
+	assert "test_node" not in _node_classes() and "test_node" not in _node_classes.cache[1]
+
+
 def test_gt():
 	assert isinstance(sine(), Node)
 	assert isinstance(sine() > sine(), gt)
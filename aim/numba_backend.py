@@ -0,0 +1,317 @@
+"""
+Compiles the whole node graph into a single numba kernel
+
+The numpy backend runs a Python statement and creates a temporary array for every node and voice
+on every block. Here, all the nodes are instead calculated for one sample before going to the next,
+in one loop that numba compiles to machine code. State that lasts between blocks, like the clocks
+of the oscillators, is kept in a single array that is given to the kernel.
+
+Only the nodes with a numba_<node name> function below are supported. None of them create voices,
+so all signals are voice 0. Use the numpy backend for anything else.
+
+The program has the same interface as the one from the numpy backend, so the engine can run both.
+"""
+from dataclasses import dataclass, field
+from typing import Any
+
+from aim.nodes import (
+	Node, CompilerState, _COMPILER_STATE, Outlet, DataType, CompilationContext, create_variable,
+	add, sub, mul, div, gt, lt,
+)
+from aim.numpy_backend import _header_code, unsupported
+
+
+@dataclass
+class KernelContext:
+	frame_count: int  # Samples per buffer
+	sample_rate: int
+	state: list[tuple[str, float]] = field(default_factory=lambda: [])  # Variable and initial value
+	outputs: list[str] = field(default_factory=lambda: [])  # Names of the out-nodes
+
+	def create_state(self, value: float) -> str:
+		"""
+		Variable that keeps its value between blocks
+		"""
+		variable = create_variable()
+		self.state.append((variable, float(value)))
+		return variable
+
+
+def _input(node: Node, name: str) -> str:
+	"""
+	Expression of the value of an inlet for the current sample
+	"""
+	value = getattr(node, name)
+
+	if isinstance(value, (int, float)):
+		return repr(float(value))
+
+	if isinstance(value, Outlet) and value.datatype == DataType.SIGNAL:
+		return value._variable
+
+	unsupported(node)
+
+
+def _oscillator_clock(kernel_context: KernelContext, node: Node, code: list[str], func: str) -> None:
+	"""
+	Common oscillator clock, like the one of the numpy backend, but wrapped every sample
+	"""
+	if isinstance(node.frequency, Outlet) and isinstance(node.phase, Outlet):
+		# Phase is read from the input when the voice starts, which is on the first sample
+		clock = kernel_context.create_state(float("nan"))
+		code.append(f"if {clock} != {clock}:")
+		code.append(f"	{clock} = {_input(node, 'phase')}")
+	elif isinstance(node.phase, (int, float)):
+		clock = kernel_context.create_state(node.phase)
+	else:
+		clock = kernel_context.create_state(0.0)
+
+	code.append(f"{clock} += {_input(node, 'frequency')} / {kernel_context.sample_rate}")
+	code.append(f"{clock} -= math.floor({clock})")
+	code.append(f"{node.output._variable} = {func % {'clock': clock}}")
+
+
+def numba_sine(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	_oscillator_clock(kernel_context, node, code, "math.sin(%(clock)s * 2 * math.pi)")
+
+
+def numba_square(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	if node.duty is None:
+		_oscillator_clock(kernel_context, node, code, "1.0 if %(clock)s >= 0.5 else -1.0")
+	elif isinstance(node.duty, (int, float)):
+		_oscillator_clock(kernel_context, node, code, f"1.0 if %(clock)s >= {_input(node, 'duty')} else -1.0")
+	else:
+		_oscillator_clock(kernel_context, node, code, f"1.0 if %(clock)s > {_input(node, 'duty')} else -1.0")
+
+
+def numba_saw(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	_oscillator_clock(kernel_context, node, code, "%(clock)s * 2.0 - 1.0")
+
+
+def _numba_math(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	op = {
+		add: "+",
+		sub: "-",
+		mul: "*",
+		div: "/",
+		gt: ">",
+		lt: "<",
+	}[node.__class__]
+
+	expression = f"{_input(node, 'in0')} {op} {_input(node, 'in1')}"
+
+	if op in "<>":
+		expression = f"1.0 if {expression} else 0.0"
+
+	code.append(f"{node.output._variable} = {expression}")
+
+
+numba_add = _numba_math
+numba_sub = _numba_math
+numba_mul = _numba_math
+numba_div = _numba_math
+numba_gt = _numba_math
+numba_lt = _numba_math
+
+
+def numba_mix(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	if isinstance(node.fac, (int, float)):
+		fac = repr((max(min(node.fac, 1), -1) + 1) / 2)
+	else:
+		fac = _input(node, "fac")
+
+	code.append(
+		f"{node.output._variable} = {_input(node, 'in0')} * (1 - {fac}) + {_input(node, 'in1')} * {fac}"
+	)
+
+
+def numba_clip(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	code.append(
+		f"{node.output._variable} = "
+		f"min(max({_input(node, 'value')}, {_input(node, 'minimum')}), {_input(node, 'maximum')})"
+	)
+
+
+def numba_trigger(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	current = kernel_context.create_state(0.0)
+
+	value = _input(node, "value")
+	code.append(f"if {value} >= {_input(node, 'on')}:")
+	code.append(f"	{current} = 1.0")
+	code.append(f"elif {value} < {_input(node, 'off')}:")
+	code.append(f"	{current} = 0.0")
+	code.append(f"{node.output._variable} = {current}")
+
+
+def numba_time(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	# As in the numpy backend, voice_trigger is only used for its voices, and all are voice 0 here
+	if not isinstance(node.voice_trigger, Outlet) and node.voice_trigger:
+		unsupported(node)
+
+	sample_clock = kernel_context.create_state(0.0)
+	code.append(f"{sample_clock} += 1.0")
+	code.append(f"{node.output._variable} = {sample_clock} / {kernel_context.sample_rate}")
+
+
+def numba_out(kernel_context: KernelContext, node: Node, code: list[str]) -> None:
+	assert node.name
+	assert "'" not in node.name
+
+	code.append(f"outputs[{len(kernel_context.outputs)}, i] = {_input(node, 'input')}")
+	kernel_context.outputs.append(node.name)
+
+
+def compile_to_numba(
+	compilation_context: CompilationContext,
+	frame_count: int = 2**13,
+	sample_rate: int = 48000,
+) -> str:
+	assert isinstance(compilation_context, CompilationContext)
+
+	return NumbaCompiler(frame_count, sample_rate).compile(compilation_context)
+
+
+class NumbaCompiler:
+	"""
+	Same interface as numpy_backend.IncrementalCompiler, but always generates everything
+
+	Nothing is carried over to the next program when hot swapping, so it starts from scratch.
+	"""
+	def __init__(self, frame_count: int = 2**13, sample_rate: int = 48000):
+		self.frame_count = frame_count
+		self.sample_rate = sample_rate
+
+		# Statistics of the last compile
+		self.reused = 0
+		self.generated = 0
+
+		self.preserved: list[str] = []
+
+		# The program of the last compile, as a single chunk, see aim.cache
+		self.chunks: list[str] = []
+
+	def compile(self, compilation_context: CompilationContext) -> str:
+		assert isinstance(compilation_context, CompilationContext)
+
+		token = _COMPILER_STATE.set(CompilerState())
+		try:
+			return self._compile(compilation_context)
+		finally:
+			_COMPILER_STATE.reset(token)
+
+	def _compile(self, compilation_context: CompilationContext) -> str:
+		kernel_context = KernelContext(frame_count=self.frame_count, sample_rate=self.sample_rate)
+
+		sample_code = []
+		for node_id in compilation_context.order:
+			node = compilation_context.node_ids[node_id]
+
+			func = globals().get(f"numba_{node.__class__.__name__}")
+
+			if not func:
+				raise NotImplementedError(f"Node {node.__class__} is not supported in the numba_backend")
+
+			sample_code.append(f"# {node.__class__.__name__}")
+			func(kernel_context, node, sample_code)
+
+		self.generated = len(compilation_context.order)
+
+		# State is kept in local variables while running, as numba can then keep them in registers
+		kernel_code = [
+			"@numba.njit('void(float64[:], float32[:, :])', error_model='numpy')",
+			"def _kernel(state, outputs):",
+			*(f"	{variable} = state[{index}]" for index, (variable, _) in enumerate(kernel_context.state)),
+			f"	for i in range({self.frame_count}):",
+			*(f"		{x}" for x in sample_code),
+			*(f"	state[{index}] = {variable}" for index, (variable, _) in enumerate(kernel_context.state)),
+		]
+
+		init_code = [
+			f"_state = np.array({[value for _, value in kernel_context.state]!r}, dtype='float64')",
+			f"_outputs = np.zeros(({len(kernel_context.outputs)}, {self.frame_count}), dtype='float32')",
+			"_signals = {",
+			*(
+				f"	'{name}': Signal(voices={{0: _outputs[{index}]}}, matrix=_outputs[{index}:{index + 1}], ids=[0], slots={{0: 0}}),"
+				for index, name in enumerate(kernel_context.outputs)
+			),
+			"}",
+		]
+
+		process_code = [
+			"global process_counter",
+			"process_counter += 1",
+			"_kernel(_state, _outputs)",
+			"return dict(_signals)",
+		]
+
+		code = "\n".join(
+			_header_code(self.frame_count) + ["import math", "import numba", "nan = math.nan"] + kernel_code + init_code
+		)
+		code += f"\nsample_rate = {self.sample_rate}"
+		code += f"\nframe_count = {self.frame_count}"
+		code += "\ndef numpy_process():\n" + "\n".join(f"\t{x}" for x in process_code)
+
+		self.chunks = [code]
+
+		return code
+
+
+def test_same_output_as_numpy_backend() -> None:
+	import contextlib
+	import io
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+	from aim.numpy_backend import compile_to_numpy
+
+	def run(compile_function, code: str, frame_count: int) -> list[dict[str, Any]]:
+		context = load(code)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph, node_ids)
+		program = {}
+		exec(compile_function(CompilationContext(context, graph, node_ids, order), frame_count, 1000), program)
+
+		with contextlib.redirect_stdout(io.StringIO()):
+			return [
+				{name: signal.voices[0].copy() for name, signal in program["numpy_process"]().items()}
+				for _ in range(5)
+			]
+
+	for code in (
+		"out(sine(110))",
+		"out(sine(sine(5) * 10 + 110, phase=0.25))",
+		"out(square(47, duty=0.3) + saw(30) * 0.5 - 1); out(square(47, duty=sine(3)) / 2)",
+		"out(mix(sine(20), saw(35), 0.2)); out(mix(sine(20), 1, fac=sine(1)))",
+		"out(clip(sine(10) * 3, -0.5, 0.8)); out(sine(43) > 0); out(sine(43) < saw(2))",
+		"out(trigger(sine(7), 0.6, -0.6)); out(trigger(sine(7), on=saw(3), off=-0.5))",
+		"out(time()); out(sine(time() * 100 + 20)); out(time(voice_trigger=sine(1)))",
+		"out(5); out(add(2, 3))",
+	):
+		expected = run(compile_to_numpy, code, 64)
+		result = run(compile_to_numba, code, 64)
+
+		for expected_block, block in zip(expected, result):
+			assert expected_block.keys() == block.keys()
+			for name in block:
+				# The numpy backend accumulates the clocks in float32, so where a signal crosses a
+				# threshold, the outputs may differ by a sample
+				assert np.sum(~np.isclose(expected_block[name], block[name], atol=1e-3)) <= 1, (code, name)
+
+
+def test_unsupported_nodes() -> None:
+	from aim.nodes import load, build_node_graph, execution_order
+
+	context = load("out(sine(unison(440, 2)))")
+	graph, node_ids = build_node_graph(context)
+
+	try:
+		compile_to_numba(CompilationContext(context, graph, node_ids, execution_order(graph)))
+	except NotImplementedError:
+		pass
+	else:
+		raise Exception("unison should not be supported")
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
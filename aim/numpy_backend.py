@@ -1,9 +1,13 @@
+import functools
+import gc
+import hashlib
+import os
 from dataclasses import dataclass, field
 from aim.nodes import (
-	Node, create_variable, Outlet, Context, DataType,
+	Node, create_variable, CompilerState, _COMPILER_STATE, Outlet, Context, DataType,
 	delay, sine, out, CompilationContext,
 )
-from typing import Any
+from typing import Any, Callable, Optional
 
 
 @dataclass
@@ -11,6 +15,9 @@ class ModuleContext:
 	frame_count: int  # Samples per buffer
 	sample_rate: int
 	pipes: set[str] = field(default_factory=lambda: set())
+	helpers: dict[tuple[str, ...], str] = field(default_factory=lambda: {})  # Lines -> name, see introduce()
+	introduced: set[str] = field(default_factory=lambda: set())  # Helpers used by the current node
+	debug: bool = False  # Compile in debug_print(), see "aim run --debug"
 
 
 def _oscillator_clock(
@@ -18,67 +25,85 @@ def _oscillator_clock(
 	node: Node,
 	init_code: list[str],
 	process_code: list[str],
-	func: str,
+	func: list[str],
 ):
 	"""
 	Common oscillator clock for all of the oscillators
+
+	func are the lines that write the output of the oscillator into %(target)s, from the clock in
+	%(clock_array)s. They may change %(clock_array)s. When the frequency is a signal, these are
+	matrices with a row for each voice in %(voice_ids)s, and all voices are calculated at once.
 	"""
 	clock = create_variable()
 	clock_array = create_variable()
 	voice_id = create_variable()
+	target = create_variable()
+
+	init_code.append(f"{clock_array} = np.empty({module_context.frame_count}, dtype='float32')")
 
 	if isinstance(node.frequency, (int, float)):
-		func %= {'clock_array': clock_array, "voice_id": 0}
+		func = [x % {'clock_array': clock_array, "voice_ids": "[0]", "target": target} for x in func]
+		ramp = create_variable()
 		if isinstance(node.phase, (int, float)):
 			init_code.append(f"{clock} = {node.phase}")
 		else:
 			init_code.append(f"{clock} = 0.0")
 		init_code.append(f"{node.output._variable} = Signal()")
-		process_code.append(f"global {clock}")
-		process_code.append(
-			f"{clock_array} = {clock} + "
-			f"np.cumsum(_ONES * ({node.frequency} / {module_context.sample_rate}))"
+		init_code.append(
+			f"{ramp} = (np.arange(1, {module_context.frame_count + 1}) * ({node.frequency} / {module_context.sample_rate})).astype('float32')"
 		)
-		process_code.append(f"{node.output._variable}.voices[0] = {func}")
-		process_code.append(f"{clock} = {clock_array}[-1] % 1")
-
-	elif isinstance(node.frequency, Outlet):
-		func %= {'clock_array': clock_array, "voice_id": "voice_id"}
-
-		init_code.append(f"{clock} = {{}}")
+		process_code.append(f"global {clock}")
+		process_code.append(f"np.add({ramp}, {clock}, out={clock_array})")
+
+		# Carried over in double precision, so that the clock does not drift between blocks
+		process_code.append(f"{clock} = ({clock} + {module_context.frame_count * node.frequency / module_context.sample_rate!r}) % 1")
+		process_code.append(f"{target} = {node.output._variable}.align([0])")
+		process_code.extend(func)
+
+	elif isinstance(node.frequency, Outlet) and node.frequency.datatype == DataType.SIGNAL:
+		# Note that we only respect voices on the frequency-input
+		# If e.g another input port has other voices, we just ignore them. This may or may not be
+		# wanted.
+		voice_ids = create_variable()
+		frequencies = create_variable()
+		clocks = create_variable()
+		row = create_variable()
+
+		func = [x % {'clock_array': target, "voice_ids": voice_ids, "target": target} for x in func]
+
+		# Clock of each voice, as a matrix with a single column. Same dtype as the output, as adding
+		# it to the output would otherwise cast through a temporary buffer
+		init_code.append(f"{clock} = Signal(width=1)")
 		init_code.append(f"{node.output._variable} = Signal()")
 
-		if node.frequency.datatype == DataType.SIGNAL:
-			# Note that we only respect voices on the frequency-input
-			# If e.g another input port has other voices, we just ignore them. This may or may not be
-			# wanted.
-
-			# Create new voices
-			process_code.append(f"for {voice_id} in set({node.frequency._variable}.voices) - set({node.output._variable}.voices):")
+		process_code.append(f"{voice_ids}, {frequencies} = voice_rows({node.frequency._variable})")
+		process_code.append(f"{target} = {node.output._variable}.align({voice_ids})")
+		process_code.append(f"{clocks} = {clock}.align({voice_ids})")
+
+		# Start the clocks of new voices
+		if node.phase is None:
+			process_code.append(f"if {clock}.new: {clocks}[{clock}.new] = 0")
+		elif isinstance(node.phase, (int, float)):
+			process_code.append(f"if {clock}.new: {clocks}[{clock}.new] = {node.phase}")
+		elif isinstance(node.phase, Outlet) and node.phase.datatype == DataType.SIGNAL:
+			process_code.append(f"for {row} in {clock}.new:")
+			process_code.append(f"	{clocks}[{row}] = {node.phase._variable}.voices.get({voice_ids}[{row}], [0])[0]")
+		else:
+			unsupported(node)
 
-			if node.phase is None:
-				process_code.append(f"	{clock}[{voice_id}] = 0")
-			elif isinstance(node.phase, (int, float)):
-				process_code.append(f"	{clock}[{voice_id}] = {node.phase}")
-			elif isinstance(node.phase, Outlet) and node.phase.datatype == DataType.SIGNAL:
-				process_code.append(f"	{clock}[{voice_id}] = {node.phase._variable}.voices.get({voice_id}, [0])[0]")
+		process_code.append(f"np.divide({frequencies}, {module_context.sample_rate}, out={target})")
+		process_code.append(f"np.cumsum({target}, axis=1, out={target})")
+		process_code.append(f"np.add({target}, {clocks}, out={target})")
+		process_code.append(f"np.remainder({target}[:, -1:], 1, out={clocks})")
+		process_code.extend(func)
 
-			voice = create_variable()
-			process_code.append(f"for {voice_id}, {voice} in {node.frequency._variable}.voices.items():")
-			process_code.append(f"	{clock_array} = {clock}[{voice_id}] + np.cumsum(_ONES * ({voice} / {module_context.sample_rate}))")
-			process_code.append(f"	{clock}[{voice_id}] = {clock_array}[-1] % 1")
-			process_code.append(f"	{node.output._variable}.voices[{voice_id}] = {func}")
+	elif isinstance(node.frequency, Outlet):
+		func = [x % {'clock_array': clock_array, "voice_ids": f"[{voice_id}]", "target": target} for x in func]
 
-			# Remove voices that has disappeared
-			process_code.extend(
-				[
-					f"for {voice_id} in set({node.output._variable}.voices) - set({node.frequency._variable}.voices):",
-					f"	{clock}.pop({voice_id})",
-					f"	{node.output._variable}.voices.pop({voice_id})",
-				]
-			)
+		init_code.append(f"{clock} = {{}}")
+		init_code.append(f"{node.output._variable} = Signal()")
 
-		elif node.frequency.datatype == DataType.MIDI:
+		if node.frequency.datatype == DataType.MIDI:
 			# XXX this code could be moved out and used by other nodes
 			# TODO merayen this does not work as we need to have separate amplitude and frequency etc for each voice, not globally
 
@@ -123,9 +148,13 @@ def _oscillator_clock(
 
 			process_code.append(f"			{packet}[{voice_id}].clear()")
 
-			process_code.append(f"	{clock_array} = {clock}[{voice_id}] + np.cumsum({frequencies}[{voice_id}] / {module_context.sample_rate})")
+			process_code.append(f"	np.divide({frequencies}[{voice_id}], {module_context.sample_rate}, out={clock_array})")
+			process_code.append(f"	np.cumsum({clock_array}, out={clock_array})")
+			process_code.append(f"	np.add({clock_array}, {clock}[{voice_id}], out={clock_array})")
 			process_code.append(f"	{clock}[{voice_id}] = {clock_array}[-1] % 1")  # Save position for next time
-			process_code.append(f"	{node.output._variable}.voices[{voice_id}] = ({func}) * {amplitudes}[{voice_id}]")
+			process_code.append(f"	{target} = {node.output._variable}.buffer({voice_id})[None]")  # As a matrix of one voice
+			process_code.extend(f"	{x}" for x in func)
+			process_code.append(f"	np.multiply({target}, {amplitudes}[{voice_id}], out={target})")
 
 			# Remove voices that has disappeared
 			process_code.extend(
@@ -136,7 +165,7 @@ def _oscillator_clock(
 					f"	{frequencies}.pop({voice_id}, None)",
 					f"	{keys}.pop({voice_id}, None)",
 					f"	{packet}.pop({voice_id}, None)",
-					f"	{node.output._variable}.voices.pop({voice_id}, None)",
+					f"	{node.output._variable}.release({voice_id})",
 				]
 			)
 		else:
@@ -153,8 +182,8 @@ def numpy_midi(
 ) -> None:
 	init_code.append(f"{node.midi._variable} = Midi(voices={{0: []}})")
 
-	introduce(init_code, ["import queue"])
-	introduce(init_code, ["import threading"])
+	introduce(module_context, ["import queue"])
+	introduce(module_context, ["import threading"])
 
 	queue = create_variable()
 	init_code.append(f"{queue} = queue.Queue()")
@@ -187,6 +216,9 @@ def numpy_print(
 	init_code: list[str],
 	process_code: list[str],
 ) -> None:
+	if not module_context.debug:
+		return  # Nothing to do, as there is nowhere to print
+
 	voices = create_variable()
 	voice_id = create_variable()
 	voice = create_variable()
@@ -195,13 +227,13 @@ def numpy_print(
 	process_code.append(f"for {voice_id}, {voice} in {node.input._variable}.voices.items():")
 	process_code.append(f"	if {voice_id} not in {voices}:")
 	process_code.append(f"		{voices}.add({voice_id})")
-	process_code.append(f"		" + debug_print(node, f"f'+voice={{{voice_id}}}, count={{len({voices})}}'"))
+	process_code.append(f"		" + debug_print(module_context, node, f"f'+voice={{{voice_id}}}, count={{len({voices})}}'"))
 
 	if isinstance(node.input, Outlet):
 		if node.input.datatype == DataType.MIDI:
 			midi_event = create_variable()
 			process_code.append(f"	for {midi_event} in {voice}:")
-			process_code.append( "		" + debug_print(node, f'f"voice={{{voice_id}}}, midi={{{midi_event}}}"'))
+			process_code.append( "		" + debug_print(module_context, node, f'f"voice={{{voice_id}}}, midi={{{midi_event}}}"'))
 		elif node.input.datatype == DataType.SIGNAL:
 			pass
 		else:
@@ -211,7 +243,7 @@ def numpy_print(
 
 	process_code.append(f"for {voice_id} in {voices} - set({node.input._variable}.voices):")
 	process_code.append(f"	{voices}.remove({voice_id})")
-	process_code.append(f"	" + debug_print(node, f'f"-voice={{{voice_id}}}, count={{len({voices})}}"'))
+	process_code.append(f"	" + debug_print(module_context, node, f'f"-voice={{{voice_id}}}, count={{len({voices})}}"'))
 
 
 def numpy_put(
@@ -232,24 +264,32 @@ def numpy_put(
 	label_escaped = node.label.replace("\"", "\\\"")
 
 	if node.label in module_context.pipes:
-		raise Exception("Pipe with the name '{node.label}' already exists.")
+		raise Exception(f"Pipe with the name '{node.label}' already exists.")
 
 	module_context.pipes.add(node.label)
 
 	if isinstance(node.input, Outlet) and node.input.datatype == DataType.SIGNAL:
-		init_code.append(f"piping_node_pipes[\"{label_escaped}\"] = {{}}")
-
-		label = create_variable()
+		# Copied into one of two signals, every other block. get() nodes running before us in the block
+		# read the other one, from the previous block, which is not written to until the next block
+		buffers = create_variable()
+		buffer = create_variable()
 		voice_id = create_variable()
 		voice = create_variable()
+		init_code.append(f"{buffers} = [Signal(), Signal()]")
+		init_code.append(f"piping_node_pipes[\"{label_escaped}\"] = {buffers}[1]")
 
-		# Copy input data to our internal buffer
-		process_code.append(f"for {voice_id}, {voice} in {node.input._variable}.voices.items():")
-		process_code.append(f"	piping_node_pipes[\"{label_escaped}\"][{voice_id}] = {voice} * 1")
-
-		# Remove dead voices
-		process_code.append(f"for {voice_id} in set(piping_node_pipes[\"{label_escaped}\"]) - set({node.input._variable}.voices):")
-		process_code.append(f"	piping_node_pipes[\"{label_escaped}\"].pop({voice_id}, None)")
+		process_code.extend(
+			[
+				f"{buffer} = {buffers}[process_counter % 2]",
+				f"if {node.input._variable}.matrix is not None:",
+				f"	np.copyto({buffer}.align({node.input._variable}.ids), {node.input._variable}.matrix)",
+				"else:",
+				f"	{buffer}.align(list({node.input._variable}.voices))",
+				f"	for {voice_id}, {voice} in {node.input._variable}.voices.items():",
+				f"		{buffer}.voices[{voice_id}][:] = {voice}",
+				f"piping_node_pipes[\"{label_escaped}\"] = {buffer}",
+			]
+		)
 	else:
 		unsupported(node)
 
@@ -267,18 +307,13 @@ def numpy_get(
 
 	init_code.append(f"{node.output._variable} = Signal()")
 
-	# Send last buffers data out
+	# Send the voices of the last put() out, as they are. See numpy_put()
 	# TODO merayen support other types of data, not just assume SIGNAL
-	voice = create_variable()
-	voice_id = create_variable()
+	pipe = create_variable()
+	output = node.output._variable
 	process_code.append(f"if \"{label_escaped}\" in piping_node_pipes:")
-	# Remove voices that has disappeared in our buffer
-	process_code.append(f"	for {voice_id} in set({node.output._variable}.voices) - set(piping_node_pipes[\"{label_escaped}\"]):")
-	process_code.append(f"		{node.output._variable}.voices.pop({voice_id}, None)")
-
-	process_code.append(f"	for {voice_id}, {voice} in piping_node_pipes[\"{label_escaped}\"].items():")
-	process_code.append(f"		{node.output._variable}.voices[{voice_id}] = {voice}")
-
+	process_code.append(f"	{pipe} = piping_node_pipes[\"{label_escaped}\"]")
+	process_code.append(f"	{output}.ids, {output}.slots, {output}.matrix, {output}.voices = {pipe}.ids, {pipe}.slots, {pipe}.matrix, {pipe}.voices")
 
 
 def numpy_sine(
@@ -292,7 +327,10 @@ def numpy_sine(
 		node,
 		init_code,
 		process_code,
-		"np.sin(%(clock_array)s * np.pi * 2)",
+		[
+			"np.multiply(%(clock_array)s, np.pi * 2, out=%(clock_array)s)",
+			"np.sin(%(clock_array)s, out=%(target)s)",
+		],
 	)
 
 
@@ -302,13 +340,19 @@ def numpy_square(
 	init_code: list[str],
 	process_code: list[str],
 ) -> None:
+	# Comparison gives 0 or 1 in the output, which is then scaled to -1 or 1
+	to_square = ["np.multiply(%(target)s, 2, out=%(target)s)", "np.subtract(%(target)s, 1, out=%(target)s)"]
+
 	if node.duty is None:
 		_oscillator_clock(
 			module_context,
 			node,
 			init_code,
 			process_code,
-			"(%(clock_array)s %% 1 >= 0.5).astype('float32') * 2 - 1",
+			[
+				"np.remainder(%(clock_array)s, 1, out=%(clock_array)s)",
+				"np.greater_equal(%(clock_array)s, 0.5, out=%(target)s)",
+			] + to_square,
 		)
 	elif isinstance(node.duty, (int, float)):
 		_oscillator_clock(
@@ -316,7 +360,10 @@ def numpy_square(
 			node,
 			init_code,
 			process_code,
-			f"(%(clock_array)s %% 1 >= {node.duty}).astype('float32') * 2 - 1",
+			[
+				"np.remainder(%(clock_array)s, 1, out=%(clock_array)s)",
+				f"np.greater_equal(%(clock_array)s, {node.duty}, out=%(target)s)",
+			] + to_square,
 		)
 	elif isinstance(node.duty, Outlet):
 		if node.duty.datatype == DataType.SIGNAL:
@@ -325,7 +372,10 @@ def numpy_square(
 				node,
 				init_code,
 				process_code,
-				f"(%(clock_array)s %% 1 > {node.duty._variable}.voices.get(%(voice_id)s, _ONES)).astype('float32') * 2 - 1",
+				[
+					"np.remainder(%(clock_array)s, 1, out=%(clock_array)s)",
+					f"np.greater(%(clock_array)s, rows_for({node.duty._variable}, %(voice_ids)s, _ONES), out=%(target)s)",
+				] + to_square,
 			)
 		else:
 			unsupported(node)
@@ -344,7 +394,11 @@ def numpy_saw(
 		node,
 		init_code,
 		process_code,
-		"(%(clock_array)s %% 1) * 2.0 - 1.0",
+		[
+			"np.remainder(%(clock_array)s, 1, out=%(clock_array)s)",
+			"np.multiply(%(clock_array)s, 2.0, out=%(target)s)",
+			"np.subtract(%(target)s, 1.0, out=%(target)s)",
+		],
 	)
 
 
@@ -356,25 +410,26 @@ def numpy_noise(
 ) -> None:
 	init_code.append(f"{node.output._variable} = Signal()")
 
+	buffer = create_variable()
+
 	if isinstance(node.voices, Outlet):
 		process_code.extend(
 			[
-				"for voice_id in {node.voices._variable}.voices:",
-					f"	{node.output._variable}.voices[0] = random.random(({module_context.frame_count},), dtype='float32') * 2 - 1",
+				f"{buffer} = {node.output._variable}.align(list({node.voices._variable}.voices))",
+				f"random.random(out={buffer}, dtype='float32')",
+				f"np.multiply({buffer}, 2, out={buffer})",
+				f"np.subtract({buffer}, 1, out={buffer})",
 			]
 		)
-
-		# Remove voices that are extinct
+	else:
 		process_code.extend(
 			[
-				f"for voice_id in set({node.output._variable}.voices) - set({node.voices._variable}.voices):",
-				f"	{node.output._variable}.voices.pop(voice_id)",
+				f"{buffer} = {node.output._variable}.align([0])",
+				f"random.random(out={buffer}, dtype='float32')",
+				f"np.multiply({buffer}, 2, out={buffer})",
+				f"np.subtract({buffer}, 1, out={buffer})",
 			]
 		)
-	else:
-		process_code.append(
-			f"{node.output._variable}.voices[0] = random.random(({module_context.frame_count},), dtype='float32') * 2 - 1"
-		)
 
 
 def numpy_random(
@@ -384,7 +439,7 @@ def numpy_random(
 	process_code: list[str],
 ) -> None:
 	if node.input is None:
-		init_code.append(f"{node.output._variable} = Signal(voices={{0: _ONES*random.random()*2-1}})")
+		init_code.append(f"{node.output._variable} = constant_signal(random.random()*2-1)")
 	elif isinstance(node.input, Outlet) and node.input.datatype == DataType.SIGNAL:
 		init_code.append(f"{node.output._variable} = Signal()")
 
@@ -426,86 +481,28 @@ def _numpy_math(
 		lt: "<",
 	}[node.__class__]
 
-	voice_id = create_variable()
+	ufunc = {
+		add: "np.add",
+		sub: "np.subtract",
+		mul: "np.multiply",
+		div: "np.divide",
+		gt: "np.greater",
+		lt: "np.less",
+	}[node.__class__]
 
 	if isinstance(node.in0, (int, float)) and isinstance(node.in1, (int, float)):
 		# Number never changes, sum it only once
-		init_code.append(
-				f"{node.output._variable} = Signal(voices={{0:"
-				f"np.zeros({module_context.frame_count}) + {eval('node.in0'+op+'node.in1')}}})"
-		)
-	elif isinstance(node.in0, Outlet) and isinstance(node.in1, Outlet):
-		init_code.append(f"{node.output._variable} = Signal()")
-		if node.in0.datatype == DataType.SIGNAL and node.in1.datatype == DataType.SIGNAL:
-			process_code.extend(
-				[
-					# Experimental, complex voice 0 handling we don't know if we want to continue or not
-					f"if list({node.in0._variable}.voices) == [0] and list({node.in1._variable}.voices) == [0]:",
-					f"	{node.output._variable}.voices[0] = ({node.in0._variable}.voices[0] {op} {node.in1._variable}.voices[0]) * 1",
-					f"elif list({node.in0._variable}.voices) == [0]:",
-					f"	for {voice_id} in {node.in1._variable}.voices:",
-					f"		{node.output._variable}.voices[{voice_id}] = ({node.in0._variable}.voices[0] {op} {node.in1._variable}.voices[{voice_id}]) * 1",
-					f"elif list({node.in1._variable}.voices) == [0]:",
-					f"	for {voice_id} in {node.in0._variable}.voices:",
-					f"		{node.output._variable}.voices[{voice_id}] = ({node.in0._variable}.voices[{voice_id}] {op} {node.in1._variable}.voices[0]) * 1",
-					f"else:",
-					f"	assert 0 not in {node.in0._variable}.voices",
-					f"	assert 0 not in {node.in1._variable}.voices",
-					f"	for {voice_id} in set({node.in0._variable}.voices).union({node.in1._variable}.voices):",
-					f"		{node.output._variable}.voices[{voice_id}] = ({node.in0._variable}.voices.get({voice_id}, _SILENCE) {op} {node.in1._variable}.voices.get({voice_id}, _SILENCE)) * 1",
-				]
-			)
-
-			# Remove voices that are extinct
-			process_code.extend(
-				[
-					f"for {voice_id} in set({node.output._variable}.voices) - (set({node.in0._variable}.voices) | set({node.in1._variable}.voices)):",
-					f"	{node.output._variable}.voices.pop({voice_id})",
-				]
-			)
-
-		else:
-			unsupported(node)
-
-	elif isinstance(node.in0, (int, float)) and isinstance(node.in1, Outlet):
-		init_code.append(f"{node.output._variable} = Signal()")
-		if node.in1.datatype == DataType.SIGNAL:
-			process_code.extend(
-				[
-					f"for {voice_id} in {node.in1._variable}.voices:",
-					f"	{node.output._variable}.voices[{voice_id}] = ({node.in0} {op} {node.in1._variable}.voices.get({voice_id}, _SILENCE)) * 1",
-				]
-			)
-
-			# Remove voices that are extinct
-			process_code.extend(
-				[
-					f"for {voice_id} in set({node.output._variable}.voices) - set({node.in1._variable}.voices):",
-					f"	{node.output._variable}.voices.pop({voice_id})",
-				]
-			)
-		else:
-			unsupported(node)
+		init_code.append(f"{node.output._variable} = constant_signal({eval('node.in0'+op+'node.in1')})")
+	elif all(
+		isinstance(x, (int, float)) or (isinstance(x, Outlet) and x.datatype == DataType.SIGNAL)
+		for x in (node.in0, node.in1)
+	):
+		# All voices in one call. See binary() for how the voices of the inputs are combined
+		in0 = node.in0._variable if isinstance(node.in0, Outlet) else repr(node.in0)
+		in1 = node.in1._variable if isinstance(node.in1, Outlet) else repr(node.in1)
 
-	elif isinstance(node.in0, Outlet) and isinstance(node.in1, (int, float)):
 		init_code.append(f"{node.output._variable} = Signal()")
-		if node.in0.datatype == DataType.SIGNAL:
-			process_code.extend(
-				[
-					f"for {voice_id} in {node.in0._variable}.voices:",
-					f"	{node.output._variable}.voices[{voice_id}] = ({node.in0._variable}.voices.get({voice_id}, _SILENCE) {op} {node.in1}) * 1",
-				]
-			)
-
-			# Remove voices that are extinct
-			process_code.extend(
-				[
-					f"for {voice_id} in set({node.output._variable}.voices) - set({node.in0._variable}.voices):",
-					f"	{node.output._variable}.voices.pop({voice_id})",
-				]
-			)
-		else:
-			unsupported(node)
+		process_code.append(f"binary({ufunc}, {in0}, {in1}, {node.output._variable})")
 
 	else:
 		unsupported(node)
@@ -525,61 +522,45 @@ def numpy_mix(
 	init_code: list[str],
 	process_code: list[str],
 ) -> None:
-	in0_voices = create_variable()
-	in1_voices = create_variable()
+	voice_ids = create_variable()
+	in0 = create_variable()
+	in1 = create_variable()
 
 	# TODO merayen how should we mix channel_map if in0 and in1 has different maps
 	init_code.append(f"{node.output._variable} = Signal()")
 
-	if isinstance(node.in0, Outlet):
-		process_code.append(f"{in0_voices} = set({node.in0._variable}.voices)")
-	if isinstance(node.in1, Outlet):
-		process_code.append(f"{in1_voices} = set({node.in1._variable}.voices)")
-
+	# All voices are calculated at once, as matrices with a row for each voice in voice_ids
 	if isinstance(node.in0, Outlet) and isinstance(node.in1, Outlet):
-		process_code.append(f"for voice_id in {in0_voices}.intersection({in1_voices}):")
-	elif isinstance(node.in0, Outlet):
-		process_code.append(f"for voice_id in {in0_voices}:")
-	elif isinstance(node.in1, Outlet):
-		process_code.append(f"for voice_id in {in1_voices}:")
+		# Only the voices that are on both inputs
+		process_code.append(f"{voice_ids}, {in0} = voice_rows({node.in0._variable})")
+		process_code.append(f"if {voice_ids} != voice_rows({node.in1._variable})[0]:")
+		process_code.append(f"	{voice_ids} = [x for x in {voice_ids} if x in {node.in1._variable}.voices]")
+		process_code.append(f"	{in0} = rows_for({node.in0._variable}, {voice_ids}, None)")
+		process_code.append(f"{in1} = rows_for({node.in1._variable}, {voice_ids}, None)")
+	elif isinstance(node.in0, Outlet) and isinstance(node.in1, (int, float)):
+		process_code.append(f"{voice_ids}, {in0} = voice_rows({node.in0._variable})")
+		process_code.append(f"{in1} = {node.in1!r}")
+	elif isinstance(node.in1, Outlet) and isinstance(node.in0, (int, float)):
+		process_code.append(f"{voice_ids}, {in1} = voice_rows({node.in1._variable})")
+		process_code.append(f"{in0} = {node.in0!r}")
+	elif isinstance(node.in0, (int, float)) and isinstance(node.in1, (int, float)):
+		process_code.append(f"{voice_ids}, {in0}, {in1} = [0], {node.in0!r}, {node.in1!r}")
 	else:
-		process_code.append("for voice_id in [0]:")
-	process_code.append(f"	{node.output._variable}.voices[voice_id] = (")
+		unsupported(node)
 
 	if isinstance(node.fac, (int, float)):
 		fac = (max(min(node.fac, 1), -1) + 1) / 2
 	elif isinstance(node.fac, Outlet):
-		fac = f"{node.fac._variable}.voices[voice_id]"
-	else:
-		unsupported(node)
-
-	if isinstance(node.in0, Outlet):
-		process_code.append(f"		{node.in0._variable}.voices[voice_id] * (1-{fac}) +")
-	elif isinstance(node.in0, (int, float)):
-		process_code.append(f"		{node.in0} * (1-{fac}) +")
+		fac = f"rows_for({node.fac._variable}, {voice_ids}, None)"
 	else:
 		unsupported(node)
 
-	if isinstance(node.in1, Outlet):
-		process_code.append(f"		{node.in1._variable}.voices[voice_id] * {fac}")
-	elif isinstance(node.in0, (int, float)):
-		process_code.append(f"		{node.in1} * {fac}")
-	else:
-		unsupported(node)
-
-	process_code.append("	)")
-
-	# Remove voices that are extinct
-	if isinstance(node.in0, Outlet) and isinstance(node.in1, Outlet):
-		process_code.append(f"for voice_id in set({node.output._variable}.voices) - {in0_voices} - {in1_voices}:")
-	elif isinstance(node.in0, Outlet):
-		process_code.append(f"for voice_id in set({node.output._variable}.voices) - {in0_voices}:")
-	elif isinstance(node.in1, Outlet):
-		process_code.append(f"for voice_id in set({node.output._variable}.voices) - {in1_voices}:")
-	else:
-		# lol code
-		process_code.append("if 0:")
-	process_code.append(f"	{node.output._variable}.voices.pop(voice_id)")
+	# in0 * (1 - fac) + in1 * fac, as in0 + (in1 - in0) * fac
+	buffer = create_variable()
+	process_code.append(f"{buffer} = {node.output._variable}.align({voice_ids})")
+	process_code.append(f"np.subtract({in1}, {in0}, out={buffer})")
+	process_code.append(f"np.multiply({buffer}, {fac}, out={buffer})")
+	process_code.append(f"np.add({buffer}, {in0}, out={buffer})")
 
 
 def numpy_downmix(
@@ -588,18 +569,14 @@ def numpy_downmix(
 	init_code: list[str],
 	process_code: list[str],
 ) -> None:
-	init_code.append(f"{node.output._variable} = Signal(voices={{0:np.zeros({module_context.frame_count})}})")
+	init_code.append(f"{node.output._variable} = constant_signal(0)")
 
 	if node.input is None:
 		return
 
 	elif isinstance(node.input, Outlet) and node.input.datatype == DataType.SIGNAL:
 		# TODO merayen downmix to channels instead, allowing channel-voice labelling for channel routing
-		voice_id = create_variable()
-		voice = create_variable()
-		process_code.append(f"{node.output._variable}.voices[0] = _SILENCE * 1")
-		process_code.append(f"for {voice_id}, {voice} in {node.input._variable}.voices.items():")
-		process_code.append(f"	{node.output._variable}.voices[0] += {voice}")
+		process_code.append(f"np.sum(voice_rows({node.input._variable})[1], axis=0, keepdims=True, out={node.output._variable}.align([0]))")
 	else:
 		unsupported(node)
 
@@ -622,65 +599,57 @@ def numpy_trigger(
 	current_value = create_variable()
 
 	init_code.append(f"{node.output._variable} = Signal()")
-	init_code.append(f"{current_value} = defaultdict(lambda: 0.0)")
+	init_code.append(f"{current_value} = Signal(width=1, dtype='float64')")  # Current output of each voice
 
+	# Rows are voices. on and off may have a single row, that is then used for all voices
 	method = introduce(
-		init_code,
+		module_context,
 		[
 			"import numba",
 			"@numba.njit",
 			"def UNIQUE_NAME(current, input_array, output_array, start_array, stop_array):",
-			"	assert len(input_array) == len(output_array) == len(start_array) == len(stop_array)",
+			"	assert input_array.shape == output_array.shape",
+			"	assert start_array.shape[1] == stop_array.shape[1] == input_array.shape[1]",
 			"",
-			"	for i in range(len(input_array)):",
-			"		if input_array[i] >= start_array[i]:",
-			"			current = 1.0",
-			"		elif input_array[i] < stop_array[i]:",
-			"			current = 0.0",
-			"		output_array[i] = current",
-			"	return current",
+			"	for voice in range(input_array.shape[0]):",
+			"		value = current[voice, 0]",
+			"		start = start_array[min(voice, len(start_array) - 1)]",
+			"		stop = stop_array[min(voice, len(stop_array) - 1)]",
+			"		for i in range(input_array.shape[1]):",
+			"			if input_array[voice, i] >= start[i]:",
+			"				value = 1.0",
+			"			elif input_array[voice, i] < stop[i]:",
+			"				value = 0.0",
+			"			output_array[voice, i] = value",
+			"		current[voice, 0] = value",
 		]
 	)
 
 	if isinstance(node.value, Outlet):
-		if isinstance(node.on, (int, float)):
-			on = create_variable()
-			init_code.append(f"{on} = np.zeros({module_context.frame_count}) + {node.on}")
-
-		if isinstance(node.off, (int, float)):
-			off = create_variable()
-			init_code.append(f"{off} = np.zeros({module_context.frame_count}) + {node.off}")
-
-		process_code.append(f"for voice_id, voice in {node.value._variable}.voices.items():")
-		process_code.append(f"	if voice_id not in {node.output._variable}.voices:")
-		process_code.append(f"		{node.output._variable}.voices[voice_id] = np.zeros({module_context.frame_count})")
-		process_code.append(f"	{current_value}[voice_id] = {method}(")
-		process_code.append(f"		{current_value}[voice_id],")
-		process_code.append("		voice,")
-		process_code.append(f"		{node.output._variable}.voices[voice_id],")
+		voice_ids = create_variable()
+		voices = create_variable()
 
 		if isinstance(node.on, (int, float)):
-			process_code.append(f"		{on},")
+			on = create_variable()
+			init_code.append(f"{on} = np.zeros((1, {module_context.frame_count}), dtype='float32') + {node.on}")
 		elif isinstance(node.on, Outlet):
-			process_code.append(f"		{node.on._variable}.voices[voice_id],")
+			on = f"rows_for({node.on._variable}, {voice_ids}, None)"
 		else:
 			unsupported(node)
 
 		if isinstance(node.off, (int, float)):
-			process_code.append(f"		{off},")
+			off = create_variable()
+			init_code.append(f"{off} = np.zeros((1, {module_context.frame_count}), dtype='float32') + {node.off}")
 		elif isinstance(node.off, Outlet):
-			process_code.append(f"		{node.off._variable}.voices[voice_id],")
+			off = f"rows_for({node.off._variable}, {voice_ids}, None)"
 		else:
 			unsupported(node)
 
-		process_code.append(")")
-
-		# Remove voices that has disappeared
-		process_code.extend(
-			[
-				f"for voice_id in set({node.output._variable}.voices) - set({node.value._variable}.voices):",
-				f"	{node.output._variable}.voices.pop(voice_id)",
-			]
+		process_code.append(f"{voice_ids}, {voices} = voice_rows({node.value._variable})")
+		process_code.append(f"{current_value}.align({voice_ids})")
+		process_code.append(f"if {current_value}.new: {current_value}.matrix[{current_value}.new] = 0")
+		process_code.append(
+			f"{method}({current_value}.matrix, {voices}, {node.output._variable}.align({voice_ids}), {on}, {off})"
 		)
 
 	else:
@@ -697,20 +666,38 @@ def numpy_clip(
 
 	if isinstance(node.value, Outlet):
 		if isinstance(node.minimum, (int, float)) and isinstance(node.maximum, (int, float)):
-			process_code.append(f"for voice_id, voice in {node.value._variable}.voices.items():")
-			process_code.append(f"	{node.output._variable}.voices[voice_id] = np.clip(voice, {node.minimum}, {node.maximum})")
+			voice_ids = create_variable()
+			voices = create_variable()
+			process_code.append(f"{voice_ids}, {voices} = voice_rows({node.value._variable})")
+			process_code.append(f"np.clip({voices}, {node.minimum}, {node.maximum}, out={node.output._variable}.align({voice_ids}))")
 		else:
 			unsupported(node)
 	else:
 		unsupported(node)
 
-	# Remove voices that has disappeared
-	process_code.extend(
-		[
-			f"for voice_id in set({node.output._variable}.voices) - set({node.value._variable}.voices):",
-			f"	{node.output._variable}.voices.pop(voice_id)",
-		]
-	)
+
+def numpy_dB(
+	module_context: ModuleContext,
+	node: Node,
+	init_code: list[str],
+	process_code: list[str],
+) -> None:
+	if isinstance(node.decibel, (int, float)):
+		init_code.append(f"{node.output._variable} = constant_signal({10 ** (node.decibel / 20)})")
+
+	elif isinstance(node.decibel, Outlet) and node.decibel.datatype == DataType.SIGNAL:
+		init_code.append(f"{node.output._variable} = Signal()")
+
+		voice_ids = create_variable()
+		voices = create_variable()
+		buffer = create_variable()
+		process_code.append(f"{voice_ids}, {voices} = voice_rows({node.decibel._variable})")
+		process_code.append(f"{buffer} = {node.output._variable}.align({voice_ids})")
+		process_code.append(f"np.divide({voices}, 20, out={buffer})")
+		process_code.append(f"np.power(10.0, {buffer}, out={buffer})")
+
+	else:
+		unsupported(node)
 
 
 def numpy_frequency(
@@ -720,30 +707,38 @@ def numpy_frequency(
 	process_code: list[str],
 ) -> None:
 	if not node.input:
-		init_code.append(f"{node.output._variable} = Signal(voices={{0: _ONES*440}})")
+		init_code.append(f"{node.output._variable} = constant_signal(440)")
 	elif isinstance(node.input, (int, float)):
-		init_code.append(f"{node.output._variable} = Signal(voices={{0: _ONES*{node.input}}})")
+		init_code.append(f"{node.output._variable} = constant_signal({node.input})")
 	elif isinstance(node.input, Outlet) and node.input.datatype == DataType.MIDI:
 		voice_id = create_variable()
 		voice = create_variable()
 		frame = create_variable()
 		byte = create_variable()
 		packet = create_variable()
+		frequencies = create_variable()
+		rows = create_variable()
+		row = create_variable()
 
 		init_code.append(f"{node.output._variable} = Signal()")
 		init_code.append(f"{packet} = {{}}")
+		init_code.append(f"{frequencies} = {{}}")  # Voice id -> frequency of the last key down
 		process_code.append(f"for {voice_id}, {voice} in {node.input._variable}.voices.items():")
 		process_code.append(f"	for {frame}, {byte} in {voice}:")
 		process_code.append(f"		if {byte} & 128: {packet}[{voice_id}] = [{byte}]")  # Command
 		process_code.append(f"		elif {packet}.get({voice_id}): {packet}[{voice_id}].append({byte})")  # Data
 		process_code.append(f"		if len({packet}[{voice_id}]) == 3:")  # Datas with 3 packets
 		process_code.append(f"			if {packet}[{voice_id}][0] == 144:")  # Key down
-		process_code.append(f"				{node.output._variable}.voices[{voice_id}] = 440 * 2**(({packet}[{voice_id}][1] - 69) / 12)")
+		process_code.append(f"				{frequencies}[{voice_id}] = 440 * 2**(({packet}[{voice_id}][1] - 69) / 12)")
 
 		# Remove any voices that had "key up" event on last cycle
-		process_code.append(f"for {voice_id} in list({node.output._variable}.voices):")
-		process_code.append(f"	if {voice_id} not in {node.input._variable}.voices:")
-		process_code.append(f"		{node.output._variable}.voices.pop({voice_id})")
+		process_code.append(f"for {voice_id} in [x for x in {frequencies} if x not in {node.input._variable}.voices]:")
+		process_code.append(f"	{frequencies}.pop({voice_id})")
+
+		# The rows of the voices are filled in place, every block, as a key down can change them
+		process_code.append(f"{rows} = {node.output._variable}.align([x for x in {node.input._variable}.voices if x in {frequencies}])")
+		process_code.append(f"for {row}, {voice_id} in enumerate({node.output._variable}.ids):")
+		process_code.append(f"	{rows}[{row}].fill({frequencies}[{voice_id}])")
 	else:
 		unsupported(node)
 
@@ -755,7 +750,7 @@ def numpy_one(
 	process_code: list[str],
 ) -> None:
 	if node.input is None or isinstance(node.input, (int, float)):
-		init_code.append(f"{node.output._variable} = Signal(voices={{0: _ONES}})")
+		init_code.append(f"{node.output._variable} = constant_signal(1)")
 
 	elif isinstance(node.input, Outlet):
 		voice_id = create_variable()
@@ -853,8 +848,7 @@ def numpy_unison(
 		node.output.datatype = DataType.SIGNAL
 		init_code.append(f"{node.output._variable} = Signal()")
 		if isinstance(node.voices, int):
-			init_code.append(f"for _ in range({node.voices}):")
-			init_code.append(f"	{node.output._variable}.voices[create_voice()] = _ONES * {node.input}")
+			init_code.append(f"{node.output._variable}.align([create_voice() for _ in range({node.voices})]).fill({node.input})")
 		else:
 			unsupported(node)
 
@@ -867,7 +861,35 @@ def numpy_unison(
 		else:
 			init_code.append(f"{node.output._variable} = Midi()")
 
-		if isinstance(node.voices, int):
+		if isinstance(node.voices, int) and node.input.datatype == DataType.SIGNAL:
+			# Each voice of the input is copied to its voices, as rows of the output, in one call
+			voice_map = create_variable()
+			input_ids = create_variable()
+			output_ids = create_variable()
+			rows = create_variable()
+			voice_ids = create_variable()
+			voices = create_variable()
+			voice_id = create_variable()
+
+			init_code.append(f"{voice_map} = {{}}")  # Input voice id -> its voice ids
+			init_code.append(f"{input_ids} = None")
+			init_code.append(f"{output_ids} = []")
+			init_code.append(f"{rows} = np.zeros(0, dtype=int)")  # Row of the input for each row of the output
+
+			process_code.append(f"global {input_ids}, {output_ids}, {rows}")
+			process_code.append(f"{voice_ids}, {voices} = voice_rows({node.input._variable})")
+			process_code.append(f"if {voice_ids} != {input_ids}:")
+			process_code.append(f"	{input_ids} = {voice_ids}")
+			process_code.append(f"	for {voice_id} in set({voice_map}) - set({voice_ids}):")
+			process_code.append(f"		{voice_map}.pop({voice_id})")
+			process_code.append(f"	for {voice_id} in {voice_ids}:")
+			process_code.append(f"		if {voice_id} not in {voice_map}:")
+			process_code.append(f"			{voice_map}[{voice_id}] = [create_voice() for _ in range({node.voices})]")
+			process_code.append(f"	{output_ids} = [x for {voice_id} in {voice_ids} for x in {voice_map}[{voice_id}]]")
+			process_code.append(f"	{rows} = np.repeat(np.arange(len({voice_ids})), {node.voices})")
+			process_code.append(f"np.take({voices}, {rows}, axis=0, out={node.output._variable}.align({output_ids}))")
+
+		elif isinstance(node.voices, int):
 			# Create new, incoming voices
 			voice_map = create_variable()
 			init_code.append(f"{voice_map} = {{}}")
@@ -922,35 +944,67 @@ def numpy_spawn(
 		return
 
 	if isinstance(node.input, Outlet) and node.input.datatype == DataType.SIGNAL:
+		# A voice for every time the input goes above 0, that is 1 until it goes to 0 or below again.
+		# The edges of the block are found first, so the voices of the output are aligned once
 		x = create_variable()
 		i = create_variable()
 		triggering = create_variable()
-		ending = create_variable()
-		voice_id = create_variable()
+		was_triggering = create_variable()
+		starts = create_variable()
+		ends = create_variable()
+		kept = create_variable()
+		new = create_variable()
+		rows = create_variable()
+		row = create_variable()
+		end = create_variable()
 		voices_to_end = create_variable()
-		init_code.append(f"{node.output._variable} = Signal()")
+		output = node.output._variable
+		frame_count = module_context.frame_count
+		init_code.append(f"{output} = Signal()")
 		init_code.append(f"{voices_to_end} = []")
 		init_code.append(f"{triggering} = 0")
-		process_code.append(f"global {triggering}")
-		process_code.append(f"for {voice_id} in {voices_to_end}:")
-		process_code.append(f"	{node.output._variable}.voices.pop({voice_id})")
-		process_code.append(f"{voices_to_end}.clear()")
-		process_code.append(f"if 0 in {node.input._variable}.voices:")
-		process_code.append(f"	if {triggering}:")
-		process_code.append(f"		for {voice_id} in {node.output._variable}.voices:")
-		process_code.append(f"			{node.output._variable}.voices[{voice_id}] = _ONES")
-		process_code.append(f"	for {i},{x} in enumerate({node.input._variable}.voices[0]):")  # XXX numba it?
-		process_code.append(f"		if {x} > 0:")
-		process_code.append(f"			if not {triggering}:")
-		process_code.append(f"				{node.output._variable}.voices[create_voice()] = np.concatenate((_SILENCE[:{i}], _ONES[{i}:]))")  # TODO merayen timing
-		process_code.append(f"				{triggering} = 1")
-		process_code.append(f"		elif {triggering}:")
-		process_code.append(f"			{triggering} = 0")
-		process_code.append(f"			{ending} = np.concatenate((_ONES[:{i}], _SILENCE[{i}:]))")
-		process_code.append(f"			for {voice_id} in {node.output._variable}.voices:")
-		process_code.append(f"				if {voice_id} not in {voices_to_end}:")
-		process_code.append(f"					{node.output._variable}.voices[{voice_id}] = {ending}")
-		process_code.append(f"					{voices_to_end}.append({voice_id})")
+		init_code.append(f"{starts} = []")  # Offsets of the voices started in this block
+		init_code.append(f"{ends} = []")  # Offsets where the input went to 0 or below
+		process_code.extend(
+			[
+				f"global {triggering}",
+				f"{was_triggering} = {triggering}",
+				f"{starts}.clear()",
+				f"{ends}.clear()",
+				f"if 0 in {node.input._variable}.voices:",
+				f"	for {i}, {x} in enumerate({node.input._variable}.voices[0]):",  # XXX numba it?
+				f"		if {x} > 0:",
+				f"			if not {triggering}:",
+				f"				{starts}.append({i})",  # TODO merayen timing
+				f"				{triggering} = 1",
+				f"		elif {triggering}:",
+				f"			{ends}.append({i})",
+				f"			{triggering} = 0",
+
+				# Voices that ended in the previous block go away
+				f"{kept} = [x for x in {output}.ids if x not in {voices_to_end}]",
+				f"{voices_to_end}.clear()",
+				f"{new} = [create_voice() for _ in {starts}]",
+				f"{rows} = {output}.align({kept} + {new})",
+
+				# The voice that was playing, until the first end
+				f"if {was_triggering} and 0 in {node.input._variable}.voices:",
+				f"	{end} = {ends}[0] if {ends} else {frame_count}",
+				f"	{rows}[:len({kept}), :{end}] = 1",
+				f"	{rows}[:len({kept}), {end}:] = 0",
+				f"	if {ends}:",
+				f"		{voices_to_end}.extend({kept})",
+
+				# Starts and ends take turns, so the end of each new voice is the next one
+				f"for {row}, {i} in enumerate({starts}):",
+				f"	{end} = {ends}[{row} + {was_triggering}] if {row} + {was_triggering} < len({ends}) else {frame_count}",
+				f"	{rows}[len({kept}) + {row}, :{i}] = 0",
+				f"	{rows}[len({kept}) + {row}, {i}:{end}] = 1",
+				f"	{rows}[len({kept}) + {row}, {end}:] = 0",
+				f"	if {end} < {frame_count}:",
+				f"		{voices_to_end}.append({new}[{row}])",
+			]
+		)
 	else:
 		unsupported(node)
 
@@ -1070,37 +1124,39 @@ def numpy_time(
 	process_code: list[str],
 ) -> None:
 
+	# Seconds from the start of the block to each sample. The seconds played are counted in float64,
+	# and only the output is float32
+	ramp = create_variable()
+	init_code.append(
+		f"{ramp} = (np.arange(1, {module_context.frame_count + 1}) / {module_context.sample_rate}).astype('float32')"
+	)
+
 	if isinstance(node.voice_trigger, Outlet):
 		# Note that we do not care what type of input we are given. We are only reading the time.
 		sample_clocks = create_variable()
-		voice_id = create_variable()
+		voice_ids = create_variable()
 
-		init_code.append(f"{sample_clocks} = {{}}")
+		init_code.append(f"{sample_clocks} = Signal(width=1, dtype='float64')")  # Seconds played of each voice
 		init_code.append(f"{node.output._variable} = Signal()")
 
-		process_code.append(f"for {voice_id} in {node.voice_trigger._variable}.voices:")
-		process_code.append(f"	if {voice_id} not in {sample_clocks}:")
-		process_code.append(f"		{sample_clocks}[{voice_id}] = 0")
+		process_code.append(f"{voice_ids} = list({node.voice_trigger._variable}.voices)")
+		process_code.append(f"{sample_clocks}.align({voice_ids})")
+		process_code.append(f"if {sample_clocks}.new: {sample_clocks}.matrix[{sample_clocks}.new] = 0")
 		process_code.append(
-			f"	{node.output._variable}.voices[{voice_id}] = "
-			f"	{sample_clocks}[{voice_id}] / {module_context.sample_rate} + np.cumsum(_ONES / {module_context.sample_rate})"
+			f"np.add({ramp}, {sample_clocks}.matrix.astype('float32'), out={node.output._variable}.align({voice_ids}))"
+		)
+		process_code.append(
+			f"np.add({sample_clocks}.matrix, {module_context.frame_count / module_context.sample_rate!r}, out={sample_clocks}.matrix)"
 		)
-		process_code.append(f"	{sample_clocks}[{voice_id}] += {module_context.frame_count}")
-
-		# Remove voices that has disappeared on the input
-		process_code.append(f"for {voice_id} in list({node.output._variable}.voices):")
-		process_code.append(f"	if {voice_id} not in {node.voice_trigger._variable}.voices:")
-		process_code.append(f"		{node.output._variable}.voices.pop({voice_id})")
 
 	elif not node.voice_trigger:
 		sample_clock = create_variable()
 		init_code.append(f"{sample_clock} = 0")
-		init_code.append(f"{node.output._variable} = Signal(voices={{0:np.zeros({module_context.frame_count})}})")
+		init_code.append(f"{node.output._variable} = Signal()")
 
 		process_code.append(f"global {sample_clock}")
 		process_code.append(
-			f"{node.output._variable}.voices[0] = "
-			f"{sample_clock} / {module_context.sample_rate} + np.cumsum(_ONES / {module_context.sample_rate})"
+			f"np.add({ramp}, {sample_clock} / {module_context.sample_rate}, out={node.output._variable}.align([0]))"
 		)
 		process_code.append(f"{sample_clock} += {module_context.frame_count}")
 	else:
@@ -1142,30 +1198,23 @@ def numpy_audiofile(
 			else:
 				init_code.append(f"assert {audio_sample_count} == len({audio_data}[{channel_index}])")
 
+		# Channels as rows, so that all of them are copied to the output in one go
+		init_code.append(f"{audio_data} = np.stack(list({audio_data}.values()))")
+
 		process_code.append(f"global {playback_position}")
 
 		# If we are done playing, clear all output voices
 		process_code.append(f"if {playback_position}+1 >= {audio_sample_count}:")
-		process_code.append(f"	{node.output._variable}.voices.clear()")
+		process_code.append(f"	{node.output._variable}.align([])")
 		process_code.append("else:")
-		process_code.append("	pass")
-
-		# Output each channel to its own voice
-		# XXX Maybe we could do this more effective using numpy directly...?
-		for channel_index in node.channel_paths:
-			process_code.append(
-				f"	{node.output._variable}.voices[{channel_index}] = "
-				f"{audio_data}[{channel_index}][{playback_position}:{playback_position}+{module_context.frame_count}]"
-			)
 
-			# When at the end of the audio signal, pad with silence
-			process_code.extend(
-				[
-					f"	if len({node.output._variable}.voices[{channel_index}]) != {module_context.frame_count}:",
-					f"		{node.output._variable}.voices[{channel_index}] = "
-					f"np.pad({node.output._variable}.voices[{channel_index}], pad_width=(0,{module_context.frame_count}-len({node.output._variable}.voices[{channel_index}])))",
-				]
-			)
+		# Output each channel to its own voice. When at the end of the audio signal, pad with silence
+		rows = create_variable()
+		remaining = create_variable()
+		process_code.append(f"	{rows} = {node.output._variable}.align({list(node.channel_paths)})")
+		process_code.append(f"	{remaining} = min({audio_sample_count} - {playback_position}, {module_context.frame_count})")
+		process_code.append(f"	{rows}[:, :{remaining}] = {audio_data}[:, {playback_position}:{playback_position}+{remaining}]")
+		process_code.append(f"	{rows}[:, {remaining}:] = 0")
 
 		# Increase the playback position, if not at the end already
 		process_code.append(f"	{playback_position} += {module_context.frame_count}")
@@ -1216,7 +1265,7 @@ def numpy_oscilloscope(
 			process_code.append(f"	{trigger_high}[voice_id] = {2**63-1}")
 			process_code.append(f"	{trigger_low}[voice_id] = {2**63-1}")
 			process_code.append(f"	{samples_filled}[voice_id] = {2**63-1}")
-			process_code.append(f"	{buffer}[voice_id] = np.zeros({buffer_size})")
+			process_code.append(f"	{buffer}[voice_id] = np.zeros({buffer_size}, dtype='float32')")
 		else:
 			unsupported(node)
 
@@ -1228,7 +1277,7 @@ def numpy_oscilloscope(
 		process_code.append(f"	{trigger_high}.pop(voice_id)")
 		process_code.append(f"	{trigger_low}.pop(voice_id)")
 		process_code.append(f"	{samples_filled}.pop(voice_id)")
-		process_code.append("	" + emit_data(node, "{'voice_id': voice_id, 'samples': []}"))
+		process_code.append("	" + emit_samples(node, "voice_id", "_SILENCE[:0]"))
 
 		# Scan for trigger points. First low point, then high point.
 		# Scans each voice's buffer for trigger points.
@@ -1292,9 +1341,7 @@ def numpy_oscilloscope(
 		if isinstance(node.time_div, (int, float)):
 			process_code.append(f"for voice_id, samples in {buffer}.items():")
 			process_code.append(f"	if {samples_filled}[voice_id] < {buffer_size}: continue")
-			process_code.append(
-				"	" + emit_data(node, "{'voice_id': voice_id, 'samples': samples.tolist() }")
-			)
+			process_code.append("	" + emit_samples(node, "voice_id", "samples"))
 			process_code.append(f"	{samples_filled}[voice_id] = 0")
 			process_code.append(f"	{clock}[voice_id] = 0")
 			process_code.append(f"	{waiting_period}[voice_id] = {clock}[voice_id] + {round(module_context.sample_rate * (1/fps) - buffer_size)}")
@@ -1316,15 +1363,10 @@ def numpy_out(module_context: ModuleContext, node: out, init_code: list[str], pr
 	assert "'" not in node.name
 
 	if isinstance(node.input, (int, float)):
-		voice_id_variable = create_variable()
-		init_code.append(f"{voice_id_variable} = create_voice()")
-		process_code.extend(
-			[
-				f"output['{node.name}'] = Signal(",
-				f"	voices=np.zeros({module_context.frame_count}, dtype='float32') + {node.input}",
-				")",
-			]
-		)
+		# Constant, e.g after the optimizer has folded the whole input
+		signal = create_variable()
+		init_code.append(f"{signal} = constant_signal({node.input})")
+		process_code.append(f"output['{node.name}'] = {signal}")
 
 	elif isinstance(node.input, Outlet):
 		process_code.extend(
@@ -1336,109 +1378,871 @@ def numpy_out(module_context: ModuleContext, node: out, init_code: list[str], pr
 		raise NotImplementedError("Support other types of input")  # TODO merayen support other types of input for out.input
 
 
+def _fusible(node: Node) -> bool:
+	"""
+	If the node is elementwise math that can be part of a fused expression
+	"""
+	from aim.nodes import add, sub, mul, div, gt, lt, mix, clip, dB
+
+	def inputs(*values: Any) -> bool:
+		return all(isinstance(x, (Outlet, int, float)) for x in values) and any(isinstance(x, Outlet) for x in values)
+
+	if isinstance(node, (add, sub, mul, div, gt, lt)):
+		return inputs(node.in0, node.in1)
+
+	if isinstance(node, mix):
+		return inputs(node.in0, node.in1) and isinstance(node.fac, (Outlet, int, float))
+
+	if isinstance(node, clip):
+		return isinstance(node.value, Outlet) and isinstance(node.minimum, (int, float)) and isinstance(node.maximum, (int, float))
+
+	if isinstance(node, dB):
+		return isinstance(node.decibel, Outlet)
+
+	return False
+
+
+MAX_FUSION_DEPTH = 64
+
+SEGMENT_SIZE = 64  # Nodes in a chunk of the program on average, see IncrementalCompiler
+
+
+def _find_fusions(
+	compilation_context: CompilationContext,
+	digests: Optional[dict[int, str]] = None,
+	previous: Optional[dict[tuple, tuple[bool, bool]]] = None,
+	known: Optional[dict[tuple, tuple[bool, bool]]] = None,
+) -> dict[int, list[Node]]:
+	"""
+	Find the chains of elementwise math that can be calculated as one expression
+
+	A fusible node is inlined into the node using it, if that is its only user and is fusible
+	itself. Returns the nodes that have other nodes inlined, with the inlined nodes in execution
+	order. The inlined nodes are also keys, with an empty list.
+
+	Expressions are at most MAX_FUSION_DEPTH nodes deep, as numpy_fused() generates them
+	recursively. Longer chains are split into several expressions.
+
+	If digests of the nodes are given, see _node_digest(), whether a node is fusible and can be
+	inlined is looked up in previous, by the digest of the node and of the nodes using it. Only the
+	nodes that changed, and the nodes they use, are then looked at again. The decisions of this
+	compile are added to known.
+	"""
+	node_ids = compilation_context.node_ids
+	previous = previous if previous is not None else {}
+	known = known if known is not None else {}
+
+	users: dict[int, list[int]] = {}
+	for node_id in compilation_context.order:
+		for value in node_ids[node_id]._inlets.values():
+			if isinstance(value, Outlet):
+				users.setdefault(id(value.node), []).append(node_id)
+
+	fusible: set[int] = set()
+	inlined: set[int] = set()
+	for node_id in compilation_context.order:
+		user_ids = users.get(node_id, [])
+		key = digests and (digests[node_id], *(digests[x] for x in user_ids))
+
+		if (decision := key and (known.get(key) or previous.get(key))) is None:
+			decision = (
+				_fusible(node_ids[node_id]),
+				len(user_ids) == 1 and _fusible(node_ids[node_id]) and _fusible(node_ids[user_ids[0]]),
+			)
+
+		if key:
+			known[key] = decision
+
+		if decision[0]:
+			fusible.add(node_id)
+		if decision[1]:
+			inlined.add(node_id)
+
+	depth: dict[int, int] = {}  # Of the expression ending in the node
+	for node_id in compilation_context.order:
+		if node_id in inlined:
+			depth[node_id] = 1 + max(
+				(
+					depth[id(value.node)]
+					for value in node_ids[node_id]._inlets.values()
+					if isinstance(value, Outlet) and id(value.node) in inlined
+				),
+				default=0,
+			)
+
+			if depth[node_id] >= MAX_FUSION_DEPTH:
+				inlined.remove(node_id)
+
+	position = {x: i for i, x in enumerate(compilation_context.order)}
+
+	result: dict[int, list[Node]] = {}
+	for node_id in compilation_context.order:
+		if node_id in inlined:
+			result[node_id] = []
+		elif node_id in fusible:
+			members = []
+			remaining = [node_id]
+			while remaining:
+				for value in node_ids[remaining.pop()]._inlets.values():
+					if isinstance(value, Outlet) and id(value.node) in inlined:
+						members.append(id(value.node))
+						remaining.append(id(value.node))
+
+			if members:
+				result[node_id] = [node_ids[x] for x in sorted(members, key=position.get)]
+
+	return result
+
+
+def numpy_inlined(
+	module_context: ModuleContext,
+	node: Node,
+	init_code: list[str],
+	process_code: list[str],
+) -> None:
+	"""
+	The node is calculated as part of the expression of the node using it, see numpy_fused()
+	"""
+
+
+def numpy_fused(
+	module_context: ModuleContext,
+	node: Node,
+	init_code: list[str],
+	process_code: list[str],
+	members: list[Node],
+) -> None:
+	"""
+	Calculate the node and the nodes inlined into it as one expression for all voices
+
+	The expression works on the matrices of the voices, see Signal.align(), and is written into the
+	matrix of the output with out=, using scratch matrices that are only reallocated when the voices
+	change. The voices of the inputs decide the voices of the output, as if
+	the nodes ran one by one. When the voices of the inputs do not line up (e.g different voices on
+	in0 and in1), that code is run instead.
+	"""
+	from aim.nodes import add, sub, mul, div, gt, lt, mix, clip, dB
+
+	ufuncs = {add: "np.add", sub: "np.subtract", mul: "np.multiply", div: "np.divide", gt: "np.greater", lt: "np.less"}
+
+	inlined = {id(x) for x in members}
+
+	# Outlets of the nodes that are not inlined, that the expression reads
+	leaves: list[Outlet] = []
+	for member in members + [node]:
+		for value in member._inlets.values():
+			if isinstance(value, Outlet) and id(value.node) not in inlined and all(value is not x for x in leaves):
+				if value.datatype != DataType.SIGNAL:
+					unsupported(member)
+				leaves.append(value)
+
+	# mix only keeps the voices that are on both inputs, so voice 0 can not be used for all voices
+	broadcast = not any(isinstance(x, mix) for x in members + [node])
+
+	voices = create_variable()
+	arrays = {id(leaf): create_variable() for leaf in leaves}
+
+	# Buffers for the values of inlined nodes, while calculating. [0] is the output
+	buffer_names: list[str] = [create_variable()]
+	free: list[str] = []
+
+	def acquire() -> str:
+		if not free:
+			free.append(create_variable())
+			buffer_names.append(free[-1])
+		return free.pop()
+
+	expression: list[str] = []
+
+	def operand(value: Any, target: Optional[str] = None) -> str:
+		if isinstance(value, Outlet) and id(value.node) in inlined:
+			buffer = target or acquire()
+			calculate(value.node, buffer)
+			return buffer
+		elif isinstance(value, Outlet):
+			return arrays[id(value)]
+		else:
+			return repr(value)
+
+	def release(target: str, *names: str) -> None:
+		# Only the buffers acquired while calculating target. target itself belongs to the caller
+		free.extend(x for x in names if x in buffer_names and x not in free and x not in (target, buffer_names[0]))
+
+	def calculate(member: Node, target: str) -> None:
+		if member.__class__ in ufuncs:
+			# First input can be calculated right into the target, as ufuncs go element by element
+			in0 = operand(member.in0, target)
+			in1 = operand(member.in1)
+			expression.append(f"{ufuncs[member.__class__]}({in0}, {in1}, out={target})")
+			release(target, in0, in1)
+
+		elif isinstance(member, mix):
+			# in0 * (1 - fac) + in1 * fac, as in0 + (in1 - in0) * fac
+			in0 = operand(member.in0)
+			in1 = operand(member.in1)
+			if isinstance(member.fac, (int, float)):
+				fac = repr((max(min(member.fac, 1), -1) + 1) / 2)
+			else:
+				fac = operand(member.fac)
+			expression.append(f"np.subtract({in1}, {in0}, out={target})")
+			expression.append(f"np.multiply({target}, {fac}, out={target})")
+			expression.append(f"np.add({target}, {in0}, out={target})")
+			release(target, in0, in1, fac)
+
+		elif isinstance(member, clip):
+			value = operand(member.value, target)
+			expression.append(f"np.clip({value}, {member.minimum!r}, {member.maximum!r}, out={target})")
+			release(target, value)
+
+		elif isinstance(member, dB):
+			value = operand(member.decibel, target)
+			expression.append(f"np.divide({value}, 20, out={target})")
+			expression.append(f"np.power(10.0, {target}, out={target})")
+			release(target, value)
+
+		else:
+			unsupported(member)
+
+	calculate(node, buffer_names[0])
+
+	voices_of = introduce(
+		module_context,
+		[
+			"def UNIQUE_NAME(signals, broadcast):",
+			"	# Voices of a fused expression, or None if the voices of the inputs do not line up. And the",
+			"	# voices of each input, as matrices",
+			"	voices = None",
+			"	inputs = [voice_rows(x) for x in signals]",
+			"	rows = [x[1] for x in inputs]",
+			"	for signal_voices, _ in inputs:",
+			"		if broadcast and signal_voices == [0]:",
+			"			continue",
+			"		if voices is None:",
+			"			voices = signal_voices",
+			"		elif signal_voices != voices:",
+			"			return None, rows",
+			"	if voices is None:",
+			"		return [0], rows",
+			"	if 0 in voices and len(voices) > 1:",
+			"		return None, rows",
+			"	return voices, rows",
+		]
+	)
+
+	# The code of the nodes, one by one
+	fallback_code: list[str] = []
+	for member in members + [node]:
+		globals()[f"numpy_{member.__class__.__name__}"](module_context, member, init_code, fallback_code)
+
+	# Scratch matrices
+	scratch = {x: create_variable() for x in buffer_names[1:]}
+	init_code.extend(f"{scratch[x]} = Signal()" for x in buffer_names[1:])
+
+	# A single voice 0 of an input has a single row, that numpy broadcasts to all the voices
+	process_code.append(
+		f"{voices}, [{', '.join(arrays.values())}] = {voices_of}(({', '.join(x._variable for x in leaves)},), {broadcast})"
+	)
+	process_code.append(f"if {voices} is not None:")
+	process_code.append(f"	{buffer_names[0]} = {node.output._variable}.align({voices})")
+	process_code.extend(f"	{x} = {scratch[x]}.align({voices})" for x in buffer_names[1:])
+	process_code.extend(f"	{x}" for x in expression)
+	process_code.append("else:")
+	process_code.extend(f"	{x}" for x in fallback_code)
+
+
 def compile_to_numpy(
 	compilation_context: CompilationContext,
 	frame_count: int = 2**13,
 	sample_rate: int = 48000,
 ) -> str:
 	assert isinstance(compilation_context, CompilationContext)
-	# Start backwards and create dependency graph
-	init_code = []
-	process_code = []
 
-	init_code = [
-		"import numpy as np",
-		"import json, sys, time",
-		"from collections import defaultdict",
-		"from dataclasses import dataclass, field",
-		f"_SILENCE = np.zeros({frame_count}, dtype='float32')",
-		f"_ONES = np.ones({frame_count}, dtype='float32')",
-		"process_counter = -1",
-		"voice_identifier = 0",  # Note: All dynamically created voices starts at 1. 0 is the default voice
-		"def create_voice():",
-		"	global voice_identifier",
-		"	voice_identifier += 1",
-		"	return voice_identifier",
-		"@dataclass",
-		"class Signal:",
-		"	voices: dict = field(default_factory=lambda:{})",
-		"	channel_map: dict = field(default_factory=lambda:{})",
-
-		# Set when voice is starting, to give a hint to receivers where in the buffer the actual start processing
-		"	voice_start: dict = field(default_factory=lambda:{})",
-		# Set when voice is starting, to give a hint to receivers where in the buffer to stop processing.
-		# After this buffer, the voice should go away.
-		"	voice_stop: dict = field(default_factory=lambda:{})",  # Set when voice is starting, to give a hint to receivers where in the buffer the actual start processing
-		"	enable: dict = field(default_factory=lambda:{})",
-		"@dataclass",
-		"class Midi:",
-		"	voices: dict[int, list[tuple[int, int]]] = field(default_factory=lambda:{})",
-		"	raw: list[int, bytes] = field(default_factory=lambda:[])",  # All data. For still transferring pitch wheel data etc.
-		"random = np.random.default_rng()",
-		"start_time = time.monotonic()",
-		"piping_node_pipes = {}",
-	]
+	return IncrementalCompiler(frame_count, sample_rate).compile(compilation_context)
 
-	process_code = [
-		"global process_counter",
-		"process_counter += 1",
-		#f"if not (process_counter % {frame_count}):"
-		#f"\tprint(round(process_counter*{frame_count} / {sample_rate}), 'seconds')",
-		"output = {}",
-	]
 
-	module_context = ModuleContext(
-		frame_count=frame_count,
-		sample_rate=sample_rate,
+class IncrementalCompiler:
+	"""
+	Compiles to numpy, reusing the code of the nodes that did not change since the previous compile
+
+	A node is unchanged when its class, its constant inputs and everything upstream of it are the
+	same as before. Editing a node therefore regenerates it and its downstream dependents, while
+	the code of all the other nodes is taken as it is, including their variable names.
+
+	The init code of reused nodes only runs if its variables have not been carried over from the
+	previous program, see aim.engine. self.preserved lists those variables after each compile.
+
+	The program is also given in self.chunks, pieces that are compiled by Python one by one, see
+	aim.cache. The process code of about SEGMENT_SIZE nodes is a function in a chunk with their init
+	code. Where a chunk ends is decided by the nodes, not their position, so an edit only changes the
+	chunks of the nodes it regenerates, and the chunk calling them all.
+	"""
+	def __init__(
+		self,
+		frame_count: int = 2**13,
+		sample_rate: int = 48000,
+		fuse: bool = True,
+		profile: bool = False,
+		debug: bool = False,
+	):
+		"""
+		If fuse is True, chains of elementwise math are calculated as one expression, see numpy_fused()
+
+		If profile is True, the process code of every node is timed, see _profiled()
+
+		If debug is True, print nodes and debug_print() of other nodes write to stdout
+		"""
+		self.frame_count = frame_count
+		self.sample_rate = sample_rate
+		self.fuse = fuse
+		self.profile = profile
+		self.debug = debug
+
+		# Statistics of the last compile
+		self.reused = 0
+		self.generated = 0
+
+		# Variables that the program of the last compile can take over from the previous program
+		self.preserved: list[str] = []
+
+		# The program of the last compile, in pieces that are compiled by Python one by one
+		self.chunks: list[str] = []
+
+		self._fragments: dict[tuple[str, int], _Fragment] = {}
+		self._digests: dict[tuple, str] = {}  # See _node_digest()
+		self._fusions: dict[tuple, tuple[bool, bool]] = {}  # See _find_fusions()
+		self._helpers: dict[tuple[str, ...], str] = {}  # Kept, so that helpers keep their names
+		self._emitted_helpers: set[str] = set()
+
+		# Variable names are unique across all compiles, as reused fragments keep theirs
+		self._state = CompilerState()
+
+	def compile(self, compilation_context: CompilationContext) -> str:
+		assert isinstance(compilation_context, CompilationContext)
+
+		# Like aim.nodes.load(), what is allocated is kept or freed by reference counting, and the
+		# garbage collector would walk all the nodes over and over again on large scripts
+		gc_enabled = gc.isenabled()
+		gc.disable()
+
+		token = _COMPILER_STATE.set(self._state)
+		try:
+			return self._compile(compilation_context)
+		finally:
+			_COMPILER_STATE.reset(token)
+
+			if gc_enabled:
+				gc.enable()
+
+	def _compile(self, compilation_context: CompilationContext) -> str:
+		module_context = ModuleContext(
+			frame_count=self.frame_count,
+			sample_rate=self.sample_rate,
+			helpers=self._helpers,
+			debug=self.debug,
+		)
+
+		fragments: dict[tuple[str, int], _Fragment] = {}
+		digests: dict[int, str] = {}  # Of the nodes and everything upstream, see _node_digest()
+		keys: dict[int, str] = {}  # Of the fragments of the nodes, which also depend on the fusions
+		known: dict[tuple, str] = {}  # Digests of this compile, by what they were made from
+		decisions: dict[tuple, tuple[bool, bool]] = {}  # See _find_fusions()
+		files: dict[str, Optional[str]] = {}
+		occurrences: dict[str, int] = {}
+		helpers: set[str] = set()
+
+		segments: list[str] = []  # Chunks of the nodes
+		segment: list[_Fragment] = []
+		names: list[str] = []  # Of the functions of the segments, calling the process code of the nodes
+
+		self.reused = 0
+		self.generated = 0
+		self.preserved = list(RUNTIME_VARIABLES)
+
+		for node_id in compilation_context.order:
+			digests[node_id] = _node_digest(compilation_context.node_ids[node_id], digests, self._digests, known, files)
+
+		fusions = _find_fusions(compilation_context, digests, self._fusions, decisions) if self.fuse else {}
+
+		for node_id in compilation_context.order:
+			node = compilation_context.node_ids[node_id]
+			assert isinstance(node, Node), (type(node), Node)
+
+			# Whether a node is fused depends on the nodes using it, so it is a part of the key of the
+			# fragment too. Nodes downstream then get regenerated when it changes, as the variables change.
+			parts = [digests[node_id]]
+			func = None
+			if (members := fusions.get(node_id)) is not None:
+				if members:
+					parts.append("fused:" + ",".join(keys[id(x)] for x in members))
+					func = functools.partial(numpy_fused, members=members)
+				else:
+					parts.append("inlined")
+					func = numpy_inlined
+
+			parts.extend(
+				keys[id(value.node)]
+				for value in node._inlets.values()
+				if isinstance(value, Outlet) and keys[id(value.node)] != digests[id(value.node)]
+			)
+
+			keys[node_id] = digest = parts[0] if len(parts) == 1 else _digest(parts, self._digests, known)
+
+			# Identical nodes in the same graph each get their own fragment
+			key = (digest, occurrences.get(digest, 0))
+			occurrences[digest] = key[1] + 1
+
+			if fragment := self._fragments.get(key):
+				fragment.restore(node, module_context)
+				self.reused += 1
+				self.preserved.extend(fragment.owned)
+			else:
+				fragment = _Fragment.generate(module_context, node, func)
+				self.generated += 1
+
+				# Made once, as the text of the fragment is the same every time it is reused. The init
+				# code is guarded even the first time, which runs it as nothing is carried over yet
+				name = node.__class__.__name__
+				fragment.init_text = "\n".join([f"# {name}", *_guarded(fragment.owned[0], fragment.init_code)])
+				fragment.process_text = "\n".join(
+					f"\t{x}"
+					for x in [
+						f"# {name}",
+						*(_profiled(node, fragment) if self.profile and fragment.process_code else fragment.process_code),
+					]
+				)
+
+			fragments[key] = fragment
+			helpers |= fragment.helpers
+
+			segment.append(fragment)
+			if (int(digest[:8], 16) + key[1]) % SEGMENT_SIZE == 0:
+				segments.append(_segment(segment, names))
+				segment = []
+
+		if segment:
+			segments.append(_segment(segment, names))
+
+		self._fragments = fragments
+		self._digests = known
+		self._fusions = decisions
+
+		process_code = [
+			"global process_counter",
+			"process_counter += 1",
+			"recycle()",
+			"output = {}",
+			*(f"{x}(output)" for x in names),
+		]
+
+		profile_code = []
+		if self.profile:
+			profile_code = _profile_code(compilation_context, self.frame_count, self.sample_rate)
+			process_code.insert(0, "_profile_block_start = _perf()")
+			process_code.append("_profile_block(_perf() - _profile_block_start)")
+
+		# Nothing is written per block. aim.engine reports the status of the engine to the parent
+		# process at a fixed rate, and flushes what the nodes printed
+		process_code.append("return output")
+
+		helper_code = []
+		for lines, name in self._helpers.items():
+			if name in helpers:
+				if name in self._emitted_helpers:
+					self.preserved.append(name)
+
+				helper_code.extend(_guarded(name, [line.replace("UNIQUE_NAME", name) for line in lines]))
+
+		self._emitted_helpers = helpers
+
+		# Forget helpers that are not used anymore
+		self._helpers = {lines: name for lines, name in self._helpers.items() if name in helpers}
+
+		self.chunks = [
+			"\n".join(_header_code(self.frame_count)),
+			*(["\n".join(helper_code)] if helper_code else []),
+			*segments,
+			*(["\n".join(profile_code)] if profile_code else []),
+			"\n".join(
+				[
+					f"sample_rate = {self.sample_rate}",
+					f"frame_count = {self.frame_count}",
+					"def numpy_process():",
+					*(f"\t{x}" for x in process_code),
+				]
+			),
+		]
+
+		return "\n".join(self.chunks)
+
+
+def _segment(fragments: list["_Fragment"], names: list[str]) -> str:
+	"""
+	Chunk with the init code of the fragments, and a function calling their process code
+
+	The function is named after the variable of the first node, which is added to names.
+	"""
+	name = f"_process{fragments[0].owned[0]}"
+	names.append(name)
+
+	return "\n".join(
+		[
+			*(x.init_text for x in fragments),
+			f"def {name}(output):",
+			*(x.process_text for x in fragments),
+			*([] if any(x.process_code for x in fragments) else ["\tpass"]),
+		]
 	)
 
-	for node_id in compilation_context.order:
-		node = compilation_context.node_ids[node_id]
-		assert isinstance(node, Node), (type(node), Node)
 
-		func = globals().get(f"numpy_{node.__class__.__name__}")
+@dataclass
+class _Fragment:
+	"""
+	Generated code of a single node
+	"""
+	init_code: list[str]
+	process_code: list[str]
+	variables: dict[str, str]  # Outlet name -> variable. "" is the variable of the node itself
+	datatypes: dict[str, int]  # Outlet name -> datatype, as the node may have decided it
+	pipes: set[str]
+	helpers: set[str]
+	owned: list[str]  # All variables created by the node. The first one is the node variable
+
+	# Code as it is put in the program, see IncrementalCompiler._compile()
+	init_text: str = ""
+	process_text: str = ""
+
+	@staticmethod
+	def generate(module_context: ModuleContext, node: Node, func: Optional[Callable] = None) -> "_Fragment":
+		"""
+		Generate the code of the node with func, or the numpy_<node name> function if not given
+		"""
+		func = func or globals().get(f"numpy_{node.__class__.__name__}")
 
 		if not func:
 			raise NotImplementedError(f"Node {node.__class__} is not supported in the numpy_backend")
 
-		init_code.append(f"# {node.__class__.__name__}")
-		process_code.append(f"# {node.__class__.__name__}")
+		state: CompilerState = _COMPILER_STATE.get()
+
+		first_variable = state.next_id
+		variables = {"": node._variable}
+		variables.update((name, outlet._variable) for name, outlet in node._outlets.items())
+
+		pipes = set(module_context.pipes)
+		module_context.introduced = set()
+
+		init_code: list[str] = []
+		process_code: list[str] = []
 		func(module_context, node, init_code, process_code)
 
-	# Emit statistic data to stdout and return data
-	process_code.extend(
-		[
-			"""print('{"status": 0}')""",  # Notify that we have processed a buffer
-			"sys.stdout.flush()",
-			"return output",
-		]
+		return _Fragment(
+			init_code=init_code,
+			process_code=process_code,
+			variables=variables,
+			datatypes={name: outlet.datatype for name, outlet in node._outlets.items()},
+			pipes=module_context.pipes - pipes,
+			helpers=module_context.introduced,
+			owned=[variables[""]] + [
+				f"_{i}" for i in range(first_variable + 1, state.next_id + 1) if f"_{i}" != variables[""]
+			],
+		)
+
+	def restore(self, node: Node, module_context: ModuleContext) -> None:
+		"""
+		Make the node look like it was the one that generated this fragment
+		"""
+		node.__dict__["_variable"] = self.variables[""]
+
+		for name, outlet in node._outlets.items():
+			outlet.__dict__["_variable"] = self.variables[name]
+			outlet.datatype = self.datatypes[name]
+
+		if duplicates := module_context.pipes & self.pipes:
+			raise Exception(f"Pipe with the name '{duplicates.pop()}' already exists.")
+
+		module_context.pipes |= self.pipes
+
+
+def _profiled(node: Node, fragment: _Fragment) -> list[str]:
+	"""
+	Process code of the node, timed and counted by the voices of its output
+
+	Nodes without outputs, like out, are counted by the voices of their first input.
+	"""
+	import re
+
+	signal = next(
+		(
+			x
+			for x in [*fragment.variables.values()][1:] + [
+				value._variable for value in node._inlets.values() if isinstance(value, Outlet)
+			]
+			# Nodes that generate nothing for an outlet, e.g when missing inputs
+			if any(re.search(rf"\b{x}\b", line) for line in fragment.init_code + fragment.process_code)
+		),
+		None,
 	)
 
-	code = "\n".join(init_code)
-	code += f"\nsample_rate = {sample_rate}"
-	code += f"\nframe_count = {frame_count}"
-	code += "\ndef numpy_process():\n" + "\n".join(f"\t{x}" for x in process_code)
+	return [
+		"_profile_start = _perf()",
+		*fragment.process_code,
+		f"_profile_add('{node._variable}', {f'len({signal}.voices)' if signal else 0}, _perf() - _profile_start)",
+	]
 
-	return code
 
+def _profile_code(compilation_context: CompilationContext, frame_count: int, sample_rate: int) -> list[str]:
+	"""
+	Sums of the times of the nodes, reported to the parent about once per second of audio as
+
+		{"profile": {"blocks": 47, "budget": 0.021, "total": 0.08, "nodes": [{"node": "_12", ...}]}}
 
-def introduce(init_code: list[str], lines: list[str]):
+	"total" is the time of all the blocks. For every node and voice count, "seconds" is the time of
+	the node and "blocks" how many blocks it ran with that many voices.
 	"""
-	Introduces method only once
+	classes = {
+		node._variable: node.__class__.__name__
+		for node in (compilation_context.node_ids[x] for x in compilation_context.order)
+	}
+
+	return [
+		"_perf = time.perf_counter",
+		f"_PROFILE_CLASSES = {classes!r}",
+		"_PROFILE = {}",  # (node variable, voices) -> [seconds, blocks]
+		"_profile_totals = [0, 0.0]",  # Blocks and seconds since the last report
+		"def _profile_add(node, voices, seconds):",
+		"	if (entry := _PROFILE.get((node, voices))) is None:",
+		"		entry = _PROFILE[node, voices] = [0.0, 0]",
+		"	entry[0] += seconds",
+		"	entry[1] += 1",
+		"def _profile_block(seconds):",
+		"	_profile_totals[0] += 1",
+		"	_profile_totals[1] += seconds",
+		f"	if _profile_totals[0] >= {max(round(sample_rate / frame_count), 1)}:",
+		"		nodes = [",
+		"			{'node': node, 'class': _PROFILE_CLASSES[node], 'voices': voices, 'seconds': entry[0], 'blocks': entry[1]}",
+		"			for (node, voices), entry in _PROFILE.items()",
+		"		]",
+		f"		print(json.dumps({{'profile': {{'blocks': _profile_totals[0], 'budget': {frame_count / sample_rate}, 'total': _profile_totals[1], 'nodes': nodes}}}}))",
+		"		_PROFILE.clear()",
+		"		_profile_totals[:] = [0, 0.0]",
+	]
+
+
+def _guarded(variable: str, lines: list[str]) -> list[str]:
+	"""
+	Only run the lines if the variable has not been carried over from a previous program
+	"""
+	if not lines:
+		return lines
+
+	return [f"if '{variable}' not in _preserved:"] + [f"\t{x}" for x in lines]
+
+
+def _node_digest(
+	node: Node,
+	digests: dict[int, str],
+	previous: dict[tuple, str],
+	known: dict[tuple, str],
+	files: dict[str, Optional[str]],
+) -> str:
+	"""
+	Hash of the node class, its inputs and, through the digests of its inputs, everything upstream
+
+	previous has the digests of the last compile by what they were made from, so a node that has not
+	changed is looked up instead of hashed again. The digests of this compile are added to known.
+	files has the stats of the files read by nodes, like score and audiofile, so each is only looked
+	at once per compile.
+	"""
+	parts = [node.__class__.__module__, node.__class__.__qualname__]
 
-	UNIQUE_NAME is replaced by the new name of the method.
+	for name, value in node._inlets.items():
+		if isinstance(value, Outlet):
+			parts.append(f"{name}=<{digests[id(value.node)]}.{value._index}>")
+		else:
+			parts.append(f"{name}={value!r}")
+
+			if isinstance(value, str):
+				if value not in files:
+					stat = os.stat(value) if os.path.isfile(value) else None
+					files[value] = stat and f"{stat.st_mtime_ns}:{stat.st_size}"
+
+				if files[value]:
+					parts.append(files[value])
+
+	return _digest(parts, previous, known)
+
+
+def _digest(parts: list[str], previous: dict[tuple, str], known: dict[tuple, str]) -> str:
+	"""
+	Hash of the parts, looked up in previous if they were hashed by the last compile. Added to known
 	"""
-	if lines in introduce.lines.values():
-		return next(k for k,v in introduce.lines.items() if v == lines) # Already defined
+	key = tuple(parts)
+	if (digest := known.get(key) or previous.get(key)) is None:
+		digest = hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+	known[key] = digest
+
+	return digest
+
+
+# State of the program itself that is always carried over when hot swapping programs
+RUNTIME_VARIABLES = ("Signal", "Midi", "voice_identifier", "process_counter", "start_time", "piping_node_pipes", "_POOL", "_RETIRED")
+
+
+def _header_code(frame_count: int) -> list[str]:
+	return [
+		"import numpy as np",
+		"import json, sys, time",
+		"from collections import defaultdict",
+		"from dataclasses import dataclass, field",
+		"from typing import Any",
+		"_preserved = globals().get('_preserved', set())",  # Set by aim.engine when hot swapping
+		"_data = globals().get('_data')",  # aim.transport.RingBuffer for node data, set by aim.engine
+		f"_SILENCE = np.zeros({frame_count}, dtype='float32')",
+		f"_ONES = np.ones({frame_count}, dtype='float32')",
+		*_guarded("_POOL", ["_POOL = {}"]),  # Matrices that are not used anymore, by shape and dtype
+		*_guarded("_RETIRED", ["_RETIRED = []"]),  # Matrices replaced by Signal.align(), see recycle()
+		"def _references():",
+		"	# References to a matrix in recycle() when nothing else references it",
+		"	matrix = np.empty(0)",
+		"	return sys.getrefcount(matrix)",
+		"_UNREFERENCED = _references()",
+		"def recycle():",
+		"	# Put the matrices replaced by Signal.align() in _POOL, once nothing references them anymore.",
+		"	# Other nodes may keep rows of a matrix, e.g get() and hold(), which are views referencing it",
+		"	if not _RETIRED:",
+		"		return",
+		"	kept = []",
+		"	while _RETIRED:",
+		"		matrix = _RETIRED.pop()",
+		"		if sys.getrefcount(matrix) > _UNREFERENCED:",
+		"			kept.append(matrix)",
+		"		else:",
+		"			_POOL.setdefault((*matrix.shape, matrix.dtype.name), []).append(matrix)",
+		"	_RETIRED.extend(kept)",
+		*_guarded("process_counter", ["process_counter = -1"]),
+		*_guarded("voice_identifier", ["voice_identifier = 0"]),  # Note: All dynamically created voices starts at 1. 0 is the default voice
+		"def create_voice():",
+		"	global voice_identifier",
+		"	voice_identifier += 1",
+		"	return voice_identifier",
+		*_guarded(
+			"Signal",
+			[
+				# Voices are either rows of the matrix, see align(), or arrays set directly in voices by
+				# the node. A node must only do one of them to its output.
+				"@dataclass(slots=True, eq=False)",
+				"class Signal:",
+				"	voices: dict = field(default_factory=lambda:{})",
+				"	channel_map: dict = field(default_factory=lambda:{})",  # Voice id -> channel, see aim.output
+
+				# Set when voice is starting, to give a hint to receivers where in the buffer the actual start processing
+				"	voice_start: dict = field(default_factory=lambda:{})",
+				# Set when voice is starting, to give a hint to receivers where in the buffer to stop processing.
+				# After this buffer, the voice should go away.
+				"	voice_stop: dict = field(default_factory=lambda:{})",  # Set when voice is starting, to give a hint to receivers where in the buffer the actual start processing
+				"	enable: dict = field(default_factory=lambda:{})",
+				"	dtype: str = 'float32'",
+				f"	width: int = {frame_count}",  # Frames of each voice. 1 for state that nodes keep per voice
+				"	matrix: Any = None",  # All the voices, one row per voice
+				"	ids: list = field(default_factory=lambda:[])",  # Voice id of each row
+				"	slots: dict = field(default_factory=lambda:{})",  # Row of each voice id
+				"	new: list = field(default_factory=lambda:[])",  # Rows of the voices added by the last align()
+				"	def align(self, ids):",
+				"		# Make the rows of the matrix the voices of ids, in that order, and return the matrix.",
+				"		# Voices that were there before keep their values. Only allocates when the voices change",
+				"		if ids == self.ids and self.matrix is not None:",
+				"			if self.new:",
+				"				self.new = []",
+				"			return self.matrix",
+				"		ids = list(ids)",
+				"		pool = _POOL.setdefault((len(ids), self.width, self.dtype), [])",
+				"		matrix = pool.pop() if pool else np.empty((len(ids), self.width), dtype=self.dtype)",
+				"		self.new = []",
+				"		for row, voice_id in enumerate(ids):",
+				"			if (slot := self.slots.get(voice_id)) is not None:",
+				"				matrix[row] = self.matrix[slot]",
+				"			else:",
+				"				self.new.append(row)",
+				"		if self.matrix is not None:",
+				"			_RETIRED.append(self.matrix)",
+				"		self.matrix = matrix",
+				"		self.ids = ids",
+				"		self.slots = {voice_id: row for row, voice_id in enumerate(ids)}",
+				"		self.voices = {voice_id: matrix[row] for row, voice_id in enumerate(ids)}",
+				"		return matrix",
+				"	def buffer(self, voice_id):",
+				"		# Row of a single voice, for nodes that write the voices one by one",
+				"		if voice_id not in self.slots:",
+				"			self.align(self.ids + [voice_id])",
+				"		return self.voices[voice_id]",
+				"	def release(self, voice_id):",
+				"		self.voices.pop(voice_id, None)",
+				"		if voice_id in self.slots:",
+				"			self.align([x for x in self.ids if x != voice_id])",
+			],
+		),
+		"def voice_rows(signal):",
+		"	# Voice ids of the signal, and its voices as a matrix with a row for each",
+		"	if signal.matrix is not None:",
+		"		return signal.ids, signal.matrix",
+		"	ids = list(signal.voices)",
+		f"	return ids, np.array([signal.voices[x] for x in ids], dtype='float32').reshape(len(ids), {frame_count})",
+		"def rows_for(signal, ids, default):",
+		"	# Voices of the signal as rows lining up with ids. default is used for the voices it does not have",
+		"	signal_ids, rows = voice_rows(signal)",
+		"	if signal_ids == ids:",
+		"		return rows",
+		f"	return np.array([signal.voices.get(x, default) for x in ids], dtype='float32').reshape(len(ids), {frame_count})",
+		"def constant_signal(value):",
+		"	# Signal with voice 0 only, that is value on every frame",
+		"	signal = Signal()",
+		"	signal.align([0]).fill(value)",
+		"	return signal",
+		"def binary(ufunc, in0, in1, output):",
+		"	# ufunc of each voice on in0 and in1, into output. A single voice 0 is used with all the voices",
+		"	# of the other input. Numbers are like voice 0",
+		"	ids0, rows0 = voice_rows(in0) if isinstance(in0, Signal) else ([0], in0)",
+		"	ids1, rows1 = voice_rows(in1) if isinstance(in1, Signal) else ([0], in1)",
+		"	if ids0 == ids1 or ids1 == [0]:",
+		"		ufunc(rows0, rows1, out=output.align(ids0))",
+		"	elif ids0 == [0]:",
+		"		ufunc(rows0, rows1, out=output.align(ids1))",
+		"	else:",
+		"		assert 0 not in ids0",
+		"		assert 0 not in ids1",
+		"		# Voices that only one of the inputs has are calculated against silence",
+		"		ids = list(dict.fromkeys(ids0 + ids1))",
+		"		rows = output.align(ids)",
+		"		for row, voice_id in enumerate(ids):",
+		"			ufunc(in0.voices.get(voice_id, _SILENCE), in1.voices.get(voice_id, _SILENCE), out=rows[row])",
+		*_guarded(
+			"Midi",
+			[
+				"@dataclass",
+				"class Midi:",
+				"	voices: dict[int, list[tuple[int, int]]] = field(default_factory=lambda:{})",
+				"	raw: list[int, bytes] = field(default_factory=lambda:[])",  # All data. For still transferring pitch wheel data etc.
+			],
+		),
+		"random = np.random.default_rng()",
+		*_guarded("start_time", ["start_time = time.monotonic()"]),
+		*_guarded("piping_node_pipes", ["piping_node_pipes = {}"]),
+	]
+
 
-	unique_name = create_variable()
+def introduce(module_context: ModuleContext, lines: list[str]) -> str:
+	"""
+	Introduces method only once
 
-	init_code.extend([x.replace("UNIQUE_NAME", unique_name) for x in lines])
+	UNIQUE_NAME is replaced by the new name of the method. The method is put before the code of
+	the nodes.
+	"""
+	if (unique_name := module_context.helpers.get(tuple(lines))) is None:
+		unique_name = module_context.helpers[tuple(lines)] = create_variable()
 
-	introduce.lines[unique_name] = lines
+	module_context.introduced.add(unique_name)
 
 	return unique_name
-introduce.lines = {}
 
 
 def emit_data(node: Node, code: str) -> str:
@@ -1447,17 +2251,28 @@ def emit_data(node: Node, code: str) -> str:
 
 	E.g, the plot data for an oscilloscope.
 	"""
-	return f"print(json.dumps({{'node_id': {id(node)}, 'name': '{node.__class__.__name__}', 'data': {code}}}))"
+	return f"print(json.dumps({{'node_id': '{node._variable}', 'name': '{node.__class__.__name__}', 'data': {code}}}))"
+
+
+def emit_samples(node: Node, voice_id: str, samples: str) -> str:
+	"""
+	Send samples of a voice of the node to the parent process, see aim.transport
+
+	Nothing is sent when the program is not run by aim.engine, as there is nobody to receive it.
+	"""
+	return f"if _data is not None: _data.write({int(node._variable[1:])}, {voice_id}, {samples})"
 
 
-def debug_print(node: Node, code: str):
+def debug_print(module_context: ModuleContext, node: Node, code: str) -> str:
 	"""
 	Output data straight to stdout
 
-	Only meant for when developing nodes, not normal usage.
+	Only meant for when developing nodes, not normal usage. Only compiled in with "aim run --debug".
 	"""
-	# TODO merayen probably only do this when "aim --debug"
-	return f"print(json.dumps({{'node': '{id(node)}', 'name': '{node.__class__.__name__}', 'time': time.monotonic()-start_time, 'debug': True, 'data': {code}}}))"
+	if not module_context.debug:
+		return "pass"
+
+	return f"print(json.dumps({{'node': '{node._variable}', 'name': '{node.__class__.__name__}', 'time': time.monotonic()-start_time, 'debug': True, 'data': {code}}}))"
 
 
 def unsupported(node: Node):
@@ -1513,17 +2328,455 @@ def test_sub_node() -> None:
 def test_out_node() -> None:
 	import numpy as np
 
-	assert np.all(run_code_for_testing("out(5*5)")["unnamed_0"].voices == 25)
+	assert np.all(run_code_for_testing("out(5*5)")["unnamed_0"].voices[0] == 25)
+
+
+def test_incremental_compiler() -> None:
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+
+	def compile_with(compiler: IncrementalCompiler, code: str) -> str:
+		context: Context = load(code)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph)
+		return compiler.compile(CompilationContext(context, graph, node_ids, order))
+
+	compiler = IncrementalCompiler(frame_count=10)
+	compile_with(compiler, "_a = sine(220); out(_a * 0.5); out(sine(110) + 1); out(trigger(sine(2)))")
+	assert (compiler.reused, compiler.generated) == (0, 9)
+
+	code = compile_with(compiler, "_a = sine(220); out(_a * 0.5); out(sine(110) + 2); out(trigger(sine(2)))")
+	assert (compiler.reused, compiler.generated) == (7, 2)
+
+	# Changing a node regenerates everything downstream of it
+	compile_with(compiler, "_a = sine(221); out(_a * 0.5); out(sine(110) + 2); out(trigger(sine(2)))")
+	assert (compiler.reused, compiler.generated) == (6, 3)
+
+	# Only the digests of the last compile are kept, and the unchanged ones are not hashed again
+	digests = dict(compiler._digests)
+	assert len(digests) == 9
+	sha1 = hashlib.sha1
+	hashlib.sha1 = None
+	try:
+		compile_with(compiler, "_a = sine(221); out(_a * 0.5); out(sine(110) + 2); out(trigger(sine(2)))")
+	finally:
+		hashlib.sha1 = sha1
+	assert compiler._digests == digests
+
+	code += "\nresult = numpy_process()"
+	a = {}
+	exec(code, a)
+
+	expected = run_code_for_testing("_a = sine(220); out(_a * 0.5); out(sine(110) + 2); out(trigger(sine(2)))")
+	for name in expected:
+		assert np.allclose(expected[name].voices[0], a["result"][name].voices[0])
 
 
-def run_code_for_testing(code: str, frame_count=10, sample_rate=48000) -> Any:
+def test_fusion() -> None:
+	import contextlib
+	import io
+	import numpy as np
 	from aim.nodes import load, build_node_graph, execution_order
 
+	def run(code: str, fuse: bool) -> tuple[str, list]:
+		context: Context = load(code)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph, node_ids)
+		program_code = IncrementalCompiler(frame_count=16, fuse=fuse).compile(CompilationContext(context, graph, node_ids, order))
+
+		program = {}
+		exec(program_code, program)
+
+		with contextlib.redirect_stdout(io.StringIO()):
+			blocks = [
+				{name: {k: v.copy() for k, v in signal.voices.items()} for name, signal in program["numpy_process"]().items()}
+				for _ in range(3)
+			]
+
+		return program_code, blocks
+
+	for code, fused in (
+		("out(sine(220) * 0.5 + sine(110) * 0.25 - 0.1)", True),
+		("out(clip(mix(sine(20), saw(35), 0.2) * 3, -0.5, 0.8) > 0.1)", True),
+		("out(sine(unison(220, 4)) * sine(3) * dB(sine(2) * 6))", True),
+		("out(mix(sine(10), sine(20), fac=sine(30) / 2))", True),
+		("out(mix(sine(unison(220, 3)), sine(110) * 2, fac=0.3))", True),  # Voices do not line up
+		("out(mix((sine(100) + 1) * 2, sine(200) * 3, 0.3))", True),  # Chains on both inputs
+		("out(mix(sine(10) - (sine(20) + 1) * 2, clip(sine(30) * 4, -1, 1), fac=dB(sine(40)) - 1))", True),
+		("_a = sine(5) * 2; out(_a + 1); out(_a - 1)", False),  # Used by two nodes
+		("out(sine(5) + 1)", False),
+		("\n".join(["_a0 = sine(5)", *(f"_a{i} = _a{i - 1} * 0.99 + 0.001" for i in range(1, 300)), "out(_a299)"]), True),
+	):
+		program_code, result = run(code, True)
+		expected_code, expected = run(code, False)
+		assert (program_code != expected_code) == fused, code
+
+		for expected_block, block in zip(expected, result):
+			assert expected_block.keys() == block.keys(), code
+			for name in block:
+				assert expected_block[name].keys() == block[name].keys(), code
+				for voice_id in block[name]:
+					assert np.allclose(expected_block[name][voice_id], block[name][voice_id]), code
+
+	# Nodes that stop or start being inlined, and the nodes using them, are regenerated
+	compiler = IncrementalCompiler(frame_count=16)
+	for code in ("_a = sine(5) * 2; out(_a + 1)", "_a = sine(5) * 2; out(_a + 1); out(_a - 1)", "_a = sine(5) * 2; out(_a + 1)"):
+		context = load(code)
+		graph, node_ids = build_node_graph(context)
+		program = {}
+		exec(compiler.compile(CompilationContext(context, graph, node_ids, execution_order(graph, node_ids))), program)
+
+		with contextlib.redirect_stdout(io.StringIO()):
+			assert np.allclose(program["numpy_process"]()["unnamed_0"].voices[0], run(code, False)[1][0]["unnamed_0"][0])
+
+	# Only the nodes that changed, and the nodes they use, are looked at again
+	looked_at = []
+	fusible = globals()["_fusible"]
+	globals()["_fusible"] = lambda node: looked_at.append(node.__class__.__name__) or fusible(node)
+	try:
+		for code in ("_a = sine(5) * 2; out(_a + 1)", "_a = sine(5) * 2; out(_a + 2)"):
+			context = load(code)
+			graph, node_ids = build_node_graph(context)
+			compiler.compile(CompilationContext(context, graph, node_ids, execution_order(graph, node_ids)))
+	finally:
+		globals()["_fusible"] = fusible
+
+	assert sorted(looked_at) == ["add", "add", "add", "mul", "mul", "out", "out"]
+
+
+def test_profile() -> None:
+	import contextlib
+	import io
+	import json
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+
+	def run(profile: bool) -> tuple[list, list]:
+		context = load("_v = sine(unison(50, 3)); out(_v * 0.5); print(sine(2))")
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph, node_ids)
+		program = {}
+		exec(IncrementalCompiler(100, 1000, profile=profile, debug=True).compile(CompilationContext(context, graph, node_ids, order)), program)
+
+		stdout = io.StringIO()
+		with contextlib.redirect_stdout(stdout):
+			blocks = [program["numpy_process"]()["unnamed_0"].matrix.copy() for _ in range(25)]
+
+		return blocks, [json.loads(x)["profile"] for x in stdout.getvalue().splitlines() if '"profile"' in x]
+
+	blocks, reports = run(True)
+	expected, no_reports = run(False)
+
+	assert all(np.array_equal(x, y) for x, y in zip(blocks, expected))
+	assert not no_reports
+
+	# Once per second of audio
+	assert len(reports) == 2
+	assert reports[0]["blocks"] == 10 and reports[0]["budget"] == 0.1
+	assert {(x["class"], x["voices"], x["blocks"]) for x in reports[0]["nodes"]} == {
+		("sine", 3, 10),  # Voices of unison, which has no process code
+		("mul", 3, 10),
+		("out", 3, 10),
+		("sine", 1, 10),
+		("print", 1, 10),
+	}
+	assert 0 < sum(x["seconds"] for x in reports[0]["nodes"]) < reports[0]["total"]
+
+
+def test_oscilloscope_data() -> None:
+	import contextlib
+	import io
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+	from aim.transport import RingBuffer
+
+	context = load("oscilloscope(sine(100), time_div=0.01)")
+	graph, node_ids = build_node_graph(context)
+	order = execution_order(graph, node_ids)
+	code = IncrementalCompiler(100, 1000).compile(CompilationContext(context, graph, node_ids, order))
+	variable, = [x._variable for x in node_ids.values() if x.__class__.__name__ == "oscilloscope"]
+
+	ring = RingBuffer.create(2**16)
+	try:
+		program = {"_data": ring}
+		exec(code, program)
+
+		stdout = io.StringIO()
+		with contextlib.redirect_stdout(stdout):
+			for _ in range(10):
+				program["numpy_process"]()
+
+		# Samples go in the ring buffer, not on stdout
+		assert '"node_id"' not in stdout.getvalue()
+
+		records = [(node_id, voice_id, samples.copy()) for node_id, voice_id, samples in ring.read()]
+		assert records and all(x[:2] == (int(variable[1:]), 0) for x in records)
+		assert all(len(x[2]) == 10 and np.all(np.abs(x[2]) <= 1) for x in records)
+
+		# Nobody listens when run without the engine
+		program = {}
+		exec(code, program)
+		for _ in range(10):
+			program["numpy_process"]()
+	finally:
+		ring.close()
+
+
+def test_no_allocations_per_block() -> None:
+	"""
+	After the first blocks, processing a block makes no new arrays
+
+	Counted are the arrays that numpy functions return, unless they are views of their arguments,
+	and the arrays the program keeps. Arrays made by operators and thrown away right after, like
+	a + b, are not seen.
+	"""
+	import contextlib
+	import dataclasses
+	import io
+	import tempfile
+	import types
+	import weakref
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+
+	frame_count = 2**15
+
+	def root(array: np.ndarray) -> np.ndarray:
+		while isinstance(array.base, np.ndarray):
+			array = array.base
+		return array
+
+	created = []
+
+	class Counted:
+		# A function of numpy, counting the arrays it makes
+		def __init__(self, function):
+			self.function = function
+
+		def __getattr__(self, name: str) -> Any:
+			return getattr(self.function, name)
+
+		def __call__(self, *args, **kwargs) -> Any:
+			result = self.function(*args, **kwargs)
+			arguments = [root(x) for x in (*args, *kwargs.values()) if isinstance(x, np.ndarray)]
+			if isinstance(result, np.ndarray) and all(root(result) is not x for x in arguments):
+				created.append(self.function.__name__)
+			return result
+
+	counting_np = types.SimpleNamespace(
+		**{name: Counted(x) if callable(x) and not isinstance(x, type) else x for name, x in vars(np).items()}
+	)
+
+	def kept(program: dict) -> dict[int, weakref.ref]:
+		# Arrays owning their memory, that the variables of the program lead to. Weak references, as
+		# the program only recycles the arrays nothing else refers to
+		result = {}
+		seen = set()
+		values = [x for name, x in program.items() if not name.startswith("__")]
+		while values:
+			value = values.pop()
+			if id(value) in seen or isinstance(value, (type, types.ModuleType, types.FunctionType)):
+				continue
+			seen.add(id(value))
+
+			if isinstance(value, np.ndarray):
+				result[id(root(value))] = weakref.ref(root(value))
+			elif isinstance(value, dict):
+				values.extend(value.values())
+			elif isinstance(value, (list, tuple, set)):
+				values.extend(value)
+			elif dataclasses.is_dataclass(value):
+				values.extend(getattr(value, x.name) for x in dataclasses.fields(value))
+
+		return result
+
+	with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+		f.write("".join(f"0 1000 {x}4\n" for x in "ceg"))
+		f.flush()
+
+		for code in (
+			"out(sine(440)); out(square(440, duty=0.3)); out(saw(sine(2) * 10 + 440))",
+			"out(sine(sine(5) * 10 + 110, phase=0.25))",
+			"out(add(sine(3), sine(5))); _a = sine(7) * 2; out(_a - 1); out(_a > 0)",
+			"out(mix(sine(20), saw(35), 0.2)); out(mix(sine(20), 1, fac=sine(1)))",
+			"out(clip(sine(10) * 3, -0.5, 0.8)); out(trigger(sine(7), 0.6, -0.6))",
+			"out(time()); out(sine(time() * 100 + 20)); out(dB(sine(2) * 6))",
+			"out(sine(unison(440, 4))); out(downmix(saw(unison(220, 3))))",
+			"out(clip(mix(sine(20), saw(35), 0.2) * 3, -0.5, 0.8) > 0.1)",
+			"out(sine(unison(220, 4)) * sine(3) * dB(sine(2) * 6))",
+			"put('a', sine(unison(5, 3))); out(get('a') * 2); out(get('b') + 1); put('b', saw(3))",
+			"out(spawn(square(3))); out(spawn(square(50)))",
+			"oscilloscope(sine(unison(100, 2))); out(hold(sine(unison(3, 2))))",
+			f"out(sine(frequency(polyphonic(score({f.name!r}))))); out(one(unison(score({f.name!r}), 2)))",
+		):
+			context: Context = load(code)
+			graph, node_ids = build_node_graph(context)
+			order = execution_order(graph, node_ids)
+			program = {}
+			exec(compile_to_numpy(CompilationContext(context, graph, node_ids, order), frame_count=frame_count), program)
+
+			with contextlib.redirect_stdout(io.StringIO()):
+				# First blocks make the buffers of the voices. spawn makes another number of voices in
+				# each block, for a while, as its input is not in step with the blocks
+				for _ in range(30):
+					program["numpy_process"]()
+
+				program["np"] = counting_np
+				try:
+					for _ in range(5):
+						before = kept(program)
+						program["numpy_process"]()
+						assert not created, (code, created)
+						assert all(before.get(x, lambda: None)() is y() for x, y in kept(program).items()), code
+				finally:
+					program["np"] = np
+
+
+def test_voice_matrix() -> None:
+	import contextlib
+	import io
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+
+	program = {}
+	exec("\n".join(_header_code(4)), program)
+	Signal = program["Signal"]
+
+	signal = Signal()
+	signal.align([3, 1])[:] = [[3] * 4, [1] * 4]
+	assert signal.new == [0, 1]
+	assert signal.voices[1].tolist() == [1] * 4
+
+	# Voices keep their values when others come and go
+	matrix = signal.align([1, 5, 3])
+	assert signal.new == [1]
+	assert matrix[0].tolist() == [1] * 4 and matrix[2].tolist() == [3] * 4
+	assert signal.align([1, 5, 3]) is matrix and signal.new == []
+
+	signal.release(5)
+	assert signal.ids == [1, 3] and list(signal.voices) == [1, 3]
+	assert signal.voices[3].tolist() == [3] * 4
+	signal.buffer(7)
+	assert signal.slots == {1: 0, 3: 1, 7: 2}
+
+	# A node keeps a row of another signal across two blocks, so the replaced matrix is not reused
+	program = {}
+	exec("\n".join(_header_code(4)), program)
+	Signal = program["Signal"]
+
+	signal = Signal()
+	signal.align([1, 2])[:] = [[1] * 4, [2] * 4]
+	kept = signal.voices[2]
+	program["recycle"]()  # Next block
+	signal.align([2])
+	program["recycle"]()
+	other = Signal()
+	other.align([1, 2]).fill(9)
+	assert kept.tolist() == [2] * 4 and kept.base is not other.matrix
+	program["recycle"]()
+	assert len(program["_RETIRED"]) == 1 and not program["_POOL"].get((2, 4, "float32"))
+
+	# Until nothing references it anymore
+	del kept
+	program["recycle"]()
+	assert not program["_RETIRED"] and len(program["_POOL"][(2, 4, "float32")]) == 1
+
+	# All voices of a node are calculated at once
+	context: Context = load("_v = unison(110, 3)\nout(sine(_v * sine(1) + _v) * 0.5)")
+	graph, node_ids = build_node_graph(context)
+	code = compile_to_numpy(CompilationContext(context, graph, node_ids, execution_order(graph, node_ids)), 16, 1000)
+	assert "for " not in code[code.index("def numpy_process"):]
+
+	program = {}
+	exec(code, program)
+	with contextlib.redirect_stdout(io.StringIO()):
+		result = program["numpy_process"]()["unnamed_0"]
+
+	assert result.matrix.shape == (3, 16)
+	assert all(np.array_equal(result.voices[x], result.matrix[0]) for x in result.ids)
+
+
+def test_float32_signals() -> None:
+	import contextlib
+	import io
+	import tempfile
+	import numpy as np
+	from aim.nodes import load, build_node_graph, execution_order
+
+	with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+		f.write("0 0.01 c4\n0.02 0.01 e4\n")
+		f.flush()
+
+		for code in (
+			"out(sine(440)); out(square(440, duty=sine(1))); out(saw(sine(2) * 10 + 440))",
+			"out(add(sine(3), 1) / 2 - sine(4) * 3); out(sine(7) > 0); out(2 < sine(7)); out(add(1, 2))",
+			"out(mix(sine(20), saw(35), 0.2)); out(mix(1, sine(20), fac=sine(1))); out(clip(sine(10) * 3, -0.5, 0.8))",
+			"out(trigger(sine(7), 0.6, -0.6)); out(trigger(sine(7), on=saw(3), off=-0.5))",
+			"out(time()); out(sine(time() * 100 + 20)); out(time(voice_trigger=unison(1, 2)))",
+			"out(dB(sine(2) * 6)); out(dB(-6)); out(one()); out(random()); out(noise())",
+			"out(sine(unison(440, 4)) * sine(3)); out(downmix(saw(unison(220, 3))))",
+			"out(clip(mix(sine(20), saw(35), 0.2) * 3, -0.5, 0.8) > 0.1)",
+			"put('a', sine(5)); out(get('a') * 2); out(hold(sine(unison(3, 2)))); out(one(sine(unison(3, 2)))); out(random(sine(unison(3, 2))))",
+			f"out(sine(frequency(polyphonic(score({f.name!r})))) + square(frequency(440)))",
+		):
+			context: Context = load(code)
+			graph, node_ids = build_node_graph(context)
+			order = execution_order(graph, node_ids)
+			program = {}
+			exec(compile_to_numpy(CompilationContext(context, graph, node_ids, order), frame_count=512), program)
+
+			with contextlib.redirect_stdout(io.StringIO()):
+				for _ in range(5):
+					output = program["numpy_process"]()
+
+					# Outputs of all nodes. State with other dtypes, like clocks, are a single column
+					signals = [x for x in program.values() if isinstance(x, program["Signal"]) and x.width > 1]
+					assert set(map(id, output.values())) <= set(map(id, signals))
+
+					for signal in signals:
+						assert signal.matrix is None or signal.matrix.dtype == np.float32, code
+						for voice in signal.voices.values():
+							assert isinstance(voice, np.ndarray) and voice.dtype == np.float32, code
+
+
+def test_concurrent_compiles() -> None:
+	from concurrent.futures import ThreadPoolExecutor
+	from aim.nodes import load, build_node_graph, execution_order
+
+	def compile_text(code: str) -> str:
+		context: Context = load(code)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph, node_ids)
+		return compile_to_numpy(CompilationContext(context, graph, node_ids, order), frame_count=10)
+
+	projects = [
+		f"_a = sine({i}); out(_a * 0.5 + square(_a)); out(trigger(sine(2) + {i}))"
+		for i in range(8)
+	]
+
+	expected = [compile_text(x) for x in projects]
+
+	# The same project always compiles to the same program
+	assert expected == [compile_text(x) for x in projects]
+
+	with ThreadPoolExecutor(8) as executor:
+		for _ in range(4):
+			assert list(executor.map(compile_text, projects)) == expected
+
+
+def run_code_for_testing(code: str, frame_count=10, sample_rate=48000, optimized=False) -> Any:
+	from aim.nodes import load, build_node_graph, execution_order
+	from aim.optimizer import optimize
+
 	context: Context = load(code)
 	graph, node_ids = build_node_graph(context)
+
+	if optimized:
+		graph, node_ids, _ = optimize(context, graph, node_ids)
+
 	order = execution_order(graph)
 	compilation_context = CompilationContext(context, graph, node_ids, order)
-	code: str = compile_to_numpy(compilation_context, frame_count=10, sample_rate=sample_rate)
+	code: str = compile_to_numpy(compilation_context, frame_count=frame_count, sample_rate=sample_rate)
 
 	code += "\nresult = numpy_process()"
 
@@ -0,0 +1,333 @@
+"""
+Optimizes the node graph before it is compiled
+
+Runs between build_node_graph and compile_to_numpy. Folds constant subgraphs into plain numbers,
+removes identities like "x + 0" and "x * 1", merges nodes that would compute exactly the same, and
+then drops every node that no OutNode reaches anymore.
+"""
+from typing import Any, Optional
+
+from aim.nodes import (
+	Node, OutNode, Outlet, Context, DataType, build_node_graph, execution_order,
+	add, sub, mul, div, gt, lt, mix, clip, dB, downmix, sine, square, saw, time, one, frequency,
+	random, noise, out, unison, trigger, oscilloscope, midi, polyphonic, spawn, use,
+)
+
+
+# Nodes that can not be merged with an identical node. They either have side effects, are random,
+# or create new voices that must stay unique for each of them.
+_NOT_MERGEABLE = (OutNode, noise, random, midi, unison, polyphonic, spawn, use)
+
+
+_OPERATORS = {
+	add: lambda a, b: a + b,
+	sub: lambda a, b: a - b,
+	mul: lambda a, b: a * b,
+	div: lambda a, b: a / b,
+	gt: lambda a, b: float(a > b),
+	lt: lambda a, b: float(a < b),
+}
+
+
+# Inlets that the numpy_backend accepts plain numbers on. A folded node is only replaced by its
+# value where the receiving inlet supports it, otherwise the node is kept.
+_CONSTANT_INLETS = {
+	**{x: {"in0", "in1"} for x in _OPERATORS},
+	mix: {"in0", "in1", "fac"},
+	clip: {"minimum", "maximum"},
+	dB: {"decibel"},
+	sine: {"frequency", "phase"},
+	saw: {"frequency", "phase"},
+	square: {"frequency", "duty", "phase"},
+	trigger: {"on", "off"},
+	oscilloscope: {"time_div"},
+	frequency: {"input"},
+	one: {"input"},
+	unison: {"input"},
+	out: {"input"},
+}
+
+
+def optimize(
+	context: Context,
+	graph: dict[int, set[int]],
+	node_ids: dict[int, Node],
+) -> tuple[dict[int, set[int]], dict[int, Node], int]:
+	"""
+	Optimize the graph in place
+
+	Returns the new graph and node_ids, and the number of nodes that got removed.
+	"""
+	replacements: dict[int, Any] = {}  # Node id -> number or Outlet that replaces its output
+	mono: dict[int, bool] = {}
+
+	for node_id in execution_order(graph, node_ids):
+		node = node_ids[node_id]
+
+		_substitute(node, replacements)
+
+		mono[node_id] = _is_mono(node, mono)
+
+		replacement = _fold(node, mono)
+		if replacement is not None:
+			replacements[node_id] = replacement
+
+	merged = _merge_identical(graph, node_ids)
+
+	if not replacements and not merged:
+		return graph, node_ids, 0
+
+	# Nodes that got folded away or merged are not reachable from any OutNode anymore
+	new_graph, new_node_ids = build_node_graph(context)
+
+	return new_graph, new_node_ids, len(node_ids) - len(new_node_ids)
+
+
+def _merge_identical(graph: dict[int, set[int]], node_ids: dict[int, Node]) -> int:
+	"""
+	Common-subexpression elimination
+
+	Nodes of the same class with the same inputs compute the same output, e.g "sine(220)" written
+	in several places. Every such node is replaced by the first one of them, so that only one of
+	them does any work. Inputs are resolved after earlier merges, so whole identical chains collapse.
+
+	Returns the number of nodes that got merged into another.
+	"""
+	canonical: dict[tuple, Node] = {}
+	replacements: dict[int, Outlet] = {}  # id() of Outlet -> Outlet on the node replacing it
+	merged = 0
+
+	for node_id in execution_order(graph, node_ids):
+		node = node_ids[node_id]
+
+		for name, value in node._inlets.items():
+			if isinstance(value, Outlet) and id(value) in replacements:
+				setattr(node, name, replacements[id(value)])
+				node._inlets[name] = replacements[id(value)]
+
+		if isinstance(node, _NOT_MERGEABLE):
+			continue
+
+		key = _node_key(node)
+		if key is None:
+			continue
+
+		if key not in canonical:
+			canonical[key] = node
+			continue
+
+		for name, outlet in node._outlets.items():
+			replacements[id(outlet)] = canonical[key]._outlets[name]
+
+		merged += 1
+
+	return merged
+
+
+def _node_key(node: Node) -> Optional[tuple]:
+	"""
+	Hashable key of the node class and its resolved inputs, or None if it has inputs we can not compare
+	"""
+	key: list[Any] = [node.__class__]
+
+	for name, value in node._inlets.items():
+		if isinstance(value, Outlet):
+			outlet_name = next(k for k, v in value.node._outlets.items() if v is value)
+			key.append((name, id(value.node), outlet_name))
+		elif value is None or isinstance(value, (int, float, str)):
+			key.append((name, type(value), value))
+		else:
+			return None
+
+	return tuple(key)
+
+
+def _substitute(node: Node, replacements: dict[int, Any]) -> None:
+	"""
+	Point our inlets to what replaces the nodes we read from
+	"""
+	for name, value in node._inlets.items():
+		if not isinstance(value, Outlet) or id(value.node) not in replacements:
+			continue
+
+		replacement = replacements[id(value.node)]
+
+		if isinstance(replacement, Outlet) or name in _CONSTANT_INLETS.get(node.__class__, ()):
+			setattr(node, name, replacement)
+			node._inlets[name] = replacement
+
+
+def _is_number(value: Any) -> bool:
+	return isinstance(value, (int, float))
+
+
+def _is_mono(node: Node, mono: dict[int, bool]) -> bool:
+	"""
+	If the output of the node never has other voices than voice 0
+	"""
+	def mono_input(value: Any) -> bool:
+		if _is_number(value):
+			return True
+
+		return isinstance(value, Outlet) and mono.get(id(value.node), False)
+
+	if isinstance(node, (sine, square, saw)):
+		return _is_number(node.frequency)
+
+	if node.__class__ in _OPERATORS or isinstance(node, mix):
+		return mono_input(node.in0) and mono_input(node.in1)
+
+	if isinstance(node, clip):
+		return mono_input(node.value)
+
+	if isinstance(node, time):
+		return not node.voice_trigger
+
+	if isinstance(node, (one, frequency)):
+		return node.input is None or _is_number(node.input)
+
+	if isinstance(node, random):
+		return node.input is None
+
+	if isinstance(node, noise):
+		return not isinstance(node.voices, Outlet)
+
+	return isinstance(node, downmix)
+
+
+def _fold(node: Node, mono: dict[int, bool]) -> Optional[Any]:
+	"""
+	Return what the output of the node can be replaced with, if anything
+	"""
+	if node.__class__ in _OPERATORS:
+		a, b = node.in0, node.in1
+
+		if _is_number(a) and _is_number(b):
+			if isinstance(node, div) and b == 0:
+				return None  # Leave it to the backend
+
+			return _OPERATORS[node.__class__](a, b)
+
+		# "x * 0" is silence, but only if x can not create more voices than voice 0
+		if isinstance(node, mul):
+			for x, y in ((a, b), (b, a)):
+				if _is_number(x) and x == 0 and isinstance(y, Outlet) and mono.get(id(y.node)):
+					return 0
+
+		# Identities, where we can forward the other input as it is
+		identities = {
+			add: ((0, "in0", "in1"), (0, "in1", "in0")),
+			sub: ((0, "in1", "in0"),),
+			mul: ((1, "in0", "in1"), (1, "in1", "in0")),
+			div: ((1, "in1", "in0"),),
+		}
+
+		for identity, constant, other in identities.get(node.__class__, ()):
+			x, y = getattr(node, constant), getattr(node, other)
+			if _is_number(x) and x == identity and isinstance(y, Outlet) and y.datatype == DataType.SIGNAL:
+				return y
+
+	elif isinstance(node, mix):
+		if _is_number(node.in0) and _is_number(node.in1) and _is_number(node.fac):
+			fac = (max(min(node.fac, 1), -1) + 1) / 2
+			return node.in0 * (1 - fac) + node.in1 * fac
+
+	elif isinstance(node, clip):
+		if _is_number(node.value) and _is_number(node.minimum) and _is_number(node.maximum):
+			return min(max(node.value, node.minimum), node.maximum)
+
+	elif isinstance(node, dB):
+		if _is_number(node.decibel):
+			return 10 ** (node.decibel / 20)
+
+	return None
+
+
+def _optimize_code(code: str) -> tuple[Context, dict[int, Node], int]:
+	from aim.nodes import load
+
+	context = load(code)
+	graph, node_ids = build_node_graph(context)
+	graph, node_ids, removed = optimize(context, graph, node_ids)
+
+	return context, node_ids, removed
+
+
+def test_constant_folding() -> None:
+	context, node_ids, removed = _optimize_code("out(add(0,1) + 5 + add(2,0) / add(4,0) * 2)")
+
+	assert removed == 7, removed
+	assert list(node_ids.values()) == context.out_nodes
+	assert context.out_nodes[0].input == 1 + 5 + 2 / 4 * 2
+
+
+def test_identities() -> None:
+	context, node_ids, removed = _optimize_code("out(sine(440) * 0)")
+	assert removed == 2
+	assert context.out_nodes[0].input == 0
+
+	# Forwarded as it is
+	context, node_ids, removed = _optimize_code("_a = sine(440); out((_a + 0) * 1 - 0)")
+	assert removed == 3, removed
+	assert context.out_nodes[0].input.node.__class__ is sine
+
+	# Voices of unison can not be replaced by a single voice
+	context, node_ids, removed = _optimize_code("out(sine(unison(440, 2)) * 0)")
+	assert removed == 0
+	assert isinstance(context.out_nodes[0].input.node, mul)
+
+
+def test_inlets_not_accepting_constants() -> None:
+	# Clip does not support numbers on its "value" input, so mul() is kept, with folded inputs
+	context, node_ids, removed = _optimize_code("out(clip(add(1, 1) * 1, dB(-6), dB(0)))")
+
+	assert removed == 3, removed
+	clip_node = context.out_nodes[0].input.node
+	assert clip_node.value.node.__class__ is mul
+	assert (clip_node.value.node.in0, clip_node.value.node.in1) == (2, 1)
+	assert clip_node.minimum == 10 ** (-6 / 20)
+	assert clip_node.maximum == 1
+
+
+def test_merge_identical() -> None:
+	context, node_ids, removed = _optimize_code("out(sine(220) + sine(220) * sine(220))")
+
+	assert removed == 2, removed
+	_add = context.out_nodes[0].input.node
+	assert _add.in0.node is _add.in1.node.in0.node is _add.in1.node.in1.node
+
+	# Whole chains collapse. Outputs are never merged
+	context, node_ids, removed = _optimize_code("out(sine(sine(2) * 5) + 1); out(sine(sine(2) * 5) + 1)")
+	assert removed == 4, removed
+	assert context.out_nodes[0].input is context.out_nodes[1].input
+
+	# Different inputs, or nodes creating voices, are kept
+	context, node_ids, removed = _optimize_code("out(sine(220) + sine(221)); out(unison(1, 2) + unison(1, 2))")
+	assert removed == 0, removed
+	assert len(node_ids) == 8
+
+
+def test_optimized_output() -> None:
+	import numpy as np
+	from aim.numpy_backend import run_code_for_testing
+
+	for code in (
+		"out(add(0,1) + 5 + add(2,0) / add(4,0) * 2)",
+		"out(sine(440) * 0 + sine(220))",
+		"out(mix(sine(440), 2, 0))",
+		"out((sine(440) + 0) * 1 - 0)",
+		"out(sine(unison(440, 2)) * 0)",
+		"out(sine(220) + sine(220) * sine(unison(220, 2)) + sine(unison(220, 2)))",
+	):
+		expected = run_code_for_testing(code)["unnamed_0"].voices
+		result = run_code_for_testing(code, optimized=True)["unnamed_0"].voices
+
+		assert set(expected) == set(result), code
+		for voice_id in expected:
+			assert np.allclose(expected[voice_id], result[voice_id]), code
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,152 @@
+"""
+Mixes the outputs of a program into audio channels
+
+Used both for the sound card (audio_interface.py) and when rendering to a file (render.py), so
+that they sound the same.
+
+Where a voice goes is decided by, in order:
+
+	channel_map of the signal, by voice id: a channel, or {channel: gain, ...} to send it to several
+	the name of the out node: "left", "right" or "channel_<n>", counting from 1, for all its voices
+	the voice id: voice_id % channel_count, like before there was routing
+
+Voices are scaled by GAIN, unless channel_map gives a gain. The gains of all the voices are kept
+as a matrix, only made again when the voices change, and the mixdown of a block is a single
+matrix multiplication of all the voices, however many outputs and voices there are.
+"""
+import re
+from typing import Optional
+
+import numpy as np
+
+CHANNEL_COUNT = 2  # Default, see Profile.channel_count
+GAIN = .1
+
+NAMED_CHANNELS = {"left": 0, "right": 1}
+
+
+def channel_of_name(name: str) -> Optional[int]:
+	"""
+	Channel that the out node with name goes to, or None if it is routed by voice id
+	"""
+	if name in NAMED_CHANNELS:
+		return NAMED_CHANNELS[name]
+
+	if match := re.fullmatch(r"channel_(\d+)", name):
+		assert int(match[1]) > 0, f"Channels of out({name!r}) count from 1"
+		return int(match[1]) - 1
+
+	return None
+
+
+class Mixer:
+	def __init__(self, frame_count: int, channel_count: int = CHANNEL_COUNT):
+		self.frame_count = frame_count
+		self.channel_count = channel_count
+
+		self._routing: Optional[list] = None  # What the gains were made for
+		self._gains = np.zeros((0, channel_count), dtype='float32')  # A row for each voice
+		self._voices = np.zeros((0, frame_count), dtype='float32')  # All the voices, stacked
+
+	def mix(self, program: dict, outputs: dict, outdata: np.ndarray) -> None:
+		"""
+		Mix the signal outputs of the program into outdata, which has one column per channel
+		"""
+		assert outdata.shape == (self.frame_count, self.channel_count), outdata.shape
+
+		signal_type = program["Signal"]
+		voice_rows = program["voice_rows"]
+
+		# TODO merayen handle midi outputs too... Send to hardware devices?
+		rows = [(name, *voice_rows(out)) for name, out in outputs.items() if isinstance(out, signal_type)]
+		routing = [(name, ids, outputs[name].channel_map) for name, ids, _ in rows]
+
+		if routing != self._routing:
+			self._route(routing)
+
+		if not len(self._gains):
+			outdata.fill(0)
+			return
+
+		if len(rows) == 1:
+			voices = rows[0][2]
+		else:
+			voices = np.concatenate([x[2] for x in rows], out=self._voices)
+
+		np.matmul(voices.T, self._gains, out=outdata)
+
+	def _route(self, routing: list) -> None:
+		gains = []
+
+		for name, ids, channel_map in routing:
+			channel = channel_of_name(name)
+
+			for voice_id in ids:
+				row = np.zeros(self.channel_count, dtype='float32')
+
+				if (mapped := channel_map.get(voice_id)) is not None:
+					for index, gain in (mapped.items() if isinstance(mapped, dict) else [(mapped, GAIN)]):
+						row[index % self.channel_count] += gain
+				elif channel is not None:
+					row[channel % self.channel_count] = GAIN
+				else:
+					row[voice_id % self.channel_count] = GAIN
+
+				gains.append(row)
+
+		# Copied, as the voice ids of the signals are changed in place by the program
+		self._routing = [(name, list(ids), dict(channel_map)) for name, ids, channel_map in routing]
+		self._gains = np.array(gains, dtype='float32').reshape(len(gains), self.channel_count)
+		self._voices = np.zeros((len(gains), self.frame_count), dtype='float32')
+
+
+def test_mixer() -> None:
+	import contextlib
+	import io
+	from aim.nodes import load, build_node_graph, execution_order, CompilationContext
+	from aim.numpy_backend import IncrementalCompiler
+
+	def program_of(text: str) -> dict:
+		context = load(text)
+		graph, node_ids = build_node_graph(context)
+		order = execution_order(graph)
+		program = {}
+		exec(IncrementalCompiler(10, 1000).compile(CompilationContext(context, graph, node_ids, order)), program)
+		return program
+
+	program = program_of(
+		"out(0.5)\n"  # Voice 0, to channel 0
+		"out(unison(0.25, 3))\n"  # Voices 1, 2 and 3, by voice id
+		"out(1, name='right')\n"
+		"out(2, name='channel_4')\n"
+	)
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		outputs = program["numpy_process"]()
+
+	mixer = Mixer(10, 4)
+	outdata = np.ones((10, 4), dtype='float32')
+	mixer.mix(program, outputs, outdata)
+	assert np.allclose(outdata, [[0.5 * GAIN, 0.25 * GAIN + 1 * GAIN, 0.25 * GAIN, 0.25 * GAIN + 2 * GAIN]])
+
+	# Routed by channel_map
+	outputs["right"].channel_map[0] = {0: 1.0, 2: 0.5}
+	mixer.mix(program, outputs, outdata)
+	assert np.allclose(outdata, [[0.5 * GAIN + 1, 0.25 * GAIN, 0.25 * GAIN + 0.5, 0.25 * GAIN + 2 * GAIN]])
+
+	# Stereo, like before there was routing
+	outdata = np.ones((10, 2), dtype='float32')
+	Mixer(10).mix(program, {"unnamed_1": outputs["unnamed_1"]}, outdata)
+	assert np.allclose(outdata, [[0.25 * GAIN, 0.5 * GAIN]])
+
+	# No outputs
+	Mixer(10).mix(program, {}, outdata)
+	assert not outdata.any()
+
+	assert channel_of_name("channel_1") == 0 and channel_of_name("unnamed_3") is None
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
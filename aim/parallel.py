@@ -0,0 +1,357 @@
+"""
+Runs the independent parts of a project in processes of their own
+
+Nodes that are not connected, through their inputs or through put() and get() of the same label,
+do not affect each other (see nodes.connected_components()). A project with several chains of
+out() nodes is split into parts, at most one per worker, each compiled to a program of its own.
+Each worker runs its program and mixes its outputs into its own ring of blocks in shared memory,
+see output.py. The blocks are then summed into the output, one block at a time.
+
+	aim render --seconds 30 --out bounce.wav --workers 8
+
+Workers do not wait to be asked for a block. They run up to RING_SLOTS blocks ahead, and only wait
+when their ring is full. Each ring has a semaphore counting the free slots, which the worker
+waits on, and one counting the blocks that are ready, which we wait on. The number of blocks a
+worker has made is also in the shared memory, like the counters of transport.py.
+
+Only "aim render" runs the parts in workers. "aim run" plays the whole project in the engine, as
+hot swapping, the node data sent to the listeners and the debug output work on a single program,
+and a block made ahead of time is latency when playing live.
+
+A part has its own voice ids, so outputs that are routed to channels by voice id may land on
+other channels than when the project is run as one program.
+"""
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+
+import numpy as np
+
+from aim.nodes import CompilationContext, connected_components
+
+RING_SLOTS = 4  # Blocks a worker can be ahead of the block being summed
+WORKER_TIMEOUT = 1  # Seconds between checking that a worker we wait for is still running
+
+
+def split(compilation_context: CompilationContext, workers: int) -> list[CompilationContext]:
+	"""
+	Split into at most workers parts, each with whole connected components of the graph
+
+	The components are given to the part with the fewest nodes, largest first. There is always at
+	least one part, also when there are no nodes.
+	"""
+	assert workers > 0
+
+	components = connected_components(compilation_context.graph, compilation_context.node_ids)
+	parts: list[set[int]] = [set() for _ in range(max(1, min(workers, len(components))))]
+
+	for component in sorted(components, key=len, reverse=True):
+		min(parts, key=len).update(component)
+
+	return [
+		CompilationContext(
+			compilation_context.context,
+			{node_id: compilation_context.graph[node_id] for node_id in compilation_context.graph if node_id in part},
+			{node_id: compilation_context.node_ids[node_id] for node_id in compilation_context.node_ids if node_id in part},
+			[node_id for node_id in compilation_context.order if node_id in part],
+		)
+		for part in parts
+	]
+
+
+def block_size(frame_count: int, channel_count: int) -> int:
+	"""
+	Bytes of a block of a worker in the shared memory
+	"""
+	return frame_count * channel_count * 4
+
+
+def control_size(workers: int) -> int:
+	"""
+	Bytes at the start of the shared memory: the stop flag, and the number of blocks each worker has
+	made. Rounded up, so that the blocks after it are aligned
+	"""
+	return ((1 + workers) * 8 + 63) // 64 * 64
+
+
+class ParallelProgram:
+	def __init__(self, codes: list[str], frame_count: int, channel_count: int, slots: int = RING_SLOTS):
+		"""
+		Start a worker for each program in codes, each with a ring of slots blocks
+		"""
+		self.frame_count = frame_count
+		self.channel_count = channel_count
+		self.slots = slots
+
+		self._block = 0  # Number of the next block to sum
+
+		size = control_size(len(codes)) + len(codes) * slots * block_size(frame_count, channel_count)
+		self._memory = shared_memory.SharedMemory(create=True, size=size)
+		self._control = np.ndarray((1 + len(codes),), dtype='<u8', buffer=self._memory.buf)
+		self._control[:] = 0
+		self._blocks = np.ndarray(
+			(len(codes), slots, frame_count, channel_count),
+			dtype='float32',
+			buffer=self._memory.buf,
+			offset=control_size(len(codes)),
+		)
+
+		# Forked, as the worker then has the modules already imported. It is not a thread, so aim
+		# itself does not need to be imported again
+		context = multiprocessing.get_context("fork")
+
+		self._connections: list[Connection] = []  # Report that the worker started, or its error
+		self._free = [context.Semaphore(slots) for _ in codes]  # Slots the worker can fill
+		self._ready = [context.Semaphore(0) for _ in codes]  # Blocks the worker has filled
+		self._processes = []
+
+		try:
+			for index, code in enumerate(codes):
+				connection, worker_connection = context.Pipe()
+				process = context.Process(
+					target=_worker,
+					args=(
+						code, self._memory.name, index, len(codes), frame_count, channel_count, slots,
+						self._free[index], self._ready[index], worker_connection,
+					),
+					daemon=True,
+				)
+				self._connections.append(connection)
+				process.start()
+				worker_connection.close()
+				self._processes.append(process)
+
+			self._started()
+		except BaseException:
+			self.close()  # Stops the workers that did start
+			raise
+
+	def process(self, outdata: np.ndarray) -> None:
+		"""
+		Sum the next block of every worker into outdata, waiting for the workers that are behind
+		"""
+		slot = self._block % self.slots
+
+		for index, ready in enumerate(self._ready):
+			while not ready.acquire(timeout=WORKER_TIMEOUT):
+				if not self._processes[index].is_alive():
+					raise Exception(f"Worker {index} failed:\n{self._error(index)}")
+
+			# A worker that fails says that a block is ready without having made it
+			if self._control[1 + index] <= self._block:
+				raise Exception(f"Worker {index} failed:\n{self._error(index)}")
+
+		np.sum(self._blocks[:, slot], axis=0, out=outdata)
+
+		for free in self._free:
+			free.release()
+
+		self._block += 1
+
+	def close(self) -> None:
+		# Workers waiting for a free slot wake up to see that they should stop
+		self._control[0] = 1
+		for free in self._free:
+			free.release()
+
+		for process in self._processes:
+			process.join()
+
+		for connection in self._connections:
+			connection.close()
+
+		del self._control
+		del self._blocks
+		self._memory.close()
+		self._memory.unlink()
+
+	def _started(self) -> None:
+		for index in range(len(self._connections)):
+			if message := self._error(index):
+				raise Exception(f"Worker {index} failed:\n{message}")
+
+	def _error(self, index: int) -> str:
+		"""
+		Wait for the worker to report that it started, or the error it failed with
+		"""
+		try:
+			return self._connections[index].recv_bytes().decode()
+		except EOFError:
+			return "Stopped"
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+
+def _worker(
+	code: str,
+	memory_name: str,
+	index: int,
+	workers: int,
+	frame_count: int,
+	channel_count: int,
+	slots: int,
+	free,
+	ready,
+	connection: Connection,
+) -> None:
+	"""
+	Run the program of code, a block at a time into the ring of the worker, while it has free slots
+
+	Reports on connection with an empty message when started, or the error.
+	"""
+	from aim.output import Mixer
+
+	# Programs report to the parent process on stdout, which nobody listens to here
+	sys.stdout = open(os.devnull, "w")
+
+	control = None
+	try:
+		memory = shared_memory.SharedMemory(name=memory_name)
+		control = np.ndarray((1 + workers,), dtype='<u8', buffer=memory.buf)
+		offset = control_size(workers) + index * slots * block_size(frame_count, channel_count)
+		blocks = np.ndarray((slots, frame_count, channel_count), dtype='float32', buffer=memory.buf, offset=offset)
+		mixer = Mixer(frame_count, channel_count)
+
+		program: dict = {}
+		exec(compile(code, f"<worker {index}>", "exec"), program)
+		process = program["numpy_process"]
+
+		connection.send_bytes(b"")
+
+		block = 0
+		while True:
+			free.acquire()
+			if control[0]:
+				break  # Stop
+
+			mixer.mix(program, process(), blocks[block % slots])
+			block += 1
+			control[1 + index] = block
+			ready.release()
+	except Exception:
+		connection.send_bytes(traceback.format_exc().encode())
+
+		if control is not None:
+			ready.release()  # Without a block, see ParallelProgram.process()
+	finally:
+		connection.close()
+
+
+def test_parallel_program() -> None:
+	import contextlib
+	import io
+	from aim.nodes import load, build_node_graph, execution_order
+	from aim.numpy_backend import IncrementalCompiler
+	from aim.output import Mixer
+
+	text = "\n".join(
+		[
+			"out(sine(100), name='left')",
+			"out(saw(unison(50, 3)) * 0.5, name='right')",
+			"put('a', sine(3))",
+			"out(get('a') * 0.25, name='channel_1')",
+			"out(square(10))",
+		]
+	)
+
+	def compilation_context_of(text: str) -> CompilationContext:
+		context = load(text, 1000)
+		graph, node_ids = build_node_graph(context)
+		return CompilationContext(context, graph, node_ids, execution_order(graph, node_ids))
+
+	compilation_context = compilation_context_of(text)
+	parts = split(compilation_context, 3)
+	assert len(parts) == 3
+	assert sorted(len(x.order) for x in parts) == [4, 4, 5]  # The two smallest chains share a worker
+	assert sorted(sum((x.order for x in parts), [])) == sorted(compilation_context.order)
+
+	empty = split(compilation_context_of(""), 3)
+	assert len(empty) == 1 and not empty[0].order
+
+	# The same as running the whole project as one program. Parsed again, as nodes keep the
+	# variables of the first program they are compiled to
+	program: dict = {}
+	exec(IncrementalCompiler(10, 1000).compile(compilation_context_of(text)), program)
+	mixer = Mixer(10, 2)
+	expected = np.zeros((10, 2), dtype='float32')
+
+	codes = [IncrementalCompiler(10, 1000).compile(x) for x in parts]
+	result = np.zeros((10, 2), dtype='float32')
+
+	with ParallelProgram(codes, 10, 2) as parallel, contextlib.redirect_stdout(io.StringIO()):
+		for _ in range(5):
+			mixer.mix(program, program["numpy_process"](), expected)
+			parallel.process(result)
+			assert np.allclose(result, expected, atol=1e-6)
+
+		# Workers fill their ring without being asked, and then wait for a free slot
+		ready = 0
+		deadline = time.monotonic() + 10
+		while ready < RING_SLOTS and time.monotonic() < deadline:
+			ready += parallel._ready[0].acquire(timeout=0.01)
+
+		time.sleep(0.05)
+		assert ready == RING_SLOTS and not parallel._ready[0].acquire(block=False)
+
+		for _ in range(ready):
+			parallel._ready[0].release()
+
+		for _ in range(RING_SLOTS * 2):
+			mixer.mix(program, program["numpy_process"](), expected)
+			parallel.process(result)
+			assert np.allclose(result, expected, atol=1e-6)
+
+	# Errors of the workers are raised, after stopping the other workers and freeing the memory
+	memories = []
+	create = shared_memory.SharedMemory
+
+	def track(*args, **kwargs) -> shared_memory.SharedMemory:
+		memories.append(create(*args, **kwargs))
+		return memories[-1]
+
+	shared_memory.SharedMemory = track
+	try:
+		ParallelProgram([codes[0], "1 / 0", codes[1]], 10, 2)
+	except Exception as e:
+		assert "Worker 1 failed" in str(e) and "ZeroDivisionError" in str(e)
+	else:
+		raise Exception("Should have failed")
+	finally:
+		shared_memory.SharedMemory = create
+
+	assert not multiprocessing.active_children()
+
+	# Also when processing a block, which the worker does ahead of time
+	failing = codes[1] + "\n_process = numpy_process\ndef numpy_process():\n\treturn _process() if process_counter < 1 else 1 / 0"
+	with ParallelProgram([codes[0], failing], 10, 2) as parallel:
+		parallel.process(result)
+		parallel.process(result)
+		try:
+			parallel.process(result)
+		except Exception as e:
+			assert "Worker 1 failed" in str(e) and "ZeroDivisionError" in str(e)
+		else:
+			raise Exception("Should have failed")
+
+	assert not multiprocessing.active_children()
+
+	try:
+		shared_memory.SharedMemory(name=memories[0].name)
+	except FileNotFoundError:
+		pass
+	else:
+		raise Exception("Shared memory should have been unlinked")
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,139 @@
+"""
+Configuration of an aim project
+
+Read from aim.json in the folder of the project, which init_folder creates:
+
+	{
+		"profile": "balanced",
+		"profiles": {
+			"my-interface": {"frame_count": 256, "sample_rate": 44100, "buffer_blocks": 3, "channel_count": 8}
+		}
+	}
+
+A profile decides the frame_count and sample_rate that the program is compiled for, that audio
+files are imported with and that the sound card is opened with. A small frame_count gives low
+latency, but Python has to run every node for every block, so a large one spends less of each
+block on overhead. The program runs ahead of the sound card by buffer_blocks blocks, which take up
+slow blocks at the cost of more latency. channel_count is the number of channels the sound card
+is opened with, and files rendered with, see output.py for how outputs are routed to them.
+
+Use "aim run --audio-profile <name>" to run with another profile than the one of aim.json.
+Profiles in aim.json are added to, or replace, the ones in PROFILES.
+"""
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+CONFIG_FILE = "aim.json"
+
+
+@dataclass(frozen=True)
+class Profile:
+	name: str
+	frame_count: int
+	sample_rate: int = 48000
+	buffer_blocks: int = 2  # Depth of the buffer between the program and the sound card
+	channel_count: int = 2
+
+	@property
+	def latency(self) -> float:
+		"""
+		Seconds of one block, which is how long the sound card waits for the first block
+		"""
+		return self.frame_count / self.sample_rate
+
+	@property
+	def buffer_latency(self) -> float:
+		"""
+		Seconds from a block being made until it is played, when the buffer is full
+		"""
+		return self.latency * self.buffer_blocks
+
+
+# Headroom is the duration of a block divided by the time it takes to process it, as measured by
+# benchmark_profiles() with the numpy backend. It is the lowest of the example projects and a
+# unison patch: 99th percentile block, with the mean in parentheses. Below 1 means underruns.
+PROFILES = {
+	"low-latency": Profile("low-latency", 128, buffer_blocks=4),  # 2.7ms per block, headroom 2x (20x)
+	"balanced": Profile("balanced", 1024),  # 21ms per block, headroom 8x (30x)
+	"throughput": Profile("throughput", 2**13),  # 171ms per block, headroom 30x (70x)
+}
+
+# Used when the project has no aim.json. Projects made before there were profiles ran with this
+DEFAULT_PROFILE = "throughput"
+
+# Written to aim.json of new projects
+INIT_PROFILE = "balanced"
+
+
+def init_config(path: str = ".") -> None:
+	with open(path + os.path.sep + CONFIG_FILE, "w") as f:
+		json.dump({"profile": INIT_PROFILE, "profiles": {}}, f, indent="\t")
+		f.write("\n")
+
+
+def load_profile(name: Optional[str] = None, path: str = ".") -> Profile:
+	"""
+	Return the profile with name, or the one chosen in aim.json of the project at path
+	"""
+	try:
+		with open(path + os.path.sep + CONFIG_FILE) as f:
+			config = json.load(f)
+	except FileNotFoundError:
+		config = {}
+
+	profiles = dict(PROFILES)
+	for profile_name, values in config.get("profiles", {}).items():
+		profiles[profile_name] = Profile(
+			profile_name,
+			int(values["frame_count"]),
+			int(values.get("sample_rate", 48000)),
+			int(values.get("buffer_blocks", 2)),
+			int(values.get("channel_count", 2)),
+		)
+
+	name = name or config.get("profile", DEFAULT_PROFILE)
+
+	assert name in profiles, f"Unknown audio profile {name!r}. Available: {', '.join(profiles)}"
+
+	profile = profiles[name]
+
+	assert min(profile.frame_count, profile.sample_rate, profile.buffer_blocks, profile.channel_count) > 0, (
+		f"Invalid audio profile {profile}"
+	)
+
+	return profile
+
+
+def test_load_profile() -> None:
+	import tempfile
+
+	with tempfile.TemporaryDirectory() as path:
+		assert load_profile(path=path) == PROFILES[DEFAULT_PROFILE]
+		assert load_profile("low-latency", path=path).frame_count == 128
+
+		init_config(path)
+		assert load_profile(path=path) == PROFILES[INIT_PROFILE]
+
+		with open(path + os.path.sep + CONFIG_FILE, "w") as f:
+			json.dump({"profile": "mine", "profiles": {"mine": {"frame_count": 256, "sample_rate": 44100}}}, f)
+
+		profile = load_profile(path=path)
+		assert profile == Profile("mine", 256, 44100)
+		assert abs(profile.latency - 256 / 44100) < 1e-12
+		assert profile.buffer_blocks == 2 and profile.channel_count == 2
+		assert load_profile("balanced", path=path) == PROFILES["balanced"]
+
+		try:
+			load_profile("missing", path=path)
+		except AssertionError:
+			pass
+		else:
+			raise Exception("Unknown profiles should not load")
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
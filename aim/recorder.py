@@ -0,0 +1,111 @@
+"""
+Records the audio being played to a file, see "aim run --record"
+
+The thread that runs the programs hands every mixed block to submit(), which copies it into one of
+a fixed number of preallocated blocks and queues it. A thread of our own writes the queued blocks
+to the file, see wav.py. Nothing waits for the disk: if all the blocks are queued, as the disk is
+behind, the block is dropped and counted instead.
+"""
+import math
+import queue
+import threading
+
+import numpy as np
+
+from aim.wav import open_writer
+
+QUEUE_SECONDS = 2  # Of audio that can wait for the disk
+WRITE_BUFFER_SIZE = 2**20  # Bytes written to the file at a time
+
+
+class Recorder:
+	def __init__(self, path: str, frame_count: int, channel_count: int, sample_rate: int):
+		self.path = path
+		self.frame_count = frame_count
+		self.channel_count = channel_count
+		self.sample_rate = sample_rate
+		self.dropped = 0  # Blocks, changed by the thread calling submit()
+
+		blocks = max(4, math.ceil(QUEUE_SECONDS * sample_rate / frame_count))
+		self._free = queue.SimpleQueue()
+		for _ in range(blocks):
+			self._free.put(np.zeros((frame_count, channel_count), dtype='float32'))
+
+		self._queued = queue.SimpleQueue()  # Blocks to write. None stops the writer
+		self._writer = open_writer(path, channel_count, sample_rate, WRITE_BUFFER_SIZE)
+		self._thread = threading.Thread(target=self._write)
+		self._thread.start()
+
+	@property
+	def frames(self) -> int:
+		"""
+		Written to the file so far
+		"""
+		return self._writer.frames
+
+	def submit(self, block: np.ndarray) -> bool:
+		"""
+		Queue a copy of block for writing. Returns False if it was dropped
+		"""
+		try:
+			copy = self._free.get_nowait()
+		except queue.Empty:
+			self.dropped += 1
+			return False
+
+		copy[:] = block
+		self._queued.put(copy)
+
+		return True
+
+	def close(self) -> None:
+		"""
+		Write what is queued and close the file
+		"""
+		self._queued.put(None)
+		self._thread.join()
+
+	def _write(self) -> None:
+		try:
+			while (block := self._queued.get()) is not None:
+				self._writer.write(block)
+				self._free.put(block)
+		finally:
+			self._writer.close()
+
+
+def test_recorder() -> None:
+	import os
+	import tempfile
+	import time
+
+	with tempfile.TemporaryDirectory() as folder:
+		path = folder + os.path.sep + "out.raw"
+		recorder = Recorder(path, 10, 2, 1000)
+		block = np.arange(20, dtype='float32').reshape(10, 2)
+
+		for i in range(5):
+			assert recorder.submit(block + i)
+
+		recorder.close()
+
+		data = np.fromfile(path, dtype='<f4').reshape(-1, 2)
+		assert np.array_equal(data, np.concatenate([block + i for i in range(5)]))
+		assert recorder.frames == 50 and recorder.dropped == 0
+
+		# The disk does not keep up
+		recorder = Recorder(path, 100, 2, 1000)  # Room for 20 blocks
+		write = recorder._writer.write
+		recorder._writer.write = lambda frames: (time.sleep(0.01), write(frames))
+
+		results = [recorder.submit(np.zeros((100, 2), dtype='float32')) for _ in range(100)]
+		recorder.close()
+
+		assert not all(results) and recorder.dropped == results.count(False)
+		assert recorder.frames == results.count(True) * 100
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
@@ -0,0 +1,158 @@
+"""
+Renders a project to a file, as fast as possible
+
+No sound card is involved. numpy_process() is called in a loop and every block is written to the
+file as soon as it is made, so the render is never kept in memory. Large blocks are used, as
+latency does not matter here, only how much of the time Python spends on the overhead of a block.
+
+	aim render --seconds 30 --out bounce.wav
+
+With --workers, the parts of the project that are not connected run in processes of their own,
+see parallel.py.
+"""
+import contextlib
+import os
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from aim.nodes import build_node_graph, execution_order, CompilationContext, load
+from aim.optimizer import optimize
+from aim.output import CHANNEL_COUNT, Mixer
+from aim.parallel import ParallelProgram, split
+from aim.project import Profile
+from aim.run import COMPILERS
+from aim.wav import open_writer
+
+RENDER_FRAME_COUNT = 2**14
+
+
+@dataclass
+class RenderResult:
+	seconds: float  # Of audio written
+	compile_time: float
+	render_time: float
+
+	@property
+	def realtime_factor(self) -> float:
+		return self.seconds / self.render_time
+
+
+def compile_program(text: str, frame_count: int, sample_rate: int, backend: str = "numpy") -> dict:
+	"""
+	Compile main.py text and return the namespace of the program
+	"""
+	code, = compile_parts(text, frame_count, sample_rate, backend)
+
+	program: dict = {}
+	exec(compile(code, "<render>", "exec"), program)
+
+	return program
+
+
+def compile_parts(text: str, frame_count: int, sample_rate: int, backend: str = "numpy", workers: int = 1) -> list[str]:
+	"""
+	Compile main.py text to at most workers programs, that together make the whole project
+	"""
+	context = load(text, sample_rate)
+	graph, node_ids = build_node_graph(context)
+	graph, node_ids, _ = optimize(context, graph, node_ids)
+	order = execution_order(graph, node_ids)
+	compilation_context = CompilationContext(context, graph, node_ids, order)
+
+	if workers == 1:
+		return [COMPILERS[backend](frame_count, sample_rate).compile(compilation_context)]
+
+	# Each part has its own compiler, as they are separate programs
+	return [COMPILERS[backend](frame_count, sample_rate).compile(x) for x in split(compilation_context, workers)]
+
+
+def render(
+	text: str,
+	seconds: float,
+	path: str,
+	profile: Profile,
+	backend: str = "numpy",
+	frame_count: int = RENDER_FRAME_COUNT,
+	workers: int = 1,
+) -> RenderResult:
+	"""
+	Render seconds of main.py text to path, at the sample rate of the profile
+
+	With more than 1 worker, the independent parts of the project are run in parallel.
+	"""
+	assert seconds > 0, "Nothing to render"
+	assert workers > 0, "Needs a worker"
+
+	start = time.perf_counter()
+	codes = compile_parts(text, frame_count, profile.sample_rate, backend, workers)
+
+	with contextlib.ExitStack() as stack:
+		if len(codes) > 1:
+			process = stack.enter_context(ParallelProgram(codes, frame_count, profile.channel_count)).process
+		else:
+			program: dict = {}
+			exec(compile(codes[0], "<render>", "exec"), program)
+			mixer = Mixer(frame_count, profile.channel_count)
+			process = lambda outdata: mixer.mix(program, program["numpy_process"](), outdata)
+
+		compile_time = time.perf_counter() - start
+
+		remaining = round(seconds * profile.sample_rate)
+		outdata = np.zeros((frame_count, profile.channel_count), dtype='float32')
+
+		start = time.perf_counter()
+
+		# Programs report to the parent process on stdout, which nobody listens to here
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			with open_writer(path, profile.channel_count, profile.sample_rate) as writer:
+				while remaining > 0:
+					process(outdata)
+					writer.write(outdata[:remaining])
+					remaining -= frame_count
+
+	return RenderResult(writer.frames / profile.sample_rate, compile_time, time.perf_counter() - start)
+
+
+def test_render() -> None:
+	import tempfile
+	from aim.wav import WavWriter
+
+	with tempfile.TemporaryDirectory() as folder:
+		path = folder + os.path.sep + "out.wav"
+		result = render("out(sine(100)); out(sine(unison(50, 2)))", 0.5, path, Profile("test", 64, 1000), frame_count=64)
+
+		assert result.seconds == 0.5
+		assert result.realtime_factor > 0
+
+		with open(path, "rb") as f:
+			data = np.frombuffer(f.read()[WavWriter.HEADER_SIZE:], dtype='<f4').reshape(-1, CHANNEL_COUNT)
+
+		assert data.shape == (500, CHANNEL_COUNT)
+
+		# sine(100) is voice 0, which goes to the left channel, as does voice 2 of unison
+		t = np.arange(1, 501) / 1000  # Oscillators advance before the first sample
+		assert np.allclose(data[:, 0], (np.sin(t * 100 * 2 * np.pi) + np.sin(t * 50 * 2 * np.pi)) * .1, atol=1e-3)
+		assert np.allclose(data[:, 1], np.sin(t * 50 * 2 * np.pi) * .1, atol=1e-3)
+
+		# The same, with the two outputs in processes of their own
+		parallel_path = folder + os.path.sep + "parallel.wav"
+		render("out(sine(100)); out(sine(50), name='left'); out(sine(50), name='right')", 0.5, parallel_path, Profile("test", 64, 1000), frame_count=64, workers=2)
+
+		with open(parallel_path, "rb") as f:
+			parallel = np.frombuffer(f.read()[WavWriter.HEADER_SIZE:], dtype='<f4').reshape(-1, CHANNEL_COUNT)
+
+		assert np.allclose(parallel, data, atol=1e-4)  # Rounding differs between the programs
+
+		# Nothing to split
+		render("", 0.1, parallel_path, Profile("test", 64, 1000), frame_count=64, workers=2)
+
+		with open(parallel_path, "rb") as f:
+			assert not np.frombuffer(f.read()[WavWriter.HEADER_SIZE:], dtype='<f4').any()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
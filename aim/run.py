@@ -8,49 +8,254 @@ import os
 import queue
 import subprocess
 import sys
+import threading
+from typing import Optional
 
-from aim.nodes import build_node_graph, execution_order, CompilationContext, Context
-from aim.numpy_backend import compile_to_numpy
+from aim.cache import CachedProgram, CompileCache
+from aim.nodes import build_node_graph, execution_order, CompilationContext, Context, load, _validate_python
+from aim.numba_backend import NumbaCompiler
+from aim.numpy_backend import IncrementalCompiler
+from aim.optimizer import optimize
+from aim.project import Profile, load_profile
+from aim.transport import ENVIRONMENT_VARIABLE, RingBuffer
+
+STOP_TIMEOUT = 5  # Seconds the engine has to stop by itself, before it is killed
+
+# Compilers of the backends, by the name used on the command line
+COMPILERS = {
+	"numpy": IncrementalCompiler,
+	"numba": NumbaCompiler,
+}
 
 
 class CompileAndRun:
-	def __init__(self, context: Context):
-		self.context = context
+	def __init__(
+		self,
+		path: str,
+		use_cache: bool = True,
+		backend: str = "numpy",
+		profile: Optional[Profile] = None,
+		profile_nodes: Optional[int] = None,
+		debug: bool = False,
+		record: Optional[str] = None,
+	):
+		"""
+		Compile and run main.py at path. It is watched and recompiled on changes
+
+		If use_cache is False, the program is compiled even if it is in the compile cache. The audio
+		profile is the one of aim.json, if not given.
+
+		If profile_nodes is given, the nodes are timed while running, and that many of the slowest
+		are printed about once per second.
+
+		If debug is True, print nodes and the debug output of other nodes are compiled in.
+
+		If record is given, what is played is written to that file, as WAV if it ends with .wav, or
+		else as raw float32.
+		"""
+		self.context: Optional[Context] = None
+		self._path = path
+		self._record = record
 		self._messages_to_listeners = queue.Queue()
 		self._running = True
+		self._process = None
+		self._listeners = {}
 
-		graph, self._node_ids = build_node_graph(self.context)
-		self._order = execution_order(graph)
+		# Samples from the nodes, like oscilloscope buffers, are sent in shared memory instead of stdout
+		self._data = RingBuffer.create()
+		self._dropped = 0
 
-		compilation_context = CompilationContext(self.context, graph, self._node_ids, self._order)
-		code: str = compile_to_numpy(compilation_context)
+		self.profile = profile or load_profile(path=os.path.dirname(os.path.abspath(path)))
+		print(
+			f"Audio profile {self.profile.name}: {self.profile.frame_count} frames at {self.profile.sample_rate}Hz, "
+			f"{self.profile.latency*1000:.1f}ms per block, {self.profile.buffer_blocks} blocks buffered "
+			f"({self.profile.buffer_latency*1000:.1f}ms), {self.profile.channel_count} channels"
+		)
+
+		self._profile_nodes = profile_nodes
+		options = {}
+		if profile_nodes:
+			if backend != "numpy":
+				raise ValueError("Only the numpy backend can time the nodes")
+			options["profile"] = True
+		if debug:
+			if backend != "numpy":
+				raise ValueError("Only the numpy backend has debug output")
+			options["debug"] = True
 
-		# Add code that plays back
-		with open(f"{os.path.split(__file__)[0]}{os.path.sep}audio_interface.py") as f:
-			code += "\n" + f.read()
+		self._compiler = COMPILERS[backend](self.profile.frame_count, self.profile.sample_rate, **options)
+		backend = "-".join([backend, *options])  # Not the same program
+		self.telemetry: Optional[dict] = None  # Last report of the engine
 
-		with open(".numpy_program.py", "w") as f:
-			f.write(code)
+		self._cache = CompileCache(self._compiler.frame_count, self._compiler.sample_rate, backend)
+		self._program: Optional[CachedProgram] = None
+		self._generation = 0
+		self._preserved: list[str] = []  # Of the compiler, when it compiled _program
+		self._sent: Optional[int] = None  # Generation last sent to the engine
+		self._program_lock = threading.Lock()  # Taken to change or send the fields above
 
-		self._listeners = self.init_listeners()
+		self._mtime = os.stat(path).st_mtime_ns
+
+		with open(path) as f:
+			text = f.read()
+
+		# The cache is only looked up for main.py that is allowed, as the checks may have changed
+		_validate_python(text)
+
+		cached = use_cache and self._cache.lookup(text)
+		if cached:
+			# Compiled before, so the engine can start right away
+			self._program = cached
+			self._generation += 1
+			self._listeners = self.init_listeners(cached.listeners)
+			print("Program loaded from compile cache")
+		else:
+			self._compile(text)
+
+		statistics = self._cache.statistics()
+		print(f"Compile cache: {statistics['hits']} hits, {statistics['misses']} misses")
 
-		import threading
 		self._thread = threading.Thread(target=self.mainloop)
 		self._thread.start()
 
+		if cached:
+			# Compiled again while the engine runs, for the compiler to know the nodes, so that the next
+			# reload only regenerates what changed. The cached program may have been compiled
+			# incrementally, with other variables, and is then replaced
+			try:
+				changed = self._compile(text)
+			except Exception as e:
+				print(f"Could not compile {self._path}: {e!r}")
+			else:
+				if changed and self._process:
+					self._send_program()
+
+	def _compile(self, text: str) -> bool:
+		"""
+		Compile main.py text and store it in the cache
+
+		Returns False if the code is the same as the program we have, so there is nothing to swap in.
+		"""
+		self.context = context = load(text, self._compiler.sample_rate)
+
+		graph, self._node_ids = build_node_graph(self.context)
+
+		graph, self._node_ids, removed = optimize(self.context, graph, self._node_ids)
+		if removed:
+			print(f"Optimizer removed {removed} nodes")
+
+		self._order = execution_order(graph, self._node_ids)
+
+		compilation_context = CompilationContext(self.context, graph, self._node_ids, self._order)
+		code: str = self._compiler.compile(compilation_context)
+
+		unchanged = False
+		if self._program is not None:
+			with open(self._program.path) as f:
+				unchanged = f.read() == code
+
+		listeners = self.listeners_of_nodes()
+		program = self._cache.store(text, code, self._node_ids, listeners, self._compiler.chunks)
+		self._listeners = self.init_listeners(listeners)
+
+		# The mainloop thread may be sending the program we have
+		with self._program_lock:
+			self._program = program
+			if not unchanged:
+				self._generation += 1
+				self._preserved = list(self._compiler.preserved)
+
+		return not unchanged
+
+	def _send_program(self) -> None:
+		"""
+		Tell the engine to swap in the program we compiled last
+		"""
+		with self._program_lock:
+			if self._sent == self._generation:
+				return  # Both the main thread and the mainloop thread may send it at the start
+
+			command = {
+				"program": self._program.path,
+				"bytecode": self._program.bytecode_path,
+				"generation": self._generation,
+				"previous": self._generation - 1 or None,
+				"preserved": self._preserved,
+			}
+
+			self._process.stdin.write(json.dumps(command) + "\n")
+			self._process.stdin.flush()
+			self._sent = self._generation
+
+	def reload(self) -> None:
+		"""
+		Recompile main.py, only regenerating the nodes that changed, and hot swap it in the engine
+		"""
+		with open(self._path) as f:
+			text = f.read()
+
+		try:
+			changed = self._compile(text)
+		except Exception as e:
+			# Keep playing what we have until the user has fixed the error
+			print(f"Could not compile {self._path}: {e!r}")
+			return
+
+		print(f"Recompiled, reusing {self._compiler.reused} nodes and generating {self._compiler.generated}")
+
+		if changed and self._process:
+			self._send_program()
+
 	def stop(self):
 		self._running = False
+
+		if self._process:
+			# The engine stops when there are no more programs, finishing the recording
+			try:
+				self._process.stdin.close()
+			except OSError:
+				pass
+
+			self._thread.join(timeout=STOP_TIMEOUT)
+
+			if self._thread.is_alive():
+				self._process.kill()
+
 		self._thread.join()
+		self._data.close()
 
 	def mainloop(self):
-		# Start a new python interpreter that executes the code
-		# TODO merayen maybe support a daemon that receives this code and executes it, and that allows for module loading and de-loading
-		with subprocess.Popen([sys.executable, ".numpy_program.py"], stdout=subprocess.PIPE, universal_newlines=True) as process:
+		# Start the engine in a new python interpreter. It keeps running and receives new programs
+		# when main.py changes.
+		environment = dict(os.environ)
+		aim_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+		environment["PYTHONPATH"] = os.pathsep.join(filter(None, [aim_path, environment.get("PYTHONPATH")]))
+		environment[ENVIRONMENT_VARIABLE] = self._data.name
+
+		with subprocess.Popen(
+			[
+				sys.executable, "-m", "aim.engine",
+				"--buffer-blocks", str(self.profile.buffer_blocks),
+				"--channels", str(self.profile.channel_count),
+				*(["--record", os.path.abspath(self._record)] if self._record else []),
+			],
+			stdin=subprocess.PIPE,
+			stdout=subprocess.PIPE,
+			universal_newlines=True,
+			env=environment,
+		) as process:
+			self._process = process
+			self._send_program()
+
 			try:
-				while self._running and process.poll() is None:
+				while process.poll() is None:
 					# XXX This should probably have some timeout, in case underlaying program halts or goes
 					# into an endless loop.
-					line = process.stdout.readline().strip()
+					line = process.stdout.readline()
+					if not line:
+						break  # The engine has stopped
+
+					line = line.strip()
 					try:
 						node_data = json.loads(line)
 						if not isinstance(node_data, dict):
@@ -60,8 +265,14 @@ class CompileAndRun:
 						print(f"Invalid output on program stdout: {line!r}")
 						break
 					else:
-						if node_data == {"status": 0}:
-							pass
+						if "telemetry" in node_data:
+							self.telemetry = node_data["telemetry"]
+							if self.telemetry["xruns"] or self.telemetry["underflows"]:
+								print(format_telemetry(self.telemetry, self.profile))
+							if self.telemetry["dropped"]:
+								print(f"Dropped {self.telemetry['dropped']} blocks of the recording, as the disk is behind")
+						elif "profile" in node_data:
+							print(format_profile(node_data["profile"], self._profile_nodes))
 						elif node_data.get("debug"):  # Print to stdout
 							print(f"DEBUG:{node_data['time']:.3f}s:{node_data['node']}:{node_data['name']}: {node_data['data']}")
 						else:
@@ -74,21 +285,135 @@ class CompileAndRun:
 
 			process.kill()
 
-	def init_listeners(self) -> dict:
+	def listeners_of_nodes(self) -> dict[str, str]:
+		"""
+		Name of the nodes that has a listener, keyed by the variable of the node
+		"""
 		import aim.listeners
 
 		result = {}
 		for node_id in self._order:
-			if listener := getattr(aim.listeners, f"{self._node_ids[node_id].__class__.__name__}_listener", None):
-				result[node_id] = listener(self._node_ids[node_id])
+			node = self._node_ids[node_id]
+			if hasattr(aim.listeners, f"{node.__class__.__name__}_listener"):
+				result[node._variable] = node.__class__.__name__
+
+		return result
+
+	def init_listeners(self, listeners: dict[str, str]) -> dict:
+		"""
+		Create listeners for nodes that emit data, keyed by the variable of the node
+
+		Listeners of nodes that were reused by the compiler are kept as they are.
+		"""
+		import aim.listeners
+
+		result = {}
+		for variable, name in listeners.items():
+			if variable in self._listeners:
+				result[variable] = self._listeners[variable]
+			else:
+				result[variable] = getattr(aim.listeners, f"{name}_listener")(variable)
 
 		return result
 
 	def mainloop_mainthread(self):
 		while self._running:  # Or until ctrl-c
+			# Listeners create UI, so main.py is reloaded in this thread
+			if self._path and os.stat(self._path).st_mtime_ns != self._mtime:
+				self._mtime = os.stat(self._path).st_mtime_ns
+				self.reload()
+
+			self.receive_data()
+
 			try:
-				message = self._messages_to_listeners.get(timeout=0.1)
+				message = self._messages_to_listeners.get(timeout=1 / 60)
 			except queue.Empty:
 				continue
 
-			self._listeners[message["node_id"]].receive(**message["data"])
+			if listener := self._listeners.get(message["node_id"]):
+				listener.receive(**message["data"])
+
+	def receive_data(self) -> None:
+		"""
+		Give the samples the engine has sent in shared memory to the listeners
+		"""
+		for node_id, voice_id, samples in self._data.read():
+			if listener := self._listeners.get(f"_{node_id}"):
+				# The listener keeps them, while the memory is reused by the engine
+				listener.receive(voice_id=voice_id, samples=samples.copy())
+
+		if self._data.dropped != self._dropped:
+			print(f"Dropped {self._data.dropped - self._dropped} node data buffers, as the UI is behind")
+			self._dropped = self._data.dropped
+
+
+def format_telemetry(telemetry: dict, profile: Profile) -> str:
+	"""
+	Warning about underruns, from a telemetry report of the engine
+
+	Underflows are of the buffer of the engine, which the program did not keep up with. xruns are
+	of the sound card, when the callback came too late.
+	"""
+	return (
+		f"{telemetry['underflows']} underflows, {telemetry['xruns']} xruns: processing takes {telemetry['load']:.0%} "
+		f"of the time, slowest block {telemetry['slowest']*1000:.2f}ms of {profile.latency*1000:.2f}ms, "
+		f"buffer down to {telemetry['fill']:.1f} of {profile.buffer_blocks} blocks"
+	)
+
+
+def format_profile(profile: dict, count: int = 10) -> str:
+	"""
+	Table of the count nodes that took the most time, from a profile report of the program
+
+	See numpy_backend._profile_code(). The share is of the time there is to process a block, on
+	average over all blocks, so the shares of all the nodes add up to the total.
+	"""
+	blocks = profile["blocks"]
+	budget = profile["budget"]
+
+	lines = [
+		f"Profile of {blocks} blocks: {profile['total']/blocks*1000:.2f}ms of {budget*1000:.2f}ms per block, "
+		f"{profile['total']/blocks/budget:.1%} of the budget",
+		f"{'node':<8} {'class':<14} {'voices':>6} {'blocks':>6} {'per block':>10} {'budget':>7}",
+	]
+
+	for entry in sorted(profile["nodes"], key=lambda x: -x["seconds"])[:count]:
+		lines.append(
+			f"{entry['node']:<8} {entry['class']:<14} {entry['voices']:>6} {entry['blocks']:>6} "
+			f"{entry['seconds']/entry['blocks']*1e6:>8.1f}us {entry['seconds']/blocks/budget:>7.1%}"
+		)
+
+	return "\n".join(lines)
+
+
+def test_format_telemetry() -> None:
+	telemetry = {"blocks": 47, "xruns": 2, "load": 0.5, "slowest": 0.03, "underflows": 3, "fill": 0.0}
+	assert format_telemetry(telemetry, Profile("test", 1024, 51200)) == (
+		"3 underflows, 2 xruns: processing takes 50% of the time, slowest block 30.00ms of 20.00ms, "
+		"buffer down to 0.0 of 2 blocks"
+	)
+
+
+def test_format_profile() -> None:
+	profile = {
+		"blocks": 10,
+		"budget": 0.01,
+		"total": 0.05,
+		"nodes": [
+			{"node": "_1", "class": "sine", "voices": 1, "seconds": 0.001, "blocks": 10},
+			{"node": "_5", "class": "unison", "voices": 8, "seconds": 0.03, "blocks": 10},
+			{"node": "_9", "class": "out", "voices": 8, "seconds": 0.0001, "blocks": 5},
+		],
+	}
+
+	lines = format_profile(profile, 2).splitlines()
+	assert lines[0] == "Profile of 10 blocks: 5.00ms of 10.00ms per block, 50.0% of the budget"
+	assert len(lines) == 4
+	assert lines[2].split() == ["_5", "unison", "8", "10", "3000.0us", "30.0%"]
+	assert lines[3].split() == ["_1", "sine", "1", "10", "100.0us", "1.0%"]
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
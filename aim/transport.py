@@ -0,0 +1,176 @@
+"""
+Sends node data, like oscilloscope buffers, from the engine to the parent process
+
+A ring buffer in shared memory, created by CompileAndRun and given to the engine by name in the
+AIM_DATA environment variable. The program writes a record for every buffer of samples:
+
+	node id   int32    12 for the node variable "_12"
+	voice id  int32
+	length    uint32   Number of samples that follow
+	samples   float32 * length
+
+Writing is a single copy of the samples, and the reader gets them as a NumPy view of the shared
+memory, without copying. There is one writer, the audio thread of the engine, and one reader. The
+writer never waits: when the reader has not made room, the record is dropped and counted.
+
+The position of the writer, of the reader and the number of dropped records are counters that
+only increase, at the start of the shared memory. Each side only writes its own, after the data
+it stands for, so no locking is needed.
+"""
+import struct
+import sys
+from multiprocessing import shared_memory
+from typing import Iterator
+
+import numpy as np
+
+RECORD = struct.Struct("<iiI")
+CONTROL_SIZE = 64  # Write position, read position, dropped records
+WRAP = -1  # Node id of a record telling the reader to go on at the start of the buffer
+
+ENVIRONMENT_VARIABLE = "AIM_DATA"
+
+
+class RingBuffer:
+	def __init__(self, memory: shared_memory.SharedMemory, owner: bool):
+		self.memory = memory
+		self.owner = owner  # Unlinks the memory when closed
+		self.capacity = (memory.size - CONTROL_SIZE) // 4 * 4  # Records are 4 byte aligned
+
+		self._positions = np.ndarray((3,), dtype='<u8', buffer=memory.buf)
+		self._data = np.ndarray((self.capacity,), dtype='u1', buffer=memory.buf, offset=CONTROL_SIZE)
+
+	@classmethod
+	def create(cls, capacity: int = 2**22) -> "RingBuffer":
+		ring = cls(shared_memory.SharedMemory(create=True, size=CONTROL_SIZE + capacity), owner=True)
+		ring._positions[:] = 0
+		return ring
+
+	@classmethod
+	def attach(cls, name: str) -> "RingBuffer":
+		memory = shared_memory.SharedMemory(name=name)
+
+		if sys.version_info < (3, 13):
+			# Attaching registers the memory to be unlinked when this process exits, while it is the
+			# creator that owns it. Newer Pythons have track=False for this
+			from multiprocessing import resource_tracker
+			resource_tracker.unregister(memory._name, "shared_memory")
+
+		return cls(memory, owner=False)
+
+	@property
+	def name(self) -> str:
+		return self.memory.name
+
+	@property
+	def dropped(self) -> int:
+		return int(self._positions[2])
+
+	def write(self, node_id: int, voice_id: int, samples: np.ndarray) -> bool:
+		"""
+		Write a record. Returns False if it was dropped, as the reader is behind
+		"""
+		size = RECORD.size + samples.size * 4
+		write = int(self._positions[0])
+		offset = write % self.capacity
+
+		# Records are never split, so one that does not fit before the end goes at the start
+		skip = self.capacity - offset if self.capacity - offset < size else 0
+
+		if write + skip + size - int(self._positions[1]) > self.capacity:
+			self._positions[2] += 1
+			return False
+
+		if skip:
+			if skip >= RECORD.size:
+				RECORD.pack_into(self._data, offset, WRAP, 0, 0)
+			write += skip
+			offset = 0
+
+		RECORD.pack_into(self._data, offset, node_id, voice_id, samples.size)
+		self._data[offset + RECORD.size:offset + size].view('<f4')[:] = samples
+
+		self._positions[0] = write + size  # Makes the record visible to the reader
+
+		return True
+
+	def read(self) -> Iterator[tuple[int, int, np.ndarray]]:
+		"""
+		Node id, voice id and samples of every record written so far
+
+		The samples are a view of the shared memory, only valid until the next record is read. Copy
+		them to keep them.
+		"""
+		while (read := int(self._positions[1])) != int(self._positions[0]):
+			offset = read % self.capacity
+
+			if self.capacity - offset < RECORD.size:
+				self._positions[1] = read + self.capacity - offset
+				continue
+
+			node_id, voice_id, length = RECORD.unpack_from(self._data, offset)
+
+			if node_id == WRAP:
+				self._positions[1] = read + self.capacity - offset
+				continue
+
+			size = RECORD.size + length * 4
+			try:
+				yield node_id, voice_id, self._data[offset + RECORD.size:offset + size].view('<f4')
+			finally:
+				self._positions[1] = read + size  # Gives the space back to the writer
+
+	def close(self) -> None:
+		# The views must go before the memory can be closed
+		del self._positions, self._data
+		self.memory.close()
+
+		if self.owner:
+			self.memory.unlink()
+
+
+def test_ring_buffer() -> None:
+	ring = RingBuffer.create(256)
+
+	# Like attach(), but in the same process, which should keep the memory registered for unlinking
+	reader = RingBuffer(shared_memory.SharedMemory(name=ring.name), owner=False)
+
+	try:
+		samples = np.arange(20, dtype='float32')
+
+		assert list(reader.read()) == []
+		assert ring.write(12, 3, samples)
+		assert ring.write(13, 0, samples[:0])  # Voice went away
+
+		records = list((node_id, voice_id, x.copy()) for node_id, voice_id, x in reader.read())
+		assert [x[:2] for x in records] == [(12, 3), (13, 0)]
+		assert np.array_equal(records[0][2], samples) and len(records[1][2]) == 0
+
+		# No copy for the reader
+		ring.write(1, 1, samples)
+		for node_id, voice_id, view in reader.read():
+			assert np.shares_memory(view, reader._data)
+
+		# Goes around the end of the buffer many times
+		for i in range(50):
+			assert ring.write(i, i, samples[:i % 15])
+			(node_id, voice_id, view), = list(reader.read())
+			assert (node_id, voice_id) == (i, i) and np.array_equal(view, samples[:i % 15])
+
+		# Full, as the reader does not read
+		written = 0
+		while ring.write(5, 5, samples):
+			written += 1
+
+		assert 0 < written <= 256 // (RECORD.size + 80) and ring.dropped == 1 == reader.dropped
+		assert len(list(reader.read())) == written
+		assert ring.write(5, 5, samples)
+	finally:
+		reader.close()
+		ring.close()
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")
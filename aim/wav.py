@@ -0,0 +1,131 @@
+"""
+Writes audio to files, a block at a time
+
+Nothing is kept in memory, so files can be as long as the disk allows. Files ending with .wav
+are written as 32-bit float WAV, anything else as raw interleaved float32 (f32le), like the
+files in .data.
+"""
+import struct
+
+import numpy as np
+
+
+class RawWriter:
+	def __init__(self, path: str, channel_count: int, sample_rate: int, buffer_size: int = -1):
+		"""
+		buffer_size is the bytes the file is written in, the default of Python if -1
+		"""
+		self.path = path
+		self.channel_count = channel_count
+		self.sample_rate = sample_rate
+		self.frames = 0  # Written so far
+		self._file = open(path, "wb", buffering=buffer_size)
+
+	def write(self, frames: np.ndarray) -> None:
+		"""
+		Write frames, one row per frame and one column per channel
+		"""
+		assert frames.ndim == 2 and frames.shape[1] == self.channel_count, frames.shape
+		assert frames.dtype == np.float32, frames.dtype
+
+		self._file.write(np.ascontiguousarray(frames).data)
+		self.frames += len(frames)
+
+	def close(self) -> None:
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args) -> None:
+		self.close()
+
+
+class WavWriter(RawWriter):
+	"""
+	WAVE_FORMAT_IEEE_FLOAT. The sizes in the header are written when the file is closed
+	"""
+	HEADER_SIZE = 58
+
+	def __init__(self, path: str, channel_count: int, sample_rate: int, buffer_size: int = -1):
+		super().__init__(path, channel_count, sample_rate, buffer_size)
+		self._file.write(self._header())
+
+	def close(self) -> None:
+		if self._file.closed:
+			return
+
+		self._file.seek(0)
+		self._file.write(self._header())
+		super().close()
+
+	def _header(self) -> bytes:
+		data_size = self.frames * self.channel_count * 4
+		block_align = self.channel_count * 4
+
+		return b"".join(
+			[
+				b"RIFF",
+				struct.pack("<I", self.HEADER_SIZE - 8 + data_size),
+				b"WAVE",
+				b"fmt ",
+				struct.pack(
+					"<IHHIIHHH",
+					18,  # Size of the fmt chunk
+					3,  # WAVE_FORMAT_IEEE_FLOAT
+					self.channel_count,
+					self.sample_rate,
+					self.sample_rate * block_align,
+					block_align,
+					32,
+					0,  # No extension
+				),
+				b"fact",
+				struct.pack("<II", 4, self.frames),  # Required for non-PCM formats
+				b"data",
+				struct.pack("<I", data_size),
+			]
+		)
+
+
+def open_writer(path: str, channel_count: int, sample_rate: int, buffer_size: int = -1) -> RawWriter:
+	if path.lower().endswith(".wav"):
+		return WavWriter(path, channel_count, sample_rate, buffer_size)
+
+	return RawWriter(path, channel_count, sample_rate, buffer_size)
+
+
+def test_wav_writer() -> None:
+	import os
+	import tempfile
+
+	with tempfile.TemporaryDirectory() as folder:
+		frames = np.arange(10, dtype='float32').reshape(5, 2) / 10
+
+		for name in ("out.wav", "out.raw"):
+			path = folder + os.path.sep + name
+
+			with open_writer(path, 2, 44100) as writer:
+				writer.write(frames)
+				writer.write(frames[:2])
+
+			with open(path, "rb") as f:
+				data = f.read()
+
+			if name.endswith(".wav"):
+				assert len(data) == WavWriter.HEADER_SIZE + 7 * 2 * 4
+				assert data[:4] == b"RIFF" and data[8:12] == b"WAVE"
+				assert struct.unpack("<I", data[4:8])[0] == len(data) - 8
+				assert struct.unpack("<HHI", data[20:28]) == (3, 2, 44100)
+				assert struct.unpack("<I", data[46:50])[0] == 7  # Frames in the fact chunk
+				assert struct.unpack("<I", data[54:58])[0] == 7 * 2 * 4
+				data = data[WavWriter.HEADER_SIZE:]
+
+			result = np.frombuffer(data, dtype='<f4').reshape(-1, 2)
+			assert np.array_equal(result, np.concatenate([frames, frames[:2]]))
+
+
+if __name__ == '__main__':
+	for x in dir():
+		if x.startswith("test_"):
+			exec(f"{x}()")